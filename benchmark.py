@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# benchmark.py - carga ponta a ponta nos handlers reais de bot.py
+# - Updates sintéticos do telebot (/start, /saldo, /comprar, buy_, /pix)
+# - Telegram substituído por um stand-in (apihelper.CUSTOM_REQUEST_SENDER) com latência configurável
+# - Mercado Pago substituído por um servidor HTTP local (MP_API_BASE) com latência configurável
+# - Banco SQLite temporário (DB_PATH) populado antes da carga; com DB_BACKEND=postgres usa
+#   o DATABASE_URL (aponte para um banco descartável: a carga grava produtos/usuários nele)
+#
+# Reporta p50/p95/p99 por handler, throughput e esperas por lock do banco.
+#
+# Uso:
+#   python benchmark.py --requests 5000 --concurrency 16 --tg-latency 20 --mp-latency 80
+#   DB_BACKEND=postgres DATABASE_URL=postgresql://localhost/loja_bench python benchmark.py
+
+import argparse
+import base64
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# mistura padrão de operações (pesos relativos)
+DEFAULT_MIX = {"start": 10, "saldo": 30, "comprar": 25, "buy": 25, "pix": 10}
+
+# -------------------------
+# Stand-in do Mercado Pago
+# -------------------------
+def start_mp_standin(latency_ms: float):
+    counter = {"id": 1000}
+    lock = threading.Lock()
+    qr_png = base64.b64encode(b"\x89PNG\r\n\x1a\n" + b"\x00" * 64).decode()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True  # cabeçalho e corpo vão em writes separados
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, obj):
+            if latency_ms:
+                time.sleep(latency_ms / 1000.0)
+            body = json.dumps(obj).encode()
+            self.send_response(201 if self.command == "POST" else 200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            with lock:
+                counter["id"] += 1
+                pid = counter["id"]
+            self._reply({
+                "id": pid,
+                "status": "pending",
+                "point_of_interaction": {"transaction_data": {"qr_code": f"000201PIX{pid}", "qr_code_base64": qr_png}},
+            })
+
+        def do_GET(self):
+            pid = self.path.rstrip("/").rsplit("/", 1)[-1]
+            self._reply({"id": int(pid) if pid.isdigit() else pid, "status": "approved"})
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# -------------------------
+# Stand-in do Telegram (todas as chamadas da Bot API)
+# -------------------------
+class FakeResponse:
+    status_code = 200
+    reason = "OK"
+
+    def __init__(self, result):
+        self._payload = {"ok": True, "result": result}
+        self.text = json.dumps(self._payload)
+
+    def json(self):
+        return self._payload
+
+def make_telegram_standin(latency_ms: float, counters: dict, lock: threading.Lock):
+    msg_id = {"n": 0}
+
+    def sender(method, url, params=None, files=None, **kwargs):
+        if latency_ms:
+            time.sleep(latency_ms / 1000.0)
+        api_method = url.rsplit("/", 1)[-1]
+        with lock:
+            counters[api_method] = counters.get(api_method, 0) + 1
+            msg_id["n"] += 1
+            n = msg_id["n"]
+        if api_method in ("answerCallbackQuery", "editMessageReplyMarkup", "deleteMessage"):
+            return FakeResponse(True)
+        chat_id = int((params or {}).get("chat_id") or 0)
+        return FakeResponse({"message_id": n, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "text": ""})
+
+    return sender
+
+# -------------------------
+# Updates sintéticos
+# -------------------------
+def _user(uid):
+    return {"id": uid, "is_bot": False, "first_name": "Bench", "last_name": str(uid), "username": f"bench{uid}"}
+
+def message_update(update_id: int, uid: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"},
+            "from": _user(uid),
+            "text": text,
+        },
+    }
+
+def callback_update(update_id: int, uid: int, data: str) -> dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": _user(uid),
+            "chat_instance": str(uid),
+            "data": data,
+            "message": {"message_id": update_id, "date": int(time.time()), "chat": {"id": uid, "type": "private"}, "text": "🛒"},
+        },
+    }
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, int(round(p / 100.0 * (len(sorted_values) - 1)))))
+    return sorted_values[k]
+
+# -------------------------
+# Execução
+# -------------------------
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark ponta a ponta dos handlers de bot.py")
+    ap.add_argument("--requests", type=int, default=2000, help="total de updates enviados")
+    ap.add_argument("--concurrency", type=int, default=8, help="updates processados em paralelo")
+    ap.add_argument("--users", type=int, default=500)
+    ap.add_argument("--products", type=int, default=20)
+    ap.add_argument("--stock", type=int, default=200, help="acessos por produto")
+    ap.add_argument("--tg-latency", type=float, default=0.0, help="latência do stand-in do Telegram (ms)")
+    ap.add_argument("--mp-latency", type=float, default=0.0, help="latência do stand-in do Mercado Pago (ms)")
+    ap.add_argument("--tg-limits", action="store_true", help="mantém os limites reais de envio (30/s global, 1/s por chat)")
+    ap.add_argument("--mix", default=None, help='pesos, ex.: "start=10,saldo=30,comprar=25,buy=25,pix=10"')
+    ap.add_argument("--db", default=None, help="arquivo SQLite (padrão: temporário)")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", action="store_true", help="imprime o resultado em JSON")
+    args = ap.parse_args()
+
+    mix = dict(DEFAULT_MIX)
+    if args.mix:
+        mix = {k.strip(): float(v) for k, v in (p.split("=") for p in args.mix.split(","))}
+
+    tmpdir = tempfile.mkdtemp(prefix="bench-")
+    mp_server = start_mp_standin(args.mp_latency)
+    os.environ["DB_PATH"] = args.db or os.path.join(tmpdir, "bench.db")
+    os.environ["MP_API_BASE"] = f"http://127.0.0.1:{mp_server.server_port}"
+    os.environ.setdefault("TELEGRAM_TOKEN", "123456:BENCHMARK")
+    os.environ.setdefault("MP_ACCESS_TOKEN", "BENCHMARK")
+    os.environ.setdefault("OUTBOX_DEAD_LETTER", os.path.join(tmpdir, "dead_letters.jsonl"))
+    if not args.tg_limits:
+        # o stand-in não limita; sem isso a drenagem do outbox domina o tempo medido
+        os.environ.setdefault("OUTBOX_GLOBAL_RATE", "1000000")
+        os.environ.setdefault("OUTBOX_CHAT_RATE", "1000000")
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from telebot import apihelper
+    import db
+    import bot
+
+    tg_calls = {}
+    tg_lock = threading.Lock()
+    apihelper.CUSTOM_REQUEST_SENDER = make_telegram_standin(args.tg_latency, tg_calls, tg_lock)
+    # executa o handler na thread que chamou process_new_updates, para medir a latência dele
+    bot.bot.threaded = False
+
+    # popular banco
+    db.migrate()
+    db.load_acl_cache()
+    product_ids = [db.add_product(f"Produto {i}", 5.0 + i % 7) for i in range(args.products)]
+    for pid in product_ids:
+        db.bulk_add_product_access(pid, ((f"login{pid}_{n}", "senha") for n in range(args.stock)))
+    user_ids = [100000 + i for i in range(args.users)]
+    for uid in user_ids:
+        db.ensure_user(uid, f"bench{uid}", "Bench", str(uid))
+        db.credit_balance(uid, 1000.0)
+    db.reset_lock_stats()
+
+    rnd = random.Random(args.seed)
+    kinds = list(mix)
+    weights = [mix[k] for k in kinds]
+    plan = []
+    for i in range(args.requests):
+        kind = rnd.choices(kinds, weights)[0]
+        uid = rnd.choice(user_ids)
+        if kind == "buy":
+            upd = callback_update(i + 1, uid, f"buy_{rnd.choice(product_ids)}")
+        elif kind == "pix":
+            upd = message_update(i + 1, uid, f"/pix {rnd.randint(10, 100)}")
+        else:
+            upd = message_update(i + 1, uid, f"/{kind}")
+        plan.append((kind, upd))
+
+    from telebot.types import Update
+    latencies = {k: [] for k in kinds}
+    errors = {"count": 0}
+    lat_lock = threading.Lock()
+
+    def run_one(item):
+        kind, raw = item
+        update = Update.de_json(raw)
+        t0 = time.perf_counter()
+        try:
+            bot.bot.process_new_updates([update])
+        except Exception:
+            with lat_lock:
+                errors["count"] += 1
+        dt = time.perf_counter() - t0
+        with lat_lock:
+            latencies[kind].append(dt)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(run_one, plan))
+    elapsed = time.perf_counter() - started
+    # handlers só enfileiram os envios; espera o outbox esvaziar
+    while any(bot.outbox.depth().values()):
+        time.sleep(0.01)
+    drained = time.perf_counter() - started
+    mp_server.shutdown()
+
+    result = {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(args.requests / elapsed, 1) if elapsed else 0.0,
+        "errors": errors["count"],
+        "outbox_drained_s": round(drained, 3),
+        "outbox": dict(bot.outbox.stats),
+        "handlers": {},
+        "db_lock": db.lock_stats(),
+        "user_cache": db.user_cache_stats(),
+        "telegram_calls": tg_calls,
+    }
+    for kind, values in latencies.items():
+        values.sort()
+        result["handlers"][kind] = {
+            "n": len(values),
+            "p50_ms": round(percentile(values, 50) * 1000, 2),
+            "p95_ms": round(percentile(values, 95) * 1000, 2),
+            "p99_ms": round(percentile(values, 99) * 1000, 2),
+            "rps": round(len(values) / elapsed, 1) if elapsed else 0.0,
+        }
+
+    if args.json:
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+        return
+
+    print(f"\n=== BENCHMARK: {args.requests} updates, concorrência {args.concurrency} ===")
+    print(f"Tempo total: {result['elapsed_s']}s — throughput: {result['throughput_rps']} updates/s — erros: {result['errors']}")
+    print(f"Outbox drenado em {result['outbox_drained_s']}s — {result['outbox']}")
+    print(f"{'handler':<10}{'n':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}")
+    for kind, h in result["handlers"].items():
+        print(f"{kind:<10}{h['n']:>7}{h['p50_ms']:>10}{h['p95_ms']:>10}{h['p99_ms']:>10}{h['rps']:>10}")
+    lk = result["db_lock"]
+    print(f"\nDB: {lk['transactions']} transações, {lk['lock_waits']} esperas por lock ({lk['lock_wait_time']*1000:.1f} ms no total)")
+    uc = result["user_cache"]
+    print(f"Cache de usuários: {uc['hits']} hits / {uc['misses']} misses")
+    print(f"Chamadas à Bot API (stand-in): {tg_calls}")
+
+if __name__ == "__main__":
+    main()
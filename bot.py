@@ -8,28 +8,46 @@ import time
 import json
 import uuid
 import base64
+import csv
+import hmac
+import html
 import threading
-import sqlite3
-from io import BytesIO
+from collections import OrderedDict
+from datetime import date
+from io import BytesIO, TextIOWrapper
+from itertools import chain, islice
 
 import requests
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 
 import telebot
+from telebot.handler_backends import BaseMiddleware, CancelUpdate
 from telebot.types import (
     ReplyKeyboardMarkup, KeyboardButton,
-    InlineKeyboardMarkup, InlineKeyboardButton
+    InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 )
 
+import db
+import metrics
+from broadcast import BroadcastEngine
+from dispatcher import ChatDispatcher, install as install_dispatcher
+from mp_client import MercadoPagoClient, MP_API_BASE
+from outbox import Outbox
+from reconciler import PendingReconciler
+from webhook_queue import PaymentQueue
+
 # Import da camada de dados (db.py)
 from db import (
-    ensure_user, get_user_by_telegram, get_user_by_id,
-    get_balance, debit_balance, credit_balance,
-    add_transaction, approve_transaction_by_mp_id, get_transaction_by_mp_id,
-    get_approved_history, list_products, get_product, get_available_access, mark_access_sold,
-    add_product, add_product_access, is_admin_level, add_admin_db, remove_admin_db, list_admins_db,
-    ban_user_db, unban_user_db, is_banned_db,
-    get_sales_report, register_sale
+    migrate, ensure_user, get_user_by_telegram,
+    get_balance, debit_balance, credit_balance, LEDGER_ADMIN,
+    add_transaction, settle_approved_payment, mark_pending_transaction,
+    get_approved_history_page, list_products, list_categories, list_all_categories,
+    add_category, delete_category, set_product_category, get_product, catalog_version, get_available_access, mark_access_sold,
+    add_product, update_product, delete_product, add_product_access, bulk_add_product_access, recount_stock, is_admin_level, add_admin_db, remove_admin_db, list_admins_db,
+    ban_user_db, unban_user_db, is_banned_db, load_acl_cache,
+    get_sales_report, get_sales_report_range, get_product_sales_report, register_sale,
+    create_broadcast_job, get_broadcast_job,
+    purchase, PURCHASE_NOT_FOUND, PURCHASE_NO_USER, PURCHASE_INSUFFICIENT_BALANCE, PURCHASE_OUT_OF_STOCK
 )
 
 # -------------------------
@@ -45,14 +63,102 @@ else:
     WEBHOOK_BASE_URL = None
 
 STORE_NAME = "Polém Store🐝"
-DB_PATH = "store.db"
+
+# Modo de recebimento de updates do Telegram: "polling" (padrão) ou "webhook"
+# No modo webhook o Telegram faz POST em {TELEGRAM_WEBHOOK_URL}/tg/webhook (mesmo Flask do MP)
+TELEGRAM_MODE = (os.environ.get("TELEGRAM_MODE") or "polling").lower()
+TELEGRAM_WEBHOOK_URL = os.environ.get("TELEGRAM_WEBHOOK_URL") or WEBHOOK_BASE_URL
+TELEGRAM_WEBHOOK_SECRET = os.environ.get("TELEGRAM_WEBHOOK_SECRET") or None
+FLASK_PORT = int(os.environ.get("PORT") or 8000)
+# EMBEDDED_FLASK=0: o HTTP fica com o servidor WSGI (wsgi.py, vários workers) e este
+# processo só faz polling, reconciliação e broadcasts
+EMBEDDED_FLASK = (os.environ.get("EMBEDDED_FLASK") or "1").lower() not in ("0", "false", "no")
 
 # Inicializa Telebot (pyTelegramBotAPI)
-bot = telebot.TeleBot(TELEGRAM_TOKEN, parse_mode="HTML")
+bot = telebot.TeleBot(TELEGRAM_TOKEN, parse_mode="HTML", use_class_middlewares=True)
 
 # Flask (webhook)
 app = Flask(__name__)
 
+# Despacho de updates: ordem garantida por chat, chats diferentes em paralelo
+DISPATCH_WORKERS = int(os.environ.get("DISPATCH_WORKERS") or 8)
+dispatcher = ChatDispatcher(workers=DISPATCH_WORKERS)
+
+# -------------------------
+# Métricas (GET /metrics, formato Prometheus)
+# -------------------------
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN") or None  # se definido, exige Authorization: Bearer
+M_UPDATES = metrics.Counter("bot_updates_total", "Updates processados por handler", ("handler",))
+M_HANDLER_ERRORS = metrics.Counter("bot_handler_errors_total", "Exceções não tratadas por handler", ("handler",))
+M_HANDLER_SECONDS = metrics.Histogram("bot_handler_seconds", "Latência dos handlers", ("handler",))
+M_DB_SECONDS = metrics.Histogram("db_call_seconds", "Latência das funções de db.py", ("function",))
+M_DB_ERRORS = metrics.Counter("db_call_errors_total", "Exceções nas funções de db.py", ("function",))
+M_MP_SECONDS = metrics.Histogram("mp_request_seconds", "Latência das chamadas ao Mercado Pago", ("endpoint",))
+M_MP_REQUESTS = metrics.Counter("mp_requests_total", "Chamadas ao Mercado Pago por status", ("endpoint", "status"))
+M_TG_SECONDS = metrics.Histogram("telegram_send_seconds", "Latência dos envios à Bot API", ("method",))
+M_TG_SENDS = metrics.Counter("telegram_sends_total", "Envios à Bot API por resultado", ("method", "status"))
+M_WEBHOOK = metrics.Counter("mp_webhook_total", "Notificações recebidas em /mp/webhook", ("outcome",))
+M_PAYMENTS = metrics.Counter("payment_checks_total", "Pagamentos consultados no MP por status", ("status",))
+M_WALLET_OPS = metrics.Counter("wallet_operations_total", "Créditos/débitos na carteira", ("kind", "source"))
+M_WALLET_AMOUNT = metrics.Counter("wallet_amount_total", "Valor (R$) creditado/debitado", ("kind", "source"))
+
+def _observe_db(name, seconds, error):
+    M_DB_SECONDS.observe(seconds, function=name)
+    if error is not None:
+        M_DB_ERRORS.inc(function=name)
+
+def _observe_mp(endpoint, status, seconds):
+    M_MP_SECONDS.observe(seconds, endpoint=endpoint)
+    M_MP_REQUESTS.inc(endpoint=endpoint, status=status)
+
+def _observe_tg(method, status, seconds):
+    M_TG_SECONDS.observe(seconds, method=method)
+    M_TG_SENDS.inc(method=method, status=status)
+
+def _wallet(kind: str, source: str, amount: float):
+    M_WALLET_OPS.inc(kind=kind, source=source)
+    M_WALLET_AMOUNT.inc(amount, kind=kind, source=source)
+
+db.add_call_observer(_observe_db)
+
+# Envio para o Telegram: handlers só enfileiram; limites de taxa e 429 tratados no outbox
+outbox = Outbox(
+    bot,
+    global_rate=float(os.environ.get("OUTBOX_GLOBAL_RATE") or 30),
+    chat_rate=float(os.environ.get("OUTBOX_CHAT_RATE") or 1),
+    chat_burst=int(os.environ.get("OUTBOX_CHAT_BURST") or 3),
+    workers=int(os.environ.get("OUTBOX_WORKERS") or 8),
+    dead_letter_path=os.environ.get("OUTBOX_DEAD_LETTER") or "dead_letters.jsonl",
+    observer=_observe_tg,
+)
+
+# -------------------------
+# Filtro de banidos (antes de qualquer handler)
+# -------------------------
+class BanMiddleware(BaseMiddleware):
+    """Descarta updates de usuários banidos; is_banned_db consulta só o cache em memória."""
+    def __init__(self):
+        super().__init__()
+        self.update_types = ["message", "callback_query"]
+
+    def pre_process(self, update, data):
+        user = getattr(update, "from_user", None)
+        if not user or not is_banned_db(user.id):
+            return
+        try:
+            if isinstance(update, CallbackQuery):
+                bot.answer_callback_query(update.id, "🚫 Você está banido da Polém Store.", show_alert=True)
+            elif (update.text or "").startswith("/start"):
+                outbox.send_message(update.chat.id, "🚫 Você está banido da Polém Store.")
+        except Exception:
+            pass
+        return CancelUpdate()
+
+    def post_process(self, update, data, exception):
+        pass
+
+bot.setup_middleware(BanMiddleware())
+
 # -------------------------
 # UTIL: keyboard principal
 # -------------------------
@@ -66,20 +172,23 @@ def main_keyboard():
 # -------------------------
 # Helper: Mercado Pago - criar PIX
 # -------------------------
+# cliente compartilhado (keep-alive, retentativas, circuit breaker); MP_API_BASE permite um stand-in local
+mp = MercadoPagoClient(
+    MP_ACCESS_TOKEN,
+    base_url=os.environ.get("MP_API_BASE") or MP_API_BASE,
+    pool_size=int(os.environ.get("MP_POOL_SIZE") or 20),
+    max_retries=int(os.environ.get("MP_MAX_RETRIES") or 3),
+    observer=_observe_mp,
+)
+
 def mp_create_pix(amount: float, description: str, external_reference: str):
     """
     Cria pagamento PIX no Mercado Pago v1 Payments.
-    - Adiciona header X-Idempotency-Key
+    - Adiciona header X-Idempotency-Key (reenviado nas retentativas do mp_client)
     - Usa payer.email com plus-addressing para evitar validações
     - Se CLOUDFLARE_SUBDOMAIN definido, inclui notification_url
     """
-    url = "https://api.mercadopago.com/v1/payments"
     idempotency_key = str(uuid.uuid4())
-    headers = {
-        "Authorization": f"Bearer {MP_ACCESS_TOKEN}",
-        "Content-Type": "application/json",
-        "X-Idempotency-Key": idempotency_key
-    }
 
     payer_email = f"pagador+{external_reference}@gmail.com"
 
@@ -99,9 +208,7 @@ def mp_create_pix(amount: float, description: str, external_reference: str):
     if WEBHOOK_BASE_URL:
         payload["notification_url"] = f"{WEBHOOK_BASE_URL}/mp/webhook"
 
-    resp = requests.post(url, json=payload, headers=headers, timeout=25)
-    resp.raise_for_status()
-    data = resp.json()
+    data = mp.create_payment(payload, idempotency_key=idempotency_key)
 
     # Extrair QR / QR base64 em diferentes formatos
     poi = data.get("point_of_interaction") or data.get("pointofinteraction") or {}
@@ -119,11 +226,7 @@ def mp_create_pix(amount: float, description: str, external_reference: str):
     }
 
 def mp_get_payment(payment_id: str):
-    url = f"https://api.mercadopago.com/v1/payments/{payment_id}"
-    headers = {"Authorization": f"Bearer {MP_ACCESS_TOKEN}"}
-    resp = requests.get(url, headers=headers, timeout=15)
-    resp.raise_for_status()
-    return resp.json()
+    return mp.get_payment(payment_id)
 
 # -------------------------
 # Comandos básicos /start e botões
@@ -132,10 +235,7 @@ def mp_get_payment(payment_id: str):
 def cmd_start(message):
     tg = message.from_user
     ensure_user(tg.id, tg.username, tg.first_name, tg.last_name)
-    # se banido, bloqueia
-    if is_banned_db(tg.id):
-        bot.send_message(message.chat.id, "🚫 Você está banido da Polém Store.")
-        return
+    # banidos já foram filtrados pelo BanMiddleware
 
     texto = (
         f"🐝 <b>{STORE_NAME}</b>\n\n"
@@ -152,7 +252,7 @@ def cmd_start(message):
         "✍️ /sugestao TEXTO – enviar sugestão\n"
         "🔑 /admin SENHA – painel admin"
     )
-    bot.send_message(message.chat.id, texto, reply_markup=main_keyboard())
+    outbox.send_message(message.chat.id, texto, reply_markup=main_keyboard())
 
 # Mapear teclado para comandos
 @bot.message_handler(func=lambda m: m.text == "📊 Saldo")
@@ -169,11 +269,11 @@ def comprar_btn(m): cmd_comprar(m)
 
 @bot.message_handler(func=lambda m: m.text == "✍️ Sugestão")
 def sugestao_btn(m):
-    bot.reply_to(m, "✉️ Envie sua sugestão assim: /sugestao texto da sugestão")
+    outbox.reply_to(m, "✉️ Envie sua sugestão assim: /sugestao texto da sugestão")
 
 @bot.message_handler(func=lambda m: m.text == "💰 Gerar PIX")
 def gerar_pix_btn(m):
-    bot.reply_to(m, "Use o comando: /pix VALOR (ex: /pix 20.00) — valor mínimo R$10.00")
+    outbox.reply_to(m, "Use o comando: /pix VALOR (ex: /pix 20.00) — valor mínimo R$10.00")
 
 # -------------------------
 # Saldo / Perfil / Histórico
@@ -183,32 +283,80 @@ def cmd_saldo(message):
     tg = message.from_user
     ensure_user(tg.id, tg.username, tg.first_name, tg.last_name)
     bal = get_balance(tg.id)
-    bot.reply_to(message, f"💰 Seu saldo atual é: R$ {bal:.2f}")
+    outbox.reply_to(message, f"💰 Seu saldo atual é: R$ {bal:.2f}")
 
 @bot.message_handler(commands=["perfil"])
 def cmd_perfil(message):
     tg = message.from_user
     ensure_user(tg.id, tg.username, tg.first_name, tg.last_name)
     bal = get_balance(tg.id)
-    bot.reply_to(message,
+    outbox.reply_to(message,
         f"👤 Perfil\n"
         f"Usuário: @{tg.username or '—'}\n"
         f"Nome: {tg.first_name or ''} {tg.last_name or ''}\n"
         f"💰 Saldo: R${bal:.2f}"
     )
 
-@bot.message_handler(commands=["historico"])
-def cmd_historico(message):
-    tg = message.from_user
-    rows = get_approved_history(tg.id, limit=20)
+# /historico paginado por cursor: callback_data "hist:o:<id>" (mais antigas) / "hist:n:<id>" (mais novas),
+# com o id da transação na borda da página em base 36
+HISTORY_PAGE_SIZE = 10
+
+def _history_page(telegram_id: int, direction: str = None, cursor: int = None):
+    """Retorna (texto, markup) da página; markup None quando não há navegação."""
+    page = get_approved_history_page(
+        telegram_id, limit=HISTORY_PAGE_SIZE,
+        before_id=cursor if direction == "o" else None,
+        after_id=cursor if direction == "n" else None,
+    )
+    rows = page["rows"]
     if not rows:
-        bot.reply_to(message, "🔍 Nenhuma transação aprovada encontrada.")
-        return
+        return None, None
     texto = "📜 Histórico de recargas aprovadas:\n\n"
     for r in rows:
-        dt = (r.get("approved_at") or r.get("created_at") or "")[:19]
+        dt = (r.get("approved_at") or "")[:19]
         texto += f"• R${float(r['amount']):.2f} — {dt} — ID {r.get('mp_id')}\n"
-    bot.reply_to(message, texto)
+    buttons = []
+    if page["has_newer"]:
+        buttons.append(InlineKeyboardButton("⬅️ Mais recentes", callback_data=f"hist:n:{_b36(rows[0]['id'])}"))
+    if page["has_older"]:
+        buttons.append(InlineKeyboardButton("Mais antigas ➡️", callback_data=f"hist:o:{_b36(rows[-1]['id'])}"))
+    markup = None
+    if buttons:
+        markup = InlineKeyboardMarkup()
+        markup.row(*buttons)
+    return texto, markup
+
+def _b36(n: int) -> str:
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = digits[r] + out
+        if n == 0:
+            return out
+
+@bot.message_handler(commands=["historico"])
+def cmd_historico(message):
+    tg = message.from_user
+    texto, markup = _history_page(tg.id)
+    if not texto:
+        outbox.reply_to(message, "🔍 Nenhuma transação aprovada encontrada.")
+        return
+    outbox.reply_to(message, texto, reply_markup=markup)
+
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("hist:"))
+def callback_historico(call):
+    try:
+        _prefix, direction, cursor = call.data.split(":", 2)
+        texto, markup = _history_page(call.from_user.id, direction, int(cursor, 36))
+        if not texto:
+            bot.answer_callback_query(call.id, "🔍 Nada mais para mostrar.")
+            return
+        outbox.enqueue(call.message.chat.id, "edit_message_text", (texto, call.message.chat.id, call.message.message_id),
+                       {"reply_markup": markup})
+        bot.answer_callback_query(call.id)
+    except Exception as e:
+        bot.answer_callback_query(call.id, f"❌ Erro ao carregar histórico: {e}", show_alert=True)
 
 # -------------------------
 # /pix - gerar cobrança PIX
@@ -219,17 +367,17 @@ def cmd_pix(message):
         MIN_VALUE = 10.0
         parts = message.text.split()
         if len(parts) < 2:
-            bot.reply_to(message, f"⚠️ Use: /pix VALOR (mínimo R$ {MIN_VALUE:.2f})")
+            outbox.reply_to(message, f"⚠️ Use: /pix VALOR (mínimo R$ {MIN_VALUE:.2f})")
             return
 
         try:
             value = float(parts[1].replace(",", "."))
         except Exception:
-            bot.reply_to(message, "⚠️ Valor inválido. Use números como 10 ou 25.50")
+            outbox.reply_to(message, "⚠️ Valor inválido. Use números como 10 ou 25.50")
             return
 
         if value < MIN_VALUE:
-            bot.reply_to(message, f"⚠️ Valor mínimo: R$ {MIN_VALUE:.2f}")
+            outbox.reply_to(message, f"⚠️ Valor mínimo: R$ {MIN_VALUE:.2f}")
             return
 
         tg = message.from_user
@@ -244,12 +392,12 @@ def cmd_pix(message):
             try:
                 status_code = e.response.status_code
                 text = e.response.text
-                bot.reply_to(message, f"❌ Erro HTTP ao gerar PIX: {status_code} - {text}")
+                outbox.reply_to(message, f"❌ Erro HTTP ao gerar PIX: {status_code} - {text}")
             except Exception:
-                bot.reply_to(message, f"❌ Erro HTTP ao gerar PIX: {e}")
+                outbox.reply_to(message, f"❌ Erro HTTP ao gerar PIX: {e}")
             return
         except Exception as e:
-            bot.reply_to(message, f"❌ Erro ao gerar PIX: {e}")
+            outbox.reply_to(message, f"❌ Erro ao gerar PIX: {e}")
             return
 
         payment_id = mp_resp.get("payment_id")
@@ -257,7 +405,7 @@ def cmd_pix(message):
         qr_code_b64 = mp_resp.get("qr_code_base64")
 
         if not payment_id:
-            bot.reply_to(message, "❌ Não foi possível gerar o PIX no momento. Tente novamente mais tarde.")
+            outbox.reply_to(message, "❌ Não foi possível gerar o PIX no momento. Tente novamente mais tarde.")
             return
 
         # registrar transação pendente
@@ -274,38 +422,131 @@ def cmd_pix(message):
         if qr_code_str:
             text += f"📋 <b>Copia-e-cola PIX:</b>\n<code>{qr_code_str}</code>\n\n"
 
-        bot.send_message(message.chat.id, text, parse_mode="HTML")
+        outbox.send_message(message.chat.id, text, parse_mode="HTML", sensitive=True)
 
         if qr_code_b64:
             try:
                 img_bytes = base64.b64decode(qr_code_b64)
                 bio = BytesIO(img_bytes)
                 bio.name = "qrcode.png"
-                bot.send_photo(message.chat.id, photo=bio, caption="📷 QR Code PIX")
+                outbox.send_photo(message.chat.id, photo=bio, caption="📷 QR Code PIX", sensitive=True)
             except Exception as e:
                 print("Erro ao enviar QR image:", e)
 
     except requests.HTTPError as e:
-        bot.reply_to(message, f"❌ Erro HTTP ao gerar PIX: {e}")
+        outbox.reply_to(message, f"❌ Erro HTTP ao gerar PIX: {e}")
     except Exception as e:
-        bot.reply_to(message, f"❌ Erro ao gerar PIX: {e}")
+        outbox.reply_to(message, f"❌ Erro ao gerar PIX: {e}")
 
 # -------------------------
 # /comprar - lista produtos (inline buttons) e callback
 # -------------------------
+# Teclados de /comprar serializados por versão do catálogo (db.catalog_version); cada página
+# vem de uma consulta em janela (list_products com limit). Navegação edita o teclado na mesma mensagem.
+# callback_data: "cats" (categorias) | "cat:<cid>" (1ª página) | "cp:<cid>:a:<id>" / "cp:<cid>:b:<id>"
+# (próxima / anterior a partir do id da borda, em base 36)
+COMPRAR_PAGE_SIZE = int(os.environ.get("COMPRAR_PAGE_SIZE") or 8)
+COMPRAR_KB_CACHE_SIZE = 256
+_comprar_kb_cache = {"version": None, "pages": OrderedDict()}
+_comprar_kb_lock = threading.Lock()
+
+def _cached_keyboard(key, build):
+    version = catalog_version()
+    pages = _comprar_kb_cache["pages"]
+    with _comprar_kb_lock:
+        if _comprar_kb_cache["version"] != version:
+            _comprar_kb_cache["version"] = version
+            pages.clear()
+        if key in pages:
+            pages.move_to_end(key)
+            return pages[key]
+    markup_json = build()
+    with _comprar_kb_lock:
+        if _comprar_kb_cache["version"] == version:
+            pages[key] = markup_json
+            while len(pages) > COMPRAR_KB_CACHE_SIZE:
+                pages.popitem(last=False)
+    return markup_json
+
+def _categories_keyboard():
+    categorias = list_categories()
+    if not categorias:
+        return None
+    markup = InlineKeyboardMarkup()
+    for c in categorias:
+        markup.add(InlineKeyboardButton(f"{c['name']} ({c['available']})", callback_data=f"cat:{_b36(c['id'])}"))
+    return markup.to_json()
+
+def _products_keyboard(category_id: int, direction: str = None, cursor: int = None, back: bool = False):
+    n = COMPRAR_PAGE_SIZE
+    if direction == "b":
+        rows = list_products(category_id=category_id, before_id=cursor, limit=n + 1)
+        has_prev, has_next = len(rows) > n, True
+        rows = rows[-n:]
+    else:
+        rows = list_products(category_id=category_id, after_id=cursor, limit=n + 1)
+        has_prev, has_next = cursor is not None, len(rows) > n
+        rows = rows[:n]
+    if not rows:
+        return None
+    markup = InlineKeyboardMarkup()
+    for p in rows:
+        label = f"{p['name']} - R${float(p['price']):.2f} ({p['stock']} disp.)"
+        markup.add(InlineKeyboardButton(label, callback_data=f"buy_{p['id']}"))
+    nav = []
+    cid = _b36(category_id)
+    if has_prev:
+        nav.append(InlineKeyboardButton("⬅️", callback_data=f"cp:{cid}:b:{_b36(rows[0]['id'])}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("➡️", callback_data=f"cp:{cid}:a:{_b36(rows[-1]['id'])}"))
+    if nav:
+        markup.row(*nav)
+    if back:
+        markup.add(InlineKeyboardButton("🔙 Categorias", callback_data="cats"))
+    return markup.to_json()
+
+def comprar_keyboard(category_id: int = None, direction: str = None, cursor: int = None):
+    """
+    Teclado de /comprar já em JSON, ou None se não há produtos.
+    Sem category_id: lista de categorias, ou direto os produtos se só existe uma.
+    """
+    if category_id is None:
+        def build_root():
+            categorias = list_categories()
+            if len(categorias) == 1:
+                return _products_keyboard(categorias[0]["id"])
+            return _categories_keyboard()
+        return _cached_keyboard(("root",), build_root)
+    key = ("page", category_id, direction, cursor)
+    return _cached_keyboard(key, lambda: _products_keyboard(category_id, direction, cursor, back=True))
+
 @bot.message_handler(commands=["comprar"])
 def cmd_comprar(message):
-    produtos = list_products()
-    if not produtos:
-        bot.reply_to(message, "📦 Nenhum produto disponível no momento.")
+    markup = comprar_keyboard()
+    if not markup:
+        outbox.reply_to(message, "📦 Nenhum produto disponível no momento.")
         return
 
-    markup = InlineKeyboardMarkup()
-    for p in produtos:
-        label = f"{p['name']} - R${float(p['price']):.2f}"
-        markup.add(InlineKeyboardButton(label, callback_data=f"buy_{p['id']}"))
+    outbox.send_message(message.chat.id, "🛒 Escolha um produto:", reply_markup=markup)
 
-    bot.send_message(message.chat.id, "🛒 Escolha um produto:", reply_markup=markup)
+@bot.callback_query_handler(func=lambda call: call.data and (call.data == "cats" or call.data.startswith(("cat:", "cp:"))))
+def callback_comprar_nav(call):
+    try:
+        parts = call.data.split(":")
+        if parts[0] == "cats":
+            markup = comprar_keyboard()
+        elif parts[0] == "cat":
+            markup = comprar_keyboard(int(parts[1], 36))
+        else:
+            markup = comprar_keyboard(int(parts[1], 36), parts[2], int(parts[3], 36))
+        if not markup:
+            bot.answer_callback_query(call.id, "📦 Nenhum produto disponível nesta página.")
+            return
+        outbox.enqueue(call.message.chat.id, "edit_message_reply_markup",
+                       (call.message.chat.id, call.message.message_id), {"reply_markup": markup})
+        bot.answer_callback_query(call.id)
+    except Exception as e:
+        bot.answer_callback_query(call.id, f"❌ Erro ao carregar produtos: {e}", show_alert=True)
 
 @bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("buy_"))
 def callback_buy(call):
@@ -313,35 +554,23 @@ def callback_buy(call):
         tg = call.from_user
         product_id = int(call.data.split("_", 1)[1])
 
-        product = get_product(product_id)
-        if not product:
+        # compra inteira (estoque + carteira + venda) em uma única transação
+        result = purchase(tg.id, product_id)
+        status = result["status"]
+        if status == PURCHASE_NOT_FOUND:
             bot.answer_callback_query(call.id, "❌ Produto não encontrado.", show_alert=True)
             return
-
-        balance = get_balance(tg.id)
-        price = float(product["price"])
-
-        if balance < price:
-            bot.answer_callback_query(call.id, f"⚠️ Saldo insuficiente. Gere PIX com /pix {price:.2f}", show_alert=True)
+        if status in (PURCHASE_INSUFFICIENT_BALANCE, PURCHASE_NO_USER):
+            bot.answer_callback_query(call.id, f"⚠️ Saldo insuficiente. Gere PIX com /pix {result['price']:.2f}", show_alert=True)
             return
-
-        # pega acesso disponível (tratamos colunas 'password' ou 'senha' no db)
-        access = get_available_access(product_id)
-        if not access:
+        if status == PURCHASE_OUT_OF_STOCK:
             bot.answer_callback_query(call.id, "📦 Produto esgotado. Nenhum acesso disponível.", show_alert=True)
             return
 
-        # marca vendido e debita
-        mark_access_sold(access["id"])
-        debit_balance(tg.id, price)
-
-        # registra venda (opcional): usa register_sale se presente
-        try:
-            user_row = get_user_by_telegram(tg.id)
-            if user_row:
-                register_sale(user_row["id"], product_id, price, quantity=1)
-        except Exception:
-            pass
+        product = result["product"]
+        price = result["price"]
+        access = result["access"]
+        _wallet("debit", "purchase", price)
 
         # mensagem com credenciais
         text = (
@@ -352,7 +581,7 @@ def callback_buy(call):
             f"🔐 Senha: {access.get('password') or access.get('senha')}\n\n"
             "Obrigado por comprar na Polém Store 🐝"
         )
-        bot.send_message(call.message.chat.id, text)
+        outbox.send_message(call.message.chat.id, text, sensitive=True)
         bot.answer_callback_query(call.id)
     except Exception as e:
         bot.answer_callback_query(call.id, f"❌ Erro na compra: {e}", show_alert=True)
@@ -364,10 +593,10 @@ def callback_buy(call):
 def cmd_sugestao(message):
     texto = message.text.replace("/sugestao", "").strip()
     if not texto:
-        bot.reply_to(message, "✉️ Envie sua sugestão assim: /sugestao texto da sugestão")
+        outbox.reply_to(message, "✉️ Envie sua sugestão assim: /sugestao texto da sugestão")
         return
     # Poderíamos salvar em uma tabela 'suggestions' — hoje apenas confirma
-    bot.reply_to(message, "✅ Obrigado pela sugestão! Ela foi registrada.")
+    outbox.reply_to(message, "✅ Obrigado pela sugestão! Ela foi registrada.")
 
 # -------------------------
 # ADMIN: painel e comandos
@@ -381,27 +610,32 @@ def _is_admin_level(user_telegram_id:int, senha: str = None, min_level: int = 1)
 def cmd_admin(message):
     parts = message.text.split(maxsplit=1)
     if len(parts) < 2:
-        bot.reply_to(message, "❌ Use: /admin SENHA")
+        outbox.reply_to(message, "❌ Use: /admin SENHA")
         return
     senha = parts[1].strip()
     tg = message.from_user
     if not _is_admin_level(tg.id, senha, min_level=1):
-        bot.reply_to(message, "🚫 Acesso negado. Senha incorreta ou você não é admin.")
+        outbox.reply_to(message, "🚫 Acesso negado. Senha incorreta ou você não é admin.")
         return
 
     # Identificar nível real (sem expor senha)
     # buscamos na tabela admins pelo telegram_id (senha ok garantiu min_level)
     # Mostrar menu simples via texto (para comandos explícitos)
-    bot.reply_to(message,
+    outbox.reply_to(message,
         "🔐 Painel Admin — comandos:\n"
         "Nível 1 (suporte): /ban TELEGRAMID | SENHA_ADMIN, /unban TELEGRAMID | SENHA_ADMIN, /admins LISTA\n"
         "Nível 2 (super): /addproduto NOME | PRECO | SENHA_ADMIN, /editproduto ID | NOME | PRECO | SENHA_ADMIN, /delproduto ID | SENHA_ADMIN\n"
         "/addacesso PRODUTOID | LOGIN | PASSWORD | SENHA_ADMIN\n"
+        "/importar PRODUTOID | SENHA_ADMIN (na legenda de um arquivo .txt/.csv, uma linha LOGIN | SENHA)\n"
+        "/recontarestoque SENHA_ADMIN, /sqlstats SENHA_ADMIN\n"
+        "/categorias SENHA_ADMIN, /addcategoria NOME | SENHA_ADMIN, /delcategoria ID | SENHA_ADMIN\n"
+        "/setcategoria PRODUTOID | CATEGORIAID (0 = nenhuma) | SENHA_ADMIN\n"
         "/addsaldo TELEGRAMID | VALOR | SENHA_ADMIN\n"
         "/aprovarpix PAYMENTID | SENHA_ADMIN\n"
         "/addadmin TELEGRAMID | NOME | SENHA_ADMIN | NIVEL\n"
         "/rmadmin TELEGRAMID | SENHA_ADMIN\n"
-        "/report PERIOD (total/daily/weekly/monthly) | SENHA_ADMIN"
+        "/report PERIOD (total/daily/weekly/monthly ou AAAA-MM-DD..AAAA-MM-DD) | SENHA_ADMIN\n"
+        "/broadcast TEXTO | SENHA_ADMIN, /broadcaststatus ID | SENHA_ADMIN, /broadcastcancel ID | SENHA_ADMIN"
     )
 
 # /addadmin TELEGRAMID | NOME | SENHA_ADMIN | NIVEL  (somente nível 2)
@@ -410,20 +644,20 @@ def cmd_addadmin(message):
     try:
         payload = message.text.replace("/addadmin", "").strip()
         if not payload or "|" not in payload:
-            bot.reply_to(message, "❌ Use: /addadmin TELEGRAMID | NOME | SENHA_ADMIN | NIVEL")
+            outbox.reply_to(message, "❌ Use: /addadmin TELEGRAMID | NOME | SENHA_ADMIN | NIVEL")
             return
         target_tg_s, nome, senha_admin, nivel_s = [p.strip() for p in payload.split("|", 3)]
         target_tg = int(target_tg_s)
         nivel = int(nivel_s)
         # checar quem executa
         if not _is_admin_level(message.from_user.id, senha_admin, min_level=2):
-            bot.reply_to(message, "🚫 Apenas admins nível 2 podem adicionar admins.")
+            outbox.reply_to(message, "🚫 Apenas admins nível 2 podem adicionar admins.")
             return
         # adicionar
         add_admin_db(target_tg, nome, senha_admin, nivel)
-        bot.reply_to(message, f"✅ Admin adicionado: {target_tg} (nível {nivel}).")
+        outbox.reply_to(message, f"✅ Admin adicionado: {target_tg} (nível {nivel}).")
     except Exception as e:
-        bot.reply_to(message, f"❌ Erro ao adicionar admin: {e}")
+        outbox.reply_to(message, f"❌ Erro ao adicionar admin: {e}")
 
 # /rmadmin TELEGRAMID | SENHA_ADMIN (nível 2)
 @bot.message_handler(commands=["rmadmin"])
@@ -431,17 +665,17 @@ def cmd_rmadmin(message):
     try:
         payload = message.text.replace("/rmadmin", "").strip()
         if not payload or "|" not in payload:
-            bot.reply_to(message, "❌ Use: /rmadmin TELEGRAMID | SENHA_ADMIN")
+            outbox.reply_to(message, "❌ Use: /rmadmin TELEGRAMID | SENHA_ADMIN")
             return
         target_tg_s, senha_admin = [p.strip() for p in payload.split("|", 1)]
         target_tg = int(target_tg_s)
         if not _is_admin_level(message.from_user.id, senha_admin, min_level=2):
-            bot.reply_to(message, "🚫 Apenas admins nível 2 podem remover admins.")
+            outbox.reply_to(message, "🚫 Apenas admins nível 2 podem remover admins.")
             return
         remove_admin_db(target_tg)
-        bot.reply_to(message, f"✅ Admin {target_tg} removido.")
+        outbox.reply_to(message, f"✅ Admin {target_tg} removido.")
     except Exception as e:
-        bot.reply_to(message, f"❌ Erro ao remover admin: {e}")
+        outbox.reply_to(message, f"❌ Erro ao remover admin: {e}")
 
 # /admins - listar admins (nivel 1+)
 @bot.message_handler(commands=["admins"])
@@ -450,18 +684,18 @@ def cmd_list_admins(message):
         parts = message.text.split(maxsplit=1)
         senha = parts[1].strip() if len(parts) > 1 else None
         if not _is_admin_level(message.from_user.id, senha, min_level=1):
-            bot.reply_to(message, "🚫 Apenas admins podem ver a lista de admins.")
+            outbox.reply_to(message, "🚫 Apenas admins podem ver a lista de admins.")
             return
         rows = list_admins_db()
         if not rows:
-            bot.reply_to(message, "Nenhum admin cadastrado.")
+            outbox.reply_to(message, "Nenhum admin cadastrado.")
             return
         texto = "🔐 Admins cadastrados:\n"
         for r in rows:
             texto += f"• {r.get('telegram_id') or r.get('telegram_id')}: {r.get('name') or r.get('nome','-')} (nível {r.get('level') or r.get('nivel')})\n"
-        bot.reply_to(message, texto)
+        outbox.reply_to(message, texto)
     except Exception as e:
-        bot.reply_to(message, f"❌ Erro ao listar admins: {e}")
+        outbox.reply_to(message, f"❌ Erro ao listar admins: {e}")
 
 # /ban TELEGRAMID | SENHA_ADMIN  (nivel 1+ can ban non-admins)
 @bot.message_handler(commands=["ban"])
@@ -469,26 +703,26 @@ def cmd_ban(message):
     try:
         payload = message.text.replace("/ban", "").strip()
         if not payload or "|" not in payload:
-            bot.reply_to(message, "❌ Use: /ban TELEGRAMID | SENHA_ADMIN")
+            outbox.reply_to(message, "❌ Use: /ban TELEGRAMID | SENHA_ADMIN")
             return
         target_s, senha = [p.strip() for p in payload.split("|", 1)]
         target_tg = int(target_s)
         # quem executa must be admin level >=1
         if not _is_admin_level(message.from_user.id, senha, min_level=1):
-            bot.reply_to(message, "🚫 Apenas admins podem banir.")
+            outbox.reply_to(message, "🚫 Apenas admins podem banir.")
             return
         # cannot ban other admins
         try:
             # check if target is admin (any level)
             if is_admin_level(target_tg, None, min_level=1):
-                bot.reply_to(message, "🚫 Não é permitido banir outro admin.")
+                outbox.reply_to(message, "🚫 Não é permitido banir outro admin.")
                 return
         except Exception:
             pass
         ban_user_db(target_tg)
-        bot.reply_to(message, f"✅ Usuário {target_tg} banido.")
+        outbox.reply_to(message, f"✅ Usuário {target_tg} banido.")
     except Exception as e:
-        bot.reply_to(message, f"❌ Erro ao banir usuário: {e}")
+        outbox.reply_to(message, f"❌ Erro ao banir usuário: {e}")
 
 # /unban TELEGRAMID | SENHA_ADMIN
 @bot.message_handler(commands=["unban"])
@@ -496,17 +730,88 @@ def cmd_unban(message):
     try:
         payload = message.text.replace("/unban", "").strip()
         if not payload or "|" not in payload:
-            bot.reply_to(message, "❌ Use: /unban TELEGRAMID | SENHA_ADMIN")
+            outbox.reply_to(message, "❌ Use: /unban TELEGRAMID | SENHA_ADMIN")
             return
         target_s, senha = [p.strip() for p in payload.split("|", 1)]
         target_tg = int(target_s)
         if not _is_admin_level(message.from_user.id, senha, min_level=1):
-            bot.reply_to(message, "🚫 Apenas admins podem desbanir.")
+            outbox.reply_to(message, "🚫 Apenas admins podem desbanir.")
             return
         unban_user_db(target_tg)
-        bot.reply_to(message, f"✅ Usuário {target_tg} desbanido.")
+        outbox.reply_to(message, f"✅ Usuário {target_tg} desbanido.")
+    except Exception as e:
+        outbox.reply_to(message, f"❌ Erro ao desbanir usuário: {e}")
+
+# /categorias SENHA_ADMIN (nível 2)
+@bot.message_handler(commands=["categorias"])
+def cmd_categorias(message):
+    try:
+        senha = message.text.replace("/categorias", "").strip()
+        if not _is_admin_level(message.from_user.id, senha, min_level=2):
+            outbox.reply_to(message, "🚫 Apenas admins nível 2 podem gerenciar categorias.")
+            return
+        cats = list_all_categories()
+        if not cats:
+            outbox.reply_to(message, "📂 Nenhuma categoria. Use /addcategoria NOME | SENHA_ADMIN")
+            return
+        outbox.reply_to(message, "📂 Categorias:\n" + "\n".join(f"• {c['id']}: {html.escape(c['name'])}" for c in cats))
+    except Exception as e:
+        outbox.reply_to(message, f"❌ Erro ao listar categorias: {e}")
+
+# /addcategoria NOME | SENHA_ADMIN (nível 2)
+@bot.message_handler(commands=["addcategoria"])
+def cmd_addcategoria(message):
+    try:
+        payload = message.text.replace("/addcategoria", "").strip()
+        if not payload or "|" not in payload:
+            outbox.reply_to(message, "❌ Use: /addcategoria NOME | SENHA_ADMIN")
+            return
+        name, senha = [p.strip() for p in payload.split("|", 1)]
+        if not _is_admin_level(message.from_user.id, senha, min_level=2):
+            outbox.reply_to(message, "🚫 Apenas admins nível 2 podem gerenciar categorias.")
+            return
+        cid = add_category(name)
+        outbox.reply_to(message, f"✅ Categoria '{html.escape(name)}' criada (id: {cid}).")
+    except Exception as e:
+        outbox.reply_to(message, f"❌ Erro ao criar categoria: {e}")
+
+# /delcategoria ID | SENHA_ADMIN (nível 2) — produtos ficam sem categoria
+@bot.message_handler(commands=["delcategoria"])
+def cmd_delcategoria(message):
+    try:
+        payload = message.text.replace("/delcategoria", "").strip()
+        if not payload or "|" not in payload:
+            outbox.reply_to(message, "❌ Use: /delcategoria ID | SENHA_ADMIN")
+            return
+        cid_s, senha = [p.strip() for p in payload.split("|", 1)]
+        if not _is_admin_level(message.from_user.id, senha, min_level=2):
+            outbox.reply_to(message, "🚫 Apenas admins nível 2 podem gerenciar categorias.")
+            return
+        if delete_category(int(cid_s)):
+            outbox.reply_to(message, f"✅ Categoria {cid_s} removida.")
+        else:
+            outbox.reply_to(message, "❌ Categoria não encontrada.")
+    except Exception as e:
+        outbox.reply_to(message, f"❌ Erro ao remover categoria: {e}")
+
+# /setcategoria PRODUTOID | CATEGORIAID | SENHA_ADMIN (nível 2); CATEGORIAID 0 = sem categoria
+@bot.message_handler(commands=["setcategoria"])
+def cmd_setcategoria(message):
+    try:
+        payload = message.text.replace("/setcategoria", "").strip()
+        if not payload or payload.count("|") < 2:
+            outbox.reply_to(message, "❌ Use: /setcategoria PRODUTOID | CATEGORIAID | SENHA_ADMIN")
+            return
+        pid_s, cid_s, senha = [p.strip() for p in payload.split("|", 2)]
+        if not _is_admin_level(message.from_user.id, senha, min_level=2):
+            outbox.reply_to(message, "🚫 Apenas admins nível 2 podem gerenciar categorias.")
+            return
+        if set_product_category(int(pid_s), int(cid_s)):
+            outbox.reply_to(message, f"✅ Produto {pid_s} movido para a categoria {cid_s}.")
+        else:
+            outbox.reply_to(message, "❌ Produto ou categoria não encontrado.")
     except Exception as e:
-        bot.reply_to(message, f"❌ Erro ao desbanir usuário: {e}")
+        outbox.reply_to(message, f"❌ Erro ao definir categoria: {e}")
 
 # /addproduto NOME | PRECO | SENHA_ADMIN  (nível 2)
 @bot.message_handler(commands=["addproduto"])
@@ -514,17 +819,17 @@ def cmd_addproduto(message):
     try:
         payload = message.text.replace("/addproduto", "").strip()
         if not payload or "|" not in payload:
-            bot.reply_to(message, "❌ Use: /addproduto NOME | PRECO | SENHA_ADMIN")
+            outbox.reply_to(message, "❌ Use: /addproduto NOME | PRECO | SENHA_ADMIN")
             return
         name, price_str, senha = [p.strip() for p in payload.split("|", 2)]
         if not _is_admin_level(message.from_user.id, senha, min_level=2):
-            bot.reply_to(message, "🚫 Apenas admins nível 2 podem adicionar produtos.")
+            outbox.reply_to(message, "🚫 Apenas admins nível 2 podem adicionar produtos.")
             return
         price = float(price_str.replace(",", "."))
         pid = add_product(name, price)
-        bot.reply_to(message, f"✅ Produto '{name}' adicionado (id: {pid}) por R$ {price:.2f}")
+        outbox.reply_to(message, f"✅ Produto '{name}' adicionado (id: {pid}) por R$ {price:.2f}")
     except Exception as e:
-        bot.reply_to(message, f"❌ Erro ao adicionar produto: {e}")
+        outbox.reply_to(message, f"❌ Erro ao adicionar produto: {e}")
 
 # /editproduto ID | NOME | PRECO | SENHA_ADMIN  (nível 2)
 @bot.message_handler(commands=["editproduto"])
@@ -532,23 +837,18 @@ def cmd_editproduto(message):
     try:
         payload = message.text.replace("/editproduto", "").strip()
         if not payload or "|" not in payload:
-            bot.reply_to(message, "❌ Use: /editproduto ID | NOME | PRECO | SENHA_ADMIN")
+            outbox.reply_to(message, "❌ Use: /editproduto ID | NOME | PRECO | SENHA_ADMIN")
             return
         pid_s, name, price_str, senha = [p.strip() for p in payload.split("|", 3)]
         pid = int(pid_s)
         if not _is_admin_level(message.from_user.id, senha, min_level=2):
-            bot.reply_to(message, "🚫 Apenas admins nível 2 podem editar produtos.")
+            outbox.reply_to(message, "🚫 Apenas admins nível 2 podem editar produtos.")
             return
         price = float(price_str.replace(",", "."))
-        # update_product isn't in your db.py earlier; we'll do direct SQL here for safety
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("UPDATE products SET name = ?, price = ? WHERE id = ?", (name, price, pid))
-        conn.commit()
-        conn.close()
-        bot.reply_to(message, f"✅ Produto {pid} atualizado: {name} — R$ {price:.2f}")
+        update_product(pid, name, price)
+        outbox.reply_to(message, f"✅ Produto {pid} atualizado: {name} — R$ {price:.2f}")
     except Exception as e:
-        bot.reply_to(message, f"❌ Erro ao editar produto: {e}")
+        outbox.reply_to(message, f"❌ Erro ao editar produto: {e}")
 
 # /delproduto ID | SENHA_ADMIN (nível 2)
 @bot.message_handler(commands=["delproduto"])
@@ -556,21 +856,17 @@ def cmd_delproduto(message):
     try:
         payload = message.text.replace("/delproduto", "").strip()
         if not payload or "|" not in payload:
-            bot.reply_to(message, "❌ Use: /delproduto ID | SENHA_ADMIN")
+            outbox.reply_to(message, "❌ Use: /delproduto ID | SENHA_ADMIN")
             return
         pid_s, senha = [p.strip() for p in payload.split("|", 1)]
         pid = int(pid_s)
         if not _is_admin_level(message.from_user.id, senha, min_level=2):
-            bot.reply_to(message, "🚫 Apenas admins nível 2 podem remover produtos.")
-            return
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("DELETE FROM products WHERE id = ?", (pid,))
-        conn.commit()
-        conn.close()
-        bot.reply_to(message, f"✅ Produto {pid} removido.")
+            outbox.reply_to(message, "🚫 Apenas admins nível 2 podem remover produtos.")
+            return
+        delete_product(pid)
+        outbox.reply_to(message, f"✅ Produto {pid} removido.")
     except Exception as e:
-        bot.reply_to(message, f"❌ Erro ao remover produto: {e}")
+        outbox.reply_to(message, f"❌ Erro ao remover produto: {e}")
 
 # /addacesso PRODUTOID | LOGIN | PASSWORD | SENHA_ADMIN (nível 2)
 @bot.message_handler(commands=["addacesso"])
@@ -578,17 +874,143 @@ def cmd_addacesso(message):
     try:
         payload = message.text.replace("/addacesso", "").strip()
         if not payload or "|" not in payload:
-            bot.reply_to(message, "❌ Use: /addacesso PRODUTOID | LOGIN | PASSWORD | SENHA_ADMIN")
+            outbox.reply_to(message, "❌ Use: /addacesso PRODUTOID | LOGIN | PASSWORD | SENHA_ADMIN")
             return
         prodid_s, login, password, senha = [p.strip() for p in payload.split("|", 3)]
         product_id = int(prodid_s)
         if not _is_admin_level(message.from_user.id, senha, min_level=2):
-            bot.reply_to(message, "🚫 Apenas admins nível 2 podem adicionar acessos.")
+            outbox.reply_to(message, "🚫 Apenas admins nível 2 podem adicionar acessos.")
             return
         aid = add_product_access(product_id, login, password)
-        bot.reply_to(message, f"✅ Acesso adicionado (id: {aid}) ao produto {product_id}: {login}/{password}")
+        outbox.reply_to(message, f"✅ Acesso adicionado (id: {aid}) ao produto {product_id}: {login}/{password}",
+                       sensitive=True)
+    except Exception as e:
+        outbox.reply_to(message, f"❌ Erro ao adicionar acesso: {e}")
+
+# /importar PRODUTOID | SENHA_ADMIN (nível 2) — legenda de um documento .txt/.csv
+# Uma credencial por linha: LOGIN | SENHA (também aceita ; , tab ou :). Linhas vazias e # são ignoradas.
+# O separador é escolhido uma vez por arquivo (o primeiro, na ordem abaixo, presente em todas
+# as linhas iniciais) e só a primeira ocorrência divide a linha: a senha pode conter os outros.
+IMPORT_MAX_BYTES = int(os.environ.get("IMPORT_MAX_BYTES") or 20 * 1024 * 1024)  # limite de download da Bot API
+_IMPORT_DELIMITERS = ("|", ";", "\t", ",", ":")
+_IMPORT_SNIFF_LINES = 50
+_IMPORT_HEADER_LOGIN = {"login", "usuario", "usuário", "user", "email"}
+_IMPORT_HEADER_SENHA = {"senha", "password", "pass"}
+
+def _detect_import_delimiter(lines: list):
+    """Separador presente em todas as linhas da amostra; senão o que aparece em mais linhas."""
+    for delim in _IMPORT_DELIMITERS:
+        if lines and all(delim in line for line in lines):
+            return delim
+    best = max(_IMPORT_DELIMITERS, key=lambda d: sum(d in line for line in lines), default=None)
+    if best is None or not any(best in line for line in lines):
+        return None
+    return best
+
+def _iter_access_lines(data: bytes, counts: dict):
+    """Lê o arquivo linha a linha e gera (login, senha); linhas inválidas somam em counts["malformed"]."""
+    stream = TextIOWrapper(BytesIO(data), encoding="utf-8-sig", errors="replace", newline=None)
+    lines = (line.strip() for line in stream)
+    lines = (line for line in lines if line and not line.startswith("#"))
+    sample = list(islice(lines, _IMPORT_SNIFF_LINES))
+    delim = _detect_import_delimiter(sample)
+    first = True
+    for line in chain(sample, lines):
+        if delim is None or delim not in line:
+            counts["malformed"] += 1
+            continue
+        # csv tira as aspas de "login","senha"; campos além do segundo voltam para a senha
+        fields = next(csv.reader([line], delimiter=delim, skipinitialspace=True))
+        login = fields[0].strip()
+        senha = delim.join(fields[1:]).strip()
+        if first:
+            first = False
+            if login.lower() in _IMPORT_HEADER_LOGIN and senha.lower() in _IMPORT_HEADER_SENHA:
+                continue
+        if not login or not senha or len(login) > 256 or len(senha) > 256:
+            counts["malformed"] += 1
+            continue
+        yield login, senha
+
+@bot.message_handler(commands=["importar"])
+def cmd_importar_help(message):
+    outbox.reply_to(message, "📄 Envie um arquivo .txt ou .csv com a legenda: /importar PRODUTOID | SENHA_ADMIN\n"
+                             "Uma credencial por linha: LOGIN | SENHA")
+
+@bot.message_handler(content_types=["document"], func=lambda m: (m.caption or "").startswith("/importar"))
+def cmd_importar(message):
+    try:
+        payload = message.caption.replace("/importar", "", 1).strip()
+        if not payload or "|" not in payload:
+            outbox.reply_to(message, "❌ Use na legenda do arquivo: /importar PRODUTOID | SENHA_ADMIN")
+            return
+        prodid_s, senha = [p.strip() for p in payload.split("|", 1)]
+        product_id = int(prodid_s)
+        if not _is_admin_level(message.from_user.id, senha, min_level=2):
+            outbox.reply_to(message, "🚫 Apenas admins nível 2 podem importar acessos.")
+            return
+        product = get_product(product_id)
+        if not product:
+            outbox.reply_to(message, "❌ Produto não encontrado.")
+            return
+        doc = message.document
+        if doc.file_size and doc.file_size > IMPORT_MAX_BYTES:
+            outbox.reply_to(message, f"❌ Arquivo muito grande (máx. {IMPORT_MAX_BYTES // (1024 * 1024)} MB).")
+            return
+
+        file_info = bot.get_file(doc.file_id)
+        data = bot.download_file(file_info.file_path)
+        counts = {"malformed": 0}
+        result = bulk_add_product_access(product_id, _iter_access_lines(data, counts))
+        outbox.reply_to(message,
+            f"✅ Importação para <b>{product['name']}</b> (id {product_id}) concluída:\n"
+            f"➕ Inseridos: {result['inserted']}\n"
+            f"🔁 Duplicados: {result['duplicates']}\n"
+            f"⚠️ Linhas inválidas: {counts['malformed']}"
+        )
+    except Exception as e:
+        outbox.reply_to(message, f"❌ Erro ao importar acessos: {e}")
+
+# /recontarestoque SENHA_ADMIN (nível 2) — recalcula products.stock a partir de product_access
+@bot.message_handler(commands=["recontarestoque"])
+def cmd_recontarestoque(message):
+    try:
+        senha = message.text.replace("/recontarestoque", "").strip()
+        if not senha:
+            outbox.reply_to(message, "❌ Use: /recontarestoque SENHA_ADMIN")
+            return
+        if not _is_admin_level(message.from_user.id, senha, min_level=2):
+            outbox.reply_to(message, "🚫 Apenas admins nível 2 podem recontar o estoque.")
+            return
+        drift = recount_stock()
+        if not drift:
+            outbox.reply_to(message, "✅ Estoque conferido: todos os contadores estavam corretos.")
+            return
+        linhas = [f"• Produto {d['product_id']}: {d['stock']} → {d['real']}" for d in drift]
+        outbox.reply_to(message, "🔧 Estoque corrigido:\n" + "\n".join(linhas))
     except Exception as e:
-        bot.reply_to(message, f"❌ Erro ao adicionar acesso: {e}")
+        outbox.reply_to(message, f"❌ Erro ao recontar estoque: {e}")
+
+# /sqlstats SENHA_ADMIN (nível 2) — resumo do tracing de SQL (DB_TRACE=1)
+@bot.message_handler(commands=["sqlstats"])
+def cmd_sqlstats(message):
+    try:
+        senha = message.text.replace("/sqlstats", "").strip()
+        if not senha:
+            outbox.reply_to(message, "❌ Use: /sqlstats SENHA_ADMIN")
+            return
+        if not _is_admin_level(message.from_user.id, senha, min_level=2):
+            outbox.reply_to(message, "🚫 Apenas admins nível 2 podem ver o tracing de SQL.")
+            return
+        summary = db.sql_trace_summary(top=10)
+        if not summary["enabled"]:
+            outbox.reply_to(message, "ℹ️ Tracing de SQL desligado (inicie com DB_TRACE=1).")
+            return
+        linhas = [f"{r['count']}x {r['total_ms']} ms (máx {r['max_ms']}, lentas {r['slow']}): <code>{html.escape(r['sql'][:80])}</code>"
+                  for r in summary["statements"]]
+        outbox.reply_to(message, f"🐢 SQL por tempo total (lenta ≥ {summary['slow_ms']} ms):\n" + "\n".join(linhas or ["(nada ainda)"]))
+    except Exception as e:
+        outbox.reply_to(message, f"❌ Erro ao ler tracing: {e}")
 
 # /addsaldo TELEGRAMID | VALOR | SENHA_ADMIN (nível 2)
 @bot.message_handler(commands=["addsaldo"])
@@ -596,20 +1018,21 @@ def cmd_addsaldo(message):
     try:
         payload = message.text.replace("/addsaldo", "").strip()
         if not payload or "|" not in payload:
-            bot.reply_to(message, "❌ Use: /addsaldo TELEGRAMID | VALOR | SENHA_ADMIN")
+            outbox.reply_to(message, "❌ Use: /addsaldo TELEGRAMID | VALOR | SENHA_ADMIN")
             return
         tg_target_s, value_s, senha = [p.strip() for p in payload.split("|", 2)]
         target_tg = int(tg_target_s)
         amount = float(value_s.replace(",", "."))
         if not _is_admin_level(message.from_user.id, senha, min_level=2):
-            bot.reply_to(message, "🚫 Apenas admins nível 2 podem adicionar saldo.")
+            outbox.reply_to(message, "🚫 Apenas admins nível 2 podem adicionar saldo.")
             return
         # garantir que o usuário exista
         ensure_user(target_tg, None, None, None)
-        credit_balance(target_tg, amount)
-        bot.reply_to(message, f"✅ Saldo R$ {amount:.2f} creditado ao usuário {target_tg}.")
+        credit_balance(target_tg, amount, kind=LEDGER_ADMIN, note=f"/addsaldo por {message.from_user.id}")
+        _wallet("credit", "admin", amount)
+        outbox.reply_to(message, f"✅ Saldo R$ {amount:.2f} creditado ao usuário {target_tg}.")
     except Exception as e:
-        bot.reply_to(message, f"❌ Erro ao creditar saldo: {e}")
+        outbox.reply_to(message, f"❌ Erro ao creditar saldo: {e}")
 
 # /aprovarpix PAYMENTID | SENHA_ADMIN (nível 2) - manual fallback
 @bot.message_handler(commands=["aprovarpix"])
@@ -617,118 +1040,319 @@ def cmd_aprovarpix(message):
     try:
         payload = message.text.replace("/aprovarpix", "").strip()
         if not payload or "|" not in payload:
-            bot.reply_to(message, "❌ Use: /aprovarpix PAYMENTID | SENHA_ADMIN")
+            outbox.reply_to(message, "❌ Use: /aprovarpix PAYMENTID | SENHA_ADMIN")
             return
         payment_id, senha = [p.strip() for p in payload.split("|", 1)]
         if not _is_admin_level(message.from_user.id, senha, min_level=2):
-            bot.reply_to(message, "🚫 Apenas admins nível 2 podem aprovar pagamentos manualmente.")
+            outbox.reply_to(message, "🚫 Apenas admins nível 2 podem aprovar pagamentos manualmente.")
             return
 
         info = mp_get_payment(payment_id)
         status = info.get("status")
         if status not in ("approved", "accredited", "paid"):
-            bot.reply_to(message, f"⚠️ Pagamento {payment_id} ainda não aprovado (status: {status}).")
-            return
-
-        changed = approve_transaction_by_mp_id(payment_id)
-        if changed:
-            tx = get_transaction_by_mp_id(payment_id)
-            if tx:
-                amount = float(tx["amount"])
-                user_db_id = tx["user_id"]
-                # buscar telegram_id real
-                conn = sqlite3.connect(DB_PATH)
-                cur = conn.cursor()
-                cur.execute("SELECT telegram_id FROM users WHERE id = ?", (user_db_id,))
-                row = cur.fetchone()
-                conn.close()
-                if row:
-                    telegram_id = int(row[0])
-                    credit_balance(telegram_id, amount)
-                    bot.reply_to(message, f"✅ Pagamento {payment_id} aprovado manualmente. R$ {amount:.2f} creditado ao {telegram_id}.")
-                    return
-        bot.reply_to(message, f"⚠️ Transação {payment_id} não encontrada ou já aprovada.")
+            outbox.reply_to(message, f"⚠️ Pagamento {payment_id} ainda não aprovado (status: {status}).")
+            return
+
+        # mesma chave de evento do webhook: quem chegar primeiro aprova e credita
+        settled = settle_approved_payment(payment_id, processed_by=f"aprovarpix:{message.from_user.id}")
+        if not settled:
+            outbox.reply_to(message, f"⚠️ Transação {payment_id} não encontrada ou já aprovada/creditada.")
+            return
+        amount = settled["amount"]
+        _wallet("credit", "pix_manual", amount)
+        outbox.reply_to(message, f"✅ Pagamento {payment_id} aprovado manualmente. R$ {amount:.2f} creditado ao {settled['telegram_id']}.")
     except Exception as e:
-        bot.reply_to(message, f"❌ Erro em aprovarpix: {e}")
+        outbox.reply_to(message, f"❌ Erro em aprovarpix: {e}")
 
-# /report PERIOD | SENHA_ADMIN (period: total/daily/weekly/monthly) - nível 2
+# /report PERIOD | SENHA_ADMIN (period: total/daily/weekly/monthly ou AAAA-MM-DD..AAAA-MM-DD) - nível 2
 @bot.message_handler(commands=["report"])
 def cmd_report(message):
     try:
         payload = message.text.replace("/report", "").strip()
         if not payload or "|" not in payload:
-            bot.reply_to(message, "❌ Use: /report PERIOD | SENHA_ADMIN (period: total/daily/weekly/monthly)")
+            outbox.reply_to(message, "❌ Use: /report PERIOD | SENHA_ADMIN (period: total/daily/weekly/monthly ou AAAA-MM-DD..AAAA-MM-DD)")
             return
         period, senha = [p.strip() for p in payload.split("|", 1)]
         if not _is_admin_level(message.from_user.id, senha, min_level=2):
-            bot.reply_to(message, "🚫 Apenas admins nível 2 podem acessar relatórios.")
+            outbox.reply_to(message, "🚫 Apenas admins nível 2 podem acessar relatórios.")
             return
         period = period.lower()
-        if period not in ("total", "daily", "weekly", "monthly"):
-            bot.reply_to(message, "❌ Período inválido. Use total/daily/weekly/monthly.")
+        if ".." in period:
+            try:
+                start_s, end_s = [p.strip() for p in period.split("..", 1)]
+                start = date.fromisoformat(start_s) if start_s else None
+                end = date.fromisoformat(end_s) if end_s else None
+            except ValueError:
+                outbox.reply_to(message, "❌ Intervalo inválido. Use AAAA-MM-DD..AAAA-MM-DD.")
+                return
+            report = get_sales_report_range(start, end)
+            top = get_product_sales_report(start, end, limit=5)
+        elif period in ("total", "daily", "weekly", "monthly"):
+            report = get_sales_report(period)
+            top = None
+        else:
+            outbox.reply_to(message, "❌ Período inválido. Use total/daily/weekly/monthly ou AAAA-MM-DD..AAAA-MM-DD.")
+            return
+        texto = (
+            f"📊 Relatório ({period}):\nVendas: {report['count']}\nTotal: R$ {float(report['total']):.2f}\n"
+            f"🛒 Produtos vendidos: {report['sales_count']} (R$ {float(report['sales_total']):.2f})"
+        )
+        if top:
+            texto += "\n\n🏆 Mais vendidos:\n"
+            for r in top:
+                texto += f"• {r.get('name') or r['product_id']}: {r['sales_count']} (R$ {float(r['sales_total']):.2f})\n"
+        outbox.reply_to(message, texto)
+    except Exception as e:
+        outbox.reply_to(message, f"❌ Erro ao gerar relatório: {e}")
+
+# -------------------------
+# Broadcast (nível 2)
+# -------------------------
+def _broadcast_summary(job) -> str:
+    return (
+        f"📣 Broadcast #{job['id']} ({job['status']})\n"
+        f"✅ Entregues: {job['delivered']}\n"
+        f"🚫 Bloqueados: {job['blocked']}\n"
+        f"❌ Falhas: {job['failed']}"
+    )
+
+def _on_broadcast_finish(job):
+    if job.get("created_by"):
+        outbox.send_message(job["created_by"], _broadcast_summary(job))
+
+broadcaster = BroadcastEngine(
+    outbox,
+    rate=float(os.environ.get("BROADCAST_RATE") or 20),
+    chunk_size=int(os.environ.get("BROADCAST_CHUNK") or 200),
+    on_finish=_on_broadcast_finish,
+)
+
+# /broadcast TEXTO | SENHA_ADMIN
+@bot.message_handler(commands=["broadcast"])
+def cmd_broadcast(message):
+    try:
+        parts = message.text.split(maxsplit=1)
+        payload = parts[1].strip() if len(parts) > 1 else ""
+        if not payload or "|" not in payload:
+            outbox.reply_to(message, "❌ Use: /broadcast TEXTO | SENHA_ADMIN")
+            return
+        texto, senha = [p.strip() for p in payload.rsplit("|", 1)]
+        if not _is_admin_level(message.from_user.id, senha, min_level=2):
+            outbox.reply_to(message, "🚫 Apenas admins nível 2 podem enviar broadcast.")
+            return
+        if not texto:
+            outbox.reply_to(message, "❌ Texto do broadcast vazio.")
+            return
+        job_id = create_broadcast_job(texto, message.chat.id)
+        broadcaster.start(job_id)
+        outbox.reply_to(message, f"📣 Broadcast #{job_id} iniciado. Acompanhe com /broadcaststatus {job_id} | SENHA_ADMIN")
+    except Exception as e:
+        outbox.reply_to(message, f"❌ Erro ao iniciar broadcast: {e}")
+
+# /broadcaststatus ID | SENHA_ADMIN
+@bot.message_handler(commands=["broadcaststatus"])
+def cmd_broadcaststatus(message):
+    try:
+        payload = message.text.replace("/broadcaststatus", "").strip()
+        if not payload or "|" not in payload:
+            outbox.reply_to(message, "❌ Use: /broadcaststatus ID | SENHA_ADMIN")
+            return
+        job_s, senha = [p.strip() for p in payload.split("|", 1)]
+        if not _is_admin_level(message.from_user.id, senha, min_level=2):
+            outbox.reply_to(message, "🚫 Apenas admins nível 2 podem ver broadcasts.")
+            return
+        job = get_broadcast_job(int(job_s))
+        if not job:
+            outbox.reply_to(message, "❌ Broadcast não encontrado.")
+            return
+        outbox.reply_to(message, _broadcast_summary(job))
+    except Exception as e:
+        outbox.reply_to(message, f"❌ Erro ao consultar broadcast: {e}")
+
+# /broadcastcancel ID | SENHA_ADMIN
+@bot.message_handler(commands=["broadcastcancel"])
+def cmd_broadcastcancel(message):
+    try:
+        payload = message.text.replace("/broadcastcancel", "").strip()
+        if not payload or "|" not in payload:
+            outbox.reply_to(message, "❌ Use: /broadcastcancel ID | SENHA_ADMIN")
             return
-        report = get_sales_report(period)
-        bot.reply_to(message, f"📊 Relatório ({period}):\nVendas: {report['count']}\nTotal: R$ {float(report['total']):.2f}")
+        job_s, senha = [p.strip() for p in payload.split("|", 1)]
+        if not _is_admin_level(message.from_user.id, senha, min_level=2):
+            outbox.reply_to(message, "🚫 Apenas admins nível 2 podem cancelar broadcasts.")
+            return
+        broadcaster.cancel(int(job_s))
+        outbox.reply_to(message, f"🛑 Broadcast #{int(job_s)} cancelado.")
     except Exception as e:
-        bot.reply_to(message, f"❌ Erro ao gerar relatório: {e}")
+        outbox.reply_to(message, f"❌ Erro ao cancelar broadcast: {e}")
 
 # -------------------------
 # Webhook Mercado Pago - /mp/webhook
 # -------------------------
+def process_payment_notification(payment_id: str):
+    """
+    Consulta o pagamento no MP e, se aprovado, aprova a transação, credita e avisa o usuário.
+    Idempotente: settle_approved_payment aprova e credita numa transação só, e só na primeira
+    vez (processed_events), mesmo com a notificação chegando em vários processos/workers.
+    Exceções (ex.: erro no MP) fazem a fila tentar novamente com backoff.
+    """
+    info = mp_get_payment(str(payment_id))
+    status = info.get("status")
+    M_PAYMENTS.inc(status=status or "unknown")
+
+    if status in ("approved", "accredited", "paid"):
+        settled = settle_approved_payment(str(payment_id))
+        if settled:
+            amount = settled["amount"]
+            _wallet("credit", "pix", amount)
+            # notificar usuário (falhas definitivas vão para o dead-letter do outbox)
+            outbox.send_message(
+                settled["telegram_id"],
+                f"✅ <b>PIX Aprovado!</b>\n\n💸 Valor: R$ {amount:.2f}\n🔐 Saldo adicionado na sua conta!",
+                parse_mode="HTML"
+            )
+    elif status in ("cancelled", "rejected"):
+        # pagamento encerrado no MP: sai da lista de pendentes do reconciliador
+        mark_pending_transaction(str(payment_id), status)
+    reconciler.record_status(str(payment_id), status)
+    return status
+
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS") or 4)
+payment_queue = PaymentQueue(process_payment_notification, workers=WEBHOOK_WORKERS)
+
+# Reconciliação de PIX pendentes (webhook perdido / fora do ar). RECONCILE_INTERVAL=0 desliga.
+RECONCILE_INTERVAL = float(os.environ.get("RECONCILE_INTERVAL") or 60)
+PIX_PAYMENT_WINDOW = int(os.environ.get("PIX_PAYMENT_WINDOW") or 24 * 3600)
+reconciler = PendingReconciler(
+    payment_queue,
+    interval=RECONCILE_INTERVAL,
+    window=PIX_PAYMENT_WINDOW,
+    min_age=int(os.environ.get("RECONCILE_MIN_AGE") or 60),
+    max_inflight=int(os.environ.get("RECONCILE_MAX_INFLIGHT") or 20),
+)
+
 @app.route("/mp/webhook", methods=["POST", "GET"])
 def mp_webhook():
     try:
+        body = (request.get_json(silent=True) or {}) if request.is_json else {}
+        # notificações de outros tópicos (merchant_order etc.) não interessam
+        topic = request.args.get("topic") or request.args.get("type") or body.get("type") or body.get("topic")
+        if topic and topic != "payment":
+            M_WEBHOOK.inc(outcome="ignored")
+            return jsonify({"ok": True, "ignored": topic}), 200
+
         payment_id = request.args.get("id") or request.args.get("data.id")
-        body = None
-        if not payment_id and request.is_json:
-            body = request.get_json(silent=True) or {}
+        if not payment_id:
             payment_id = (body.get("data") or {}).get("id") or body.get("id")
 
-        if not payment_id:
+        if not payment_id or not str(payment_id).isdigit():
+            M_WEBHOOK.inc(outcome="invalid")
             return jsonify({"ok": False, "error": "missing payment_id"}), 400
 
-        info = mp_get_payment(str(payment_id))
-        status = info.get("status")
-
-        if status in ("approved", "accredited", "paid"):
-            changed = approve_transaction_by_mp_id(str(payment_id))
-            if changed:
-                tx = get_transaction_by_mp_id(str(payment_id))
-                if tx:
-                    amount = float(tx["amount"])
-                    user_db_id = tx["user_id"]
-                    # buscar telegram_id
-                    conn = sqlite3.connect(DB_PATH)
-                    cur = conn.cursor()
-                    cur.execute("SELECT telegram_id FROM users WHERE id = ?", (user_db_id,))
-                    row = cur.fetchone()
-                    conn.close()
-                    if row:
-                        telegram_id = int(row[0])
-                        credit_balance(telegram_id, amount)
-                        # notificar usuário
-                        try:
-                            bot.send_message(
-                                telegram_id,
-                                f"✅ <b>PIX Aprovado!</b>\n\n💸 Valor: R$ {amount:.2f}\n🔐 Saldo adicionado na sua conta!",
-                                parse_mode="HTML"
-                            )
-                        except Exception:
-                            pass
-
-        return jsonify({"ok": True, "status": status}), 200
+        # responde na hora; o processamento (MP + crédito + aviso) roda na fila
+        queued = payment_queue.submit(str(payment_id))
+        M_WEBHOOK.inc(outcome="queued" if queued else "coalesced")
+        return jsonify({"ok": True, "queued": queued}), 200
     except Exception as e:
+        M_WEBHOOK.inc(outcome="error")
         print("ERRO NO WEBHOOK:", e)
         return jsonify({"ok": False, "error": str(e)}), 500
 
 # -------------------------
-# Run: Flask thread + Telebot polling
+# Webhook Telegram - /tg/webhook (opcional, TELEGRAM_MODE=webhook)
+# -------------------------
+@app.route("/tg/webhook", methods=["POST"])
+def tg_webhook():
+    if TELEGRAM_MODE != "webhook":
+        return jsonify({"ok": False, "error": "webhook mode disabled"}), 404
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token") or ""
+    if not TELEGRAM_WEBHOOK_SECRET or not hmac.compare_digest(token, TELEGRAM_WEBHOOK_SECRET):
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+
+    payload = request.get_json(silent=True)
+    if payload is None:
+        return jsonify({"ok": False, "error": "invalid json"}), 400
+    # o Telegram manda um update por requisição; aceitamos também listas (repasse em lote)
+    raw_updates = payload if isinstance(payload, list) else [payload]
+    updates = []
+    for raw in raw_updates:
+        try:
+            updates.append(telebot.types.Update.de_json(raw))
+        except Exception as e:
+            print("Update inválido ignorado:", e)
+    if updates:
+        # com o dispatcher instalado isto só enfileira; os handlers rodam nos workers
+        bot.process_new_updates(updates)
+    return jsonify({"ok": True, "received": len(updates)}), 200
+
+def setup_telegram_webhook():
+    if not TELEGRAM_WEBHOOK_URL or not TELEGRAM_WEBHOOK_SECRET:
+        raise RuntimeError("TELEGRAM_MODE=webhook exige TELEGRAM_WEBHOOK_URL e TELEGRAM_WEBHOOK_SECRET")
+    bot.remove_webhook()
+    bot.set_webhook(
+        url=f"{TELEGRAM_WEBHOOK_URL.rstrip('/')}/tg/webhook",
+        secret_token=TELEGRAM_WEBHOOK_SECRET,
+        max_connections=int(os.environ.get("TELEGRAM_WEBHOOK_MAX_CONNECTIONS") or 40),
+        allowed_updates=["message", "callback_query"],
+    )
+
+# -------------------------
+# GET /metrics
+# -------------------------
+metrics.Gauge("dispatcher_queue_depth", "Updates aguardando/rodando no dispatcher", lambda: dispatcher.stats()["queue_depth"])
+metrics.Gauge("dispatcher_busy_workers", "Workers do dispatcher ocupados", lambda: dispatcher.stats()["busy_workers"])
+metrics.Gauge("outbox_queue_depth", "Envios pendentes no outbox", outbox.depth, labelname="state")
+metrics.Gauge("payment_queue_depth", "Notificações de pagamento na fila", lambda: payment_queue.depth())
+metrics.Gauge("payment_queue_inflight", "Pagamentos em processamento (singleflight)", lambda: payment_queue.inflight())
+metrics.Gauge("reconciler_tracked_payments", "PIX pendentes acompanhados pelo reconciliador", lambda: reconciler.tracked())
+metrics.Gauge("broadcasts_running", "Broadcasts em execução neste processo", broadcaster.running_count)
+# lock_stats / user_cache_stats só leem contadores em memória e ficam fora do db_call_seconds
+metrics.CounterFunc("db_lock_waits_total", "Transações que esperaram pelo lock de escrita",
+                    lambda: db.lock_stats()["lock_waits"])
+metrics.CounterFunc("user_cache_lookups_total", "Consultas ao cache LRU de usuários por resultado",
+                    lambda: {k: v for k, v in db.user_cache_stats().items() if k != "size"}, labelname="result")
+metrics.Gauge("user_cache_size", "Usuários no cache LRU", lambda: db.user_cache_stats()["size"])
+
+# depois de todos os @bot.*_handler: envolve cada handler com contagem e latência
+metrics.instrument_handlers(bot, M_UPDATES, M_HANDLER_SECONDS, M_HANDLER_ERRORS)
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        return Response("unauthorized\n", status=401, mimetype="text/plain")
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+# -------------------------
+# Run: Flask + Telebot (polling ou webhook)
 # -------------------------
 def run_flask():
-    app.run(host="0.0.0.0", port=8000)
+    # servidor de desenvolvimento do Flask; em produção use wsgi.py (gunicorn)
+    app.run(host="0.0.0.0", port=FLASK_PORT, threaded=True)
+
+def init_process():
+    """Preparação comum ao processo do bot e a cada worker WSGI (wsgi.py)."""
+    migrate()
+    load_acl_cache()
+    install_dispatcher(bot, dispatcher)
 
 if __name__ == "__main__":
     print(f"🤖 Iniciando {STORE_NAME}...")
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-    bot.infinity_polling(timeout=60, long_polling_timeout=60)
+    init_process()
+    broadcaster.resume_pending()
+    if RECONCILE_INTERVAL > 0:
+        reconciler.start()
+    if TELEGRAM_MODE == "webhook":
+        # sem thread de polling: o próprio Flask recebe os updates
+        setup_telegram_webhook()
+        print(f"📡 Modo webhook: {TELEGRAM_WEBHOOK_URL}/tg/webhook")
+        if EMBEDDED_FLASK:
+            run_flask()
+        else:
+            # updates e notificações chegam nos workers WSGI; aqui ficam reconciliador e broadcasts
+            threading.Event().wait()
+    else:
+        bot.remove_webhook()
+        if EMBEDDED_FLASK:
+            flask_thread = threading.Thread(target=run_flask, daemon=True)
+            flask_thread.start()
+        bot.infinity_polling(timeout=60, long_polling_timeout=60)
@@ -0,0 +1,121 @@
+# broadcast.py
+# Envio de mensagens para todos os clientes (/broadcast)
+# - Percorre users em lotes por keyset (id > cursor), sem carregar tudo na memória
+# - Envia pelo outbox com PRIORITY_LOW e taxa própria; cede a vez ao tráfego interativo
+# - Checkpoint por lote em broadcast_jobs: após reinício, resume_pending() continua do cursor
+#   (no pior caso o último lote não confirmado é reenviado)
+# - Conta entregues / bloqueados (403) / falhas
+
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import db
+from outbox import PRIORITY_LOW
+
+class BroadcastEngine:
+    def __init__(self, outbox, rate: float = 20.0, chunk_size: int = 200,
+                 on_finish: Optional[Callable[[Dict], None]] = None, chunk_timeout: float = 600.0):
+        self.outbox = outbox
+        self.interval = 1.0 / rate
+        self.chunk_size = chunk_size
+        self.on_finish = on_finish
+        self.chunk_timeout = chunk_timeout
+        self._lock = threading.Lock()
+        self._running = {}
+
+    def start(self, job_id: int) -> None:
+        with self._lock:
+            if job_id in self._running:
+                return
+            t = threading.Thread(target=self._run, args=(job_id,), name=f"broadcast-{job_id}", daemon=True)
+            self._running[job_id] = t
+        t.start()
+
+    def resume_pending(self) -> int:
+        jobs = db.list_running_broadcasts()
+        for job in jobs:
+            self.start(job["id"])
+        return len(jobs)
+
+    def running_count(self) -> int:
+        """Broadcasts rodando neste processo (gauge do /metrics)."""
+        with self._lock:
+            return len(self._running)
+
+    def cancel(self, job_id: int) -> None:
+        # o runner percebe no início do próximo lote
+        db.finish_broadcast(job_id, "cancelled")
+
+    def _wait_turn(self, next_at: float) -> float:
+        # tráfego interativo na fila do outbox tem precedência
+        while not self.outbox.pending_low_priority_ok():
+            time.sleep(0.05)
+        now = time.monotonic()
+        if next_at > now:
+            time.sleep(next_at - now)
+            now = next_at
+        return now + self.interval
+
+    def _send_chunk(self, text: str, users) -> Dict:
+        counts = {"delivered": 0, "blocked": 0, "failed": 0}
+        lock = threading.Lock()
+        remaining = {"n": len(users)}
+        done = threading.Event()
+
+        def on_done(ok, error):
+            with lock:
+                if ok:
+                    counts["delivered"] += 1
+                elif getattr(error, "error_code", None) == 403:
+                    counts["blocked"] += 1
+                else:
+                    counts["failed"] += 1
+                remaining["n"] -= 1
+                if remaining["n"] == 0:
+                    done.set()
+
+        next_at = time.monotonic()
+        for u in users:
+            if db.is_banned_db(u["telegram_id"]):
+                with lock:
+                    remaining["n"] -= 1
+                continue
+            next_at = self._wait_turn(next_at)
+            self.outbox.send_message(u["telegram_id"], text, priority=PRIORITY_LOW, on_done=on_done)
+
+        with lock:
+            if remaining["n"] == 0:
+                done.set()
+        if not done.wait(self.chunk_timeout):
+            with lock:
+                counts["failed"] += remaining["n"]
+                remaining["n"] = 0
+        with lock:
+            return dict(counts)
+
+    def _run(self, job_id: int) -> None:
+        try:
+            while True:
+                job = db.get_broadcast_job(job_id)
+                if not job or job["status"] != "running":
+                    break
+                users = db.iter_users_after(job["last_user_id"], self.chunk_size)
+                if not users:
+                    db.finish_broadcast(job_id, "done")
+                    break
+                counts = self._send_chunk(job["text"], users)
+                db.checkpoint_broadcast(job_id, users[-1]["id"], **counts)
+        except Exception as e:
+            print(f"[broadcast-{job_id}] erro, será retomado no próximo start: {e}")
+            return
+        finally:
+            with self._lock:
+                self._running.pop(job_id, None)
+
+        job = db.get_broadcast_job(job_id)
+        if job and self.on_finish:
+            try:
+                self.on_finish(job)
+            except Exception as e:
+                print(f"[broadcast-{job_id}] erro ao notificar término: {e}")
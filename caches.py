@@ -0,0 +1,168 @@
+# caches.py
+# Caches de processo da camada de dados, comuns aos dois backends (db.py e db_postgres.py)
+# - UserCache: LRU telegram_id -> (user.id, username, first_name, last_name)
+# - CatalogCache: produtos por id + ativos, recarregados após `ttl` segundos ou invalidação
+# - AclCache: admins e banidos, write-through; escritas de outros processos são detectadas
+#   pelo contador cache_versions('acl'), conferido no máximo a cada `refresh_interval` segundos
+# Aqui não há SQL: cada backend passa as funções que leem o banco.
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class UserCache:
+    """Uma entrada só existe depois que users + wallet foram garantidos no banco."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0}
+
+    def lookup(self, telegram_id: int, username: Optional[str], first_name: Optional[str],
+               last_name: Optional[str]) -> Optional[int]:
+        """user.id se o usuário está em cache e nenhum campo informado mudou; senão None."""
+        with self._lock:
+            cached = self._entries.get(telegram_id)
+            if cached is not None:
+                _, c_username, c_first, c_last = cached
+                unchanged = all(
+                    new is None or new == old
+                    for new, old in ((username, c_username), (first_name, c_first), (last_name, c_last))
+                )
+                if unchanged:
+                    self._entries.move_to_end(telegram_id)
+                    self._stats["hits"] += 1
+                    return cached[0]
+            self._stats["misses"] += 1
+            return None
+
+    def store(self, telegram_id: int, user_id: int, username: Optional[str], first_name: Optional[str],
+              last_name: Optional[str]) -> None:
+        with self._lock:
+            self._entries[telegram_id] = (user_id, username, first_name, last_name)
+            self._entries.move_to_end(telegram_id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"hits": self._stats["hits"], "misses": self._stats["misses"], "size": len(self._entries)}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class CatalogCache:
+    """`load()` retorna todos os produtos (dicts com id, stock e active) em ordem de id."""
+
+    def __init__(self, load: Callable[[], List[Dict]], ttl: float):
+        self._load = load
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._by_id = None
+        self._active = None
+        self._loaded_at = 0.0
+        self._version = 0
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._by_id = None
+            self._active = None
+
+    def stock_delta(self, product_id: int, delta: int) -> None:
+        """Aplica no cache uma mudança de estoque já gravada por este processo (sem recarregar)."""
+        with self._lock:
+            p = (self._by_id or {}).get(product_id)
+            if p is None:
+                return
+            p["stock"] = max(0, int(p["stock"] or 0) + delta)
+            self._version += 1
+
+    def snapshot(self) -> Tuple[int, Dict[int, Dict], List[Dict]]:
+        """(versão, produtos por id, ativos); a versão muda a cada recarga ou mudança de estoque."""
+        with self._lock:
+            if self._by_id is None or time.monotonic() - self._loaded_at > self.ttl:
+                by_id = {p["id"]: p for p in self._load()}
+                self._by_id = by_id
+                self._active = [p for p in by_id.values() if p["active"] == 1]
+                self._loaded_at = time.monotonic()
+                self._version += 1
+            return self._version, self._by_id, self._active
+
+
+class AclCache:
+    """
+    `load()` retorna (versão, banidos, admins) lidos num mesmo snapshot;
+    `db_version()` só o contador cache_versions('acl').
+    Depois de cada escrita (que incrementa o contador) o backend chama applied().
+    """
+
+    def __init__(self, load: Callable[[], Tuple[int, set, Dict[int, Dict]]], db_version: Callable[[], int],
+                 refresh_interval: float):
+        self._load = load
+        self._db_version = db_version
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._state = {"banned": None, "admins": None, "version": None, "checked_at": 0.0}
+
+    def _reload(self) -> None:
+        version, banned, admins = self._load()
+        self._state.update(banned=banned, admins=admins, version=version, checked_at=time.monotonic())
+
+    def _current(self) -> Dict:
+        """Estado carregado/atualizado se preciso. Chamar com self._lock."""
+        if self._state["banned"] is None:
+            self._reload()
+        elif time.monotonic() - self._state["checked_at"] > self.refresh_interval:
+            self._state["checked_at"] = time.monotonic()
+            if self._db_version() != self._state["version"]:
+                self._reload()
+        return self._state
+
+    def reload(self) -> None:
+        with self._lock:
+            self._reload()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._state.update(banned=None, admins=None, version=None, checked_at=0.0)
+
+    def applied(self, version: int, apply: Callable[[Dict], None]) -> None:
+        """Escrita deste processo já gravada, com o contador agora em `version`."""
+        with self._lock:
+            if self._state["banned"] is None:
+                return
+            if self._state["version"] == version - 1:
+                apply(self._state)
+                self._state["version"] = version
+            else:
+                # outro processo escreveu no meio tempo: recarrega na próxima leitura
+                self._state["banned"] = None
+
+    def is_admin_level(self, telegram_id: int, senha: Optional[str] = None, min_level: int = 1) -> bool:
+        with self._lock:
+            row = self._current()["admins"].get(int(telegram_id))
+        if not row:
+            return False
+        if senha is not None and row["senha"] != senha:
+            return False
+        try:
+            return int(row["nivel"]) >= int(min_level)
+        except Exception:
+            return False
+
+    def list_admins(self) -> List[Dict]:
+        with self._lock:
+            admins = self._current()["admins"]
+            return [
+                {"telegram_id": tg, "nome": a["nome"], "nivel": a["nivel"]}
+                for tg, a in sorted(admins.items())
+            ]
+
+    def is_banned(self, telegram_id: int) -> bool:
+        with self._lock:
+            return int(telegram_id) in self._current()["banned"]
@@ -3,29 +3,299 @@
 # - Preserva tabelas antigas
 # - Cria novas tabelas necessárias
 # - Expõe funções usadas por bot.py (ensure_user, get_balance, add_transaction, etc.)
+# - DB_BACKEND=postgres troca a implementação pela de db_postgres.py (ver BACKEND no fim)
 
+import atexit
+import os
+import re
+import socket
 import sqlite3
 import json
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal, ROUND_HALF_UP
+from functools import wraps
+from itertools import islice
 from typing import Optional, List, Dict
 
-DB_PATH = "store.db"  # ajuste se usar outro arquivo
+from caches import AclCache, CatalogCache, UserCache
 
-def _conn():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+DB_PATH = os.environ.get("DB_PATH") or "store.db"  # ajuste se usar outro arquivo
+
+# Ajustes de performance do SQLite (podem ser sobrescritos por variáveis de ambiente)
+BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS") or 5000)
+CACHE_SIZE_KB = int(os.environ.get("DB_CACHE_SIZE_KB") or 65536)       # 64 MB por conexão
+MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE") or 268435456)           # 256 MB
+
+# status do MP (e legados) tratados como pagamento aprovado
+APPROVED_STATUSES = ("approved", "aprovado", "accredited", "paid")
+
+# processed_events: chave "payment.approved:<mp_id>" = recarga aprovada e creditada
+EVENT_PAYMENT_APPROVED = "payment.approved"
 
 # -------------------------
-# MIGRAÇÃO / CRIAÇÃO DE TABELAS
+# CONEXÕES (uma conexão persistente por thread)
 # -------------------------
-def migrate():
+_local = threading.local()
+
+# -------------------------
+# TRACING DE SQL / SLOW QUERY LOG (opcional: DB_TRACE=1 ou enable_sql_trace())
+# -------------------------
+# - Conexões abertas com o tracing ligado usam _TracingConnection: cada execute/executemany
+#   é cronometrado e somado por texto do comando (com os "?", sem os valores)
+# - set_trace_callback guarda o último comando já expandido (com valores) para o slow log
+# - Comandos acima de DB_SLOW_MS vão para DB_SLOW_LOG (JSONL) com o EXPLAIN QUERY PLAN;
+#   os valores só são gravados com DB_SLOW_LOG_PARAMS=1 (podem conter logins/senhas)
+# - As funções públicas também são somadas (via add_call_observer)
+# - dump_sql_trace() imprime o resumo; com o tracing ligado roda também ao encerrar o processo
+SQL_TRACE = (os.environ.get("DB_TRACE") or "0").lower() in ("1", "true", "yes")
+SLOW_QUERY_MS = float(os.environ.get("DB_SLOW_MS") or 50)
+SLOW_QUERY_LOG = os.environ.get("DB_SLOW_LOG") or "slow_queries.jsonl"
+SLOW_QUERY_LOG_PARAMS = (os.environ.get("DB_SLOW_LOG_PARAMS") or "0").lower() in ("1", "true", "yes")
+
+_trace_lock = threading.Lock()
+_trace = {"enabled": False, "atexit": False}
+_sql_stats: Dict[str, list] = {}   # sql -> [execuções, tempo total, maior tempo, lentas]
+_fn_stats: Dict[str, list] = {}    # função -> [chamadas, tempo total, maior tempo, erros]
+
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+def _record_sql(conn, sql: str, params, elapsed: float) -> None:
+    # IN (?,?,...) de tamanhos diferentes contam como o mesmo comando
+    key = _IN_LIST.sub("(?, ...)", " ".join(sql.split()))
+    slow = elapsed * 1000 >= SLOW_QUERY_MS
+    with _trace_lock:
+        st = _sql_stats.get(key)
+        if st is None:
+            st = _sql_stats[key] = [0, 0.0, 0.0, 0]
+        st[0] += 1
+        st[1] += elapsed
+        st[2] = max(st[2], elapsed)
+        if slow:
+            st[3] += 1
+    if slow and not key.upper().startswith(("BEGIN", "COMMIT", "ROLLBACK", "EXPLAIN")):
+        _log_slow(conn, key, sql, params, elapsed)
+
+def _log_slow(conn, key: str, sql: str, params, elapsed: float) -> None:
+    try:
+        plan = [r[3] for r in conn.cursor(sqlite3.Cursor).execute(f"EXPLAIN QUERY PLAN {sql}", params or ())]
+    except Exception as e:
+        plan = [f"(sem plano: {e})"]
+    record = {"ts": time.strftime("%Y-%m-%d %H:%M:%S"), "ms": round(elapsed * 1000, 2), "sql": key, "plan": plan}
+    if SLOW_QUERY_LOG_PARAMS:
+        record["expanded"] = getattr(_local, "last_stmt", None)
+    print(f"[db] consulta lenta ({record['ms']} ms): {key[:200]} | plano: {'; '.join(plan)}")
+    if SLOW_QUERY_LOG:
+        try:
+            with open(SLOW_QUERY_LOG, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        except Exception as e:
+            print("Erro ao gravar slow query log:", e)
+
+def _trace_stmt(text: str) -> None:
+    _local.last_stmt = text
+
+def _trace_call(name: str, elapsed: float, error) -> None:
+    with _trace_lock:
+        st = _fn_stats.get(name)
+        if st is None:
+            st = _fn_stats[name] = [0, 0.0, 0.0, 0]
+        st[0] += 1
+        st[1] += elapsed
+        st[2] = max(st[2], elapsed)
+        if error is not None:
+            st[3] += 1
+
+class _TracingCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record_sql(self.connection, sql, parameters, time.perf_counter() - t0)
+
+    def executemany(self, sql, seq_of_parameters):
+        rows = seq_of_parameters if isinstance(seq_of_parameters, (list, tuple)) else list(seq_of_parameters)
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(sql, rows)
+        finally:
+            _record_sql(self.connection, sql, rows[0] if rows else (), time.perf_counter() - t0)
+
+class _TracingConnection(sqlite3.Connection):
+    def cursor(self, factory=None):
+        return super().cursor(factory or _TracingCursor)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def enable_sql_trace(slow_ms: Optional[float] = None) -> None:
     """
-    Cria tabelas que faltam sem apagar as existentes.
-    Execute no start do bot (ou chame manualmente).
+    Liga o tracing. Vale para conexões abertas daqui em diante (a da thread atual é reaberta);
+    para pegar todas as threads, use DB_TRACE=1 no ambiente.
+    """
+    global SLOW_QUERY_MS
+    if slow_ms is not None:
+        SLOW_QUERY_MS = float(slow_ms)
+    with _trace_lock:
+        _trace["enabled"] = True
+        register_exit = not _trace["atexit"]
+        _trace["atexit"] = True
+    add_call_observer(_trace_call)
+    if register_exit:
+        atexit.register(dump_sql_trace)
+    close_conn()
+
+def reset_sql_trace() -> None:
+    with _trace_lock:
+        _sql_stats.clear()
+        _fn_stats.clear()
+
+def sql_trace_summary(top: int = 20) -> Dict:
+    """Top comandos e funções por tempo total: listas de dicts com count, total_ms, avg_ms, max_ms."""
+    def rows(stats, key, extra):
+        out = []
+        for name, (n, total, peak, other) in sorted(stats.items(), key=lambda kv: kv[1][1], reverse=True)[:top]:
+            out.append({key: name, "count": n, "total_ms": round(total * 1000, 2),
+                        "avg_ms": round(total * 1000 / n, 3) if n else 0.0, "max_ms": round(peak * 1000, 2), extra: other})
+        return out
+    with _trace_lock:
+        return {
+            "enabled": _trace["enabled"],
+            "slow_ms": SLOW_QUERY_MS,
+            "statements": rows(dict(_sql_stats), "sql", "slow"),
+            "functions": rows(dict(_fn_stats), "function", "errors"),
+        }
+
+def dump_sql_trace(top: int = 20, out=None) -> None:
+    summary = sql_trace_summary(top)
+    if not summary["statements"] and not summary["functions"]:
+        return
+    write = out.write if out else (lambda text: print(text, end=""))
+    write(f"\n=== SQL TRACE (top {top} por tempo total, lenta >= {summary['slow_ms']} ms) ===\n")
+    write(f"{'n':>8}{'total ms':>12}{'média ms':>10}{'máx ms':>10}{'lentas':>8}  comando\n")
+    for r in summary["statements"]:
+        write(f"{r['count']:>8}{r['total_ms']:>12}{r['avg_ms']:>10}{r['max_ms']:>10}{r['slow']:>8}  {r['sql'][:120]}\n")
+    write(f"\n{'n':>8}{'total ms':>12}{'média ms':>10}{'máx ms':>10}{'erros':>8}  função\n")
+    for r in summary["functions"]:
+        write(f"{r['count']:>8}{r['total_ms']:>12}{r['avg_ms']:>10}{r['max_ms']:>10}{r['errors']:>8}  {r['function']}\n")
+
+def _open_conn(path: str) -> sqlite3.Connection:
+    # isolation_level=None: autocommit; transações são abertas explicitamente em transaction()
+    factory = _TracingConnection if _trace["enabled"] else sqlite3.Connection
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000.0, isolation_level=None,
+                           check_same_thread=False, factory=factory)
+    conn.row_factory = sqlite3.Row
+    if _trace["enabled"]:
+        conn.set_trace_callback(_trace_stmt)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+def _conn() -> sqlite3.Connection:
+    """
+    Retorna a conexão da thread atual, abrindo (e configurando) na primeira chamada.
+    A conexão é reaproveitada por todas as funções deste módulo; não feche-a.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "path", None) != DB_PATH:
+        if conn is not None:
+            conn.close()
+        conn = _open_conn(DB_PATH)
+        _local.conn = conn
+        _local.path = DB_PATH
+    return conn
+
+def close_conn() -> None:
+    """Fecha a conexão da thread atual (útil ao encerrar threads/processos)."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+        _local.path = None
+
+def backend_info() -> str:
+    return f"sqlite: {DB_PATH}"
+
+# contadores de espera por lock de escrita (BEGIN IMMEDIATE que não foi imediato)
+LOCK_WAIT_THRESHOLD = 0.001  # segundos
+_lock_stats_lock = threading.Lock()
+_lock_stats = {"transactions": 0, "lock_waits": 0, "lock_wait_time": 0.0}
+
+def lock_stats() -> Dict:
+    with _lock_stats_lock:
+        return dict(_lock_stats)
+
+def reset_lock_stats() -> None:
+    with _lock_stats_lock:
+        _lock_stats.update(transactions=0, lock_waits=0, lock_wait_time=0.0)
+
+@contextmanager
+def transaction(immediate: bool = True):
+    """
+    Abre uma transação na conexão da thread e faz commit/rollback ao sair.
+    immediate=True (padrão) usa BEGIN IMMEDIATE: reserva a escrita logo no início,
+    esperando até busy_timeout. Em WAL, uma transação DEFERRED que lê e depois
+    escreve falha com SQLITE_BUSY se outro processo escreveu no meio; use
+    immediate=False só para leituras que precisam de um snapshot consistente.
+    Chamadas aninhadas reaproveitam a transação externa.
     """
     conn = _conn()
-    cur = conn.cursor()
+    if conn.in_transaction:
+        yield conn
+        return
+    started = time.perf_counter()
+    conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    waited = time.perf_counter() - started
+    with _lock_stats_lock:
+        _lock_stats["transactions"] += 1
+        if waited > LOCK_WAIT_THRESHOLD:
+            _lock_stats["lock_waits"] += 1
+            _lock_stats["lock_wait_time"] += waited
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        if _trace["enabled"]:
+            t0 = time.perf_counter()
+            conn.commit()
+            _record_sql(conn, "COMMIT", None, time.perf_counter() - t0)
+        else:
+            conn.commit()
+
+# -------------------------
+# MIGRAÇÕES VERSIONADAS (PRAGMA user_version)
+# -------------------------
+# Cada migração é (versão, descrição, função, online).
+# - online=False: a função recebe um cursor e roda dentro de uma única transação
+#   junto com a atualização do user_version (tudo ou nada).
+# - online=True: a função gerencia as próprias transações curtas (ex.: rebuild_table)
+#   e o user_version só é gravado ao final. Deve ser idempotente. Em banco já em uso só
+#   roda com migrate(online=True) (db_migrate.py): no start dos processos a migração para
+#   antes dela, então o código precisa aceitar o schema anterior enquanto estiver pendente.
+#   Banco novo (sem tabelas) aplica tudo no próprio start: não há o que copiar.
+# Nunca altere uma migração já publicada; acrescente uma nova no fim da lista.
+
+def _column_names(cur, table: str) -> List[str]:
+    return [r["name"] for r in cur.execute(f"PRAGMA table_info({table})")]
 
+def _add_column(cur, table: str, column: str, type_def: str) -> None:
+    if column not in _column_names(cur, table):
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {type_def}")
+
+def _m001_base_tables(cur):
     # USERS (compatível com versões anteriores)
     cur.execute("""
     CREATE TABLE IF NOT EXISTS users (
@@ -115,155 +385,580 @@ def migrate():
     )
     """)
 
-    conn.commit()
-    conn.close()
+    # colunas que versões antigas não tinham
+    _add_column(cur, "products", "active", "INTEGER DEFAULT 1")
+    _add_column(cur, "transactions", "approved_at", "TEXT")
+
+def _m002_hot_indexes(cur):
+    # acessos não vendidos por produto (get_available_access / purchase)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_product_access_unsold
+    ON product_access (product_id, id) WHERE vendido = 0
+    """)
+    # busca por mp_id (webhook / aprovarpix); único quando a base não tem duplicados
+    try:
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_mp_id ON transactions (mp_id)")
+    except sqlite3.IntegrityError:
+        print("Aviso: mp_id duplicado em transactions; criando índice não-único.")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_transactions_mp_id_nu ON transactions (mp_id)")
+    # histórico por usuário (cobre as colunas retornadas)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_transactions_user_status_approved
+    ON transactions (user_id, status, approved_at, created_at, amount, mp_id)
+    """)
+    # relatórios por status + intervalo de approved_at (cobre amount)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_transactions_status_approved
+    ON transactions (status, approved_at, amount)
+    """)
+
+def _m003_cache_versions(cur):
+    # contadores de versão para caches em memória compartilhados entre processos
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS cache_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    cur.execute("INSERT OR IGNORE INTO cache_versions (name, version) VALUES ('acl', 0)")
+
+def _m004_sales_rollups(cur):
+    # agregados diários mantidos na mesma transação da aprovação / venda
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS sales_daily (
+        day TEXT PRIMARY KEY,
+        recharge_count INTEGER NOT NULL DEFAULT 0,
+        recharge_total REAL NOT NULL DEFAULT 0,
+        sales_count INTEGER NOT NULL DEFAULT 0,
+        sales_total REAL NOT NULL DEFAULT 0
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS product_sales_daily (
+        day TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        sales_count INTEGER NOT NULL DEFAULT 0,
+        sales_total REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, product_id)
+    )
+    """)
+    _backfill_sales_rollups(cur)
+
+def _m005_broadcast_jobs(cur):
+    # jobs de broadcast com checkpoint (cursor por users.id) para retomar após reinício
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS broadcast_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        created_by INTEGER,
+        status TEXT NOT NULL DEFAULT 'running',
+        last_user_id INTEGER NOT NULL DEFAULT 0,
+        delivered INTEGER NOT NULL DEFAULT 0,
+        blocked INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT DEFAULT (datetime('now')),
+        finished_at TEXT
+    )
+    """)
+
+def _m006_access_login_index(cur):
+    # deduplicação na importação em lote (bulk_add_product_access)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_product_access_login ON product_access (product_id, login)")
+
+# products.stock = acessos não vendidos, mantido por triggers em product_access
+# (qualquer caminho de escrita, inclusive SQL manual). Ao recriar product_access com
+# rebuild_table, passe STOCK_TRIGGERS_SQL em post_sql.
+STOCK_TRIGGERS_SQL = (
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_product_access_stock_ins
+    AFTER INSERT ON product_access WHEN NEW.vendido = 0 BEGIN
+        UPDATE products SET stock = stock + 1 WHERE id = NEW.product_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_product_access_stock_upd
+    AFTER UPDATE OF vendido, product_id ON product_access
+    WHEN OLD.vendido IS NOT NEW.vendido OR OLD.product_id IS NOT NEW.product_id BEGIN
+        UPDATE products SET stock = stock - 1 WHERE id = OLD.product_id AND OLD.vendido = 0;
+        UPDATE products SET stock = stock + 1 WHERE id = NEW.product_id AND NEW.vendido = 0;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_product_access_stock_del
+    AFTER DELETE ON product_access WHEN OLD.vendido = 0 BEGIN
+        UPDATE products SET stock = stock - 1 WHERE id = OLD.product_id;
+    END
+    """,
+)
 
-# Execute migração automaticamente ao importar
-try:
-    migrate()
-except Exception as e:
-    print("Erro ao migrar DB:", e)
+def _m007_stock_counters(cur):
+    for sql in STOCK_TRIGGERS_SQL:
+        cur.execute(sql)
+    _recount_stock(cur)
+
+def _m008_wallet_ledger(cur):
+    # livro-razão da carteira em centavos; wallet.balance_cents é o snapshot (soma do ledger)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS wallet_ledger (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        amount_cents INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        transaction_id INTEGER,
+        sale_id INTEGER,
+        note TEXT,
+        created_at TEXT DEFAULT (datetime('now'))
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_wallet_ledger_user ON wallet_ledger (user_id, id)")
+    # uma recarga (transactions.id) só pode ser creditada uma vez
+    cur.execute("""
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_wallet_ledger_transaction
+    ON wallet_ledger (transaction_id) WHERE transaction_id IS NOT NULL
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_wallet_ledger_no_update BEFORE UPDATE ON wallet_ledger BEGIN
+        SELECT RAISE(ABORT, 'wallet_ledger é append-only');
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_wallet_ledger_no_delete BEFORE DELETE ON wallet_ledger BEGIN
+        SELECT RAISE(ABORT, 'wallet_ledger é append-only');
+    END
+    """)
+    _add_column(cur, "wallet", "balance_cents", "INTEGER NOT NULL DEFAULT 0")
+    # saldo atual vira lançamento de abertura
+    cur.execute("UPDATE wallet SET balance_cents = CAST(ROUND(balance * 100) AS INTEGER)")
+    cur.execute("""
+        INSERT INTO wallet_ledger (user_id, amount_cents, kind, note)
+        SELECT user_id, balance_cents, 'opening', 'saldo anterior ao ledger'
+        FROM wallet
+        WHERE balance_cents != 0
+          AND NOT EXISTS (SELECT 1 FROM wallet_ledger l WHERE l.user_id = wallet.user_id)
+    """)
+
+def _m009_history_index(cur):
+    # paginação por cursor do /historico: (approved_at, id) dentro do usuário
+    cur.execute(f"""
+        UPDATE transactions SET approved_at = created_at
+        WHERE approved_at IS NULL AND status IN {APPROVED_STATUSES!r}
+    """)
+    cur.execute(f"""
+    CREATE INDEX IF NOT EXISTS idx_transactions_user_history
+    ON transactions (user_id, approved_at, id, amount, mp_id) WHERE status IN {APPROVED_STATUSES!r}
+    """)
+
+def _m010_categories(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS categories (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT UNIQUE NOT NULL,
+        position INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    _add_column(cur, "products", "category_id", "INTEGER")
+    # páginas de /comprar: produtos à venda por categoria, em ordem de id (list_products com limit)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_products_catalog
+    ON products (category_id, id) WHERE active = 1 AND stock > 0
+    """)
+
+def _m011_processed_events(cur):
+    # eventos externos já aplicados (ex.: aprovação de PIX); a chave única faz a mesma
+    # notificação ser aplicada uma vez só, mesmo chegando em vários processos
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS processed_events (
+        event_key TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        processed_by TEXT,
+        processed_at TEXT DEFAULT (datetime('now'))
+    )
+    """)
+    # recargas aprovadas antes desta tabela já foram creditadas (saldo antigo virou o
+    # lançamento 'opening' da migração 8); marca o evento para não creditar de novo
+    cur.execute(f"""
+        INSERT OR IGNORE INTO processed_events (event_key, kind, processed_by)
+        SELECT ? || ':' || mp_id, ?, 'migração 11'
+        FROM transactions
+        WHERE mp_id IS NOT NULL AND status IN {APPROVED_STATUSES!r}
+    """, (EVENT_PAYMENT_APPROVED, EVENT_PAYMENT_APPROVED))
+
+MIGRATIONS = [
+    (1, "tabelas base", _m001_base_tables, False),
+    (2, "índices das consultas quentes", _m002_hot_indexes, False),
+    (3, "tabela cache_versions", _m003_cache_versions, False),
+    (4, "agregados de vendas (sales_daily / product_sales_daily)", _m004_sales_rollups, False),
+    (5, "tabela broadcast_jobs", _m005_broadcast_jobs, False),
+    (6, "índice de logins por produto", _m006_access_login_index, False),
+    (7, "contador de estoque em products.stock (triggers)", _m007_stock_counters, False),
+    (8, "ledger da carteira em centavos (wallet_ledger + wallet.balance_cents)", _m008_wallet_ledger, False),
+    (9, "índice do histórico paginado", _m009_history_index, False),
+    (10, "categorias de produtos", _m010_categories, False),
+    (11, "tabela processed_events (eventos aplicados uma única vez)", _m011_processed_events, False),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def schema_version() -> int:
+    return int(_conn().execute("PRAGMA user_version").fetchone()[0])
+
+def migrate(verbose: bool = False, online: bool = False) -> int:
+    """
+    Aplica as migrações pendentes e retorna a versão final do schema.
+    Se o banco já está na versão atual, custa apenas um PRAGMA user_version.
+    Chame no start do processo (bot.py) ou via db_migrate.py.
+    Migrações online só rodam com online=True (db_migrate.py) ou em banco novo: vários
+    workers subindo juntos não podem reconstruir a mesma tabela ao mesmo tempo. Sem ele,
+    para na primeira online pendente e retorna a versão anterior a ela.
+    """
+    current = schema_version()
+    if current >= SCHEMA_VERSION:
+        return current
+    # banco novo: reconstruir tabelas vazias é instantâneo, então a etapa online roda como as
+    # demais (uma transação, com o lock de escrita que serializa os workers)
+    fresh = current == 0 and not _conn().execute("SELECT 1 FROM sqlite_master WHERE type = 'table' LIMIT 1").fetchone()
+
+    for version, descricao, fn, online_step in MIGRATIONS:
+        if version <= current:
+            continue
+        if online_step and not (online or fresh):
+            print(f"Migração online v{version} pendente ({descricao}): rode python db_migrate.py")
+            break
+        if verbose:
+            print(f"-> Migração {version}: {descricao}")
+        if online_step and not fresh:
+            fn()
+            with transaction() as conn:
+                conn.execute(f"PRAGMA user_version = {int(version)}")
+        else:
+            with transaction() as conn:
+                # outro processo pode ter aplicado esta versão enquanto esperávamos o lock
+                if schema_version() < version:
+                    fn() if online_step else fn(conn.cursor())
+                    conn.execute(f"PRAGMA user_version = {int(version)}")
+        current = version
+
+    _conn().execute("PRAGMA optimize")
+    return current
+
+def rebuild_table(table: str, create_sql: str, post_sql: tuple = (), batch_size: int = 5000, pause: float = 0.0) -> int:
+    """
+    Recria `table` sem segurar o lock de escrita durante a cópia inteira.
+    `create_sql` é o DDL da nova tabela com o placeholder {table}; `post_sql`
+    são comandos executados após a troca (ex.: recriar índices).
+    Passos: cria {table}__new + triggers que espelham escritas concorrentes,
+    copia em lotes por rowid (uma transação curta por lote) e troca as tabelas
+    em uma transação final. Colunas em comum são copiadas; as novas usam DEFAULT.
+    Retorna o número de lotes copiados. Pode ser reexecutada após falha.
+    """
+    new = f"{table}__new"
+    triggers = (f"{table}__rb_ins", f"{table}__rb_upd", f"{table}__rb_del")
+    conn = _conn()
+
+    with transaction():
+        for trg in triggers:
+            conn.execute(f"DROP TRIGGER IF EXISTS {trg}")
+        conn.execute(f"DROP TABLE IF EXISTS {new}")
+        conn.execute(create_sql.format(table=new))
+        cur = conn.cursor()
+        new_cols = _column_names(cur, new)
+        cols = [c for c in _column_names(cur, table) if c in new_cols]
+        col_list = ", ".join(cols)
+        new_vals = ", ".join(f"NEW.{c}" for c in cols)
+        conn.execute(f"""
+            CREATE TRIGGER {triggers[0]} AFTER INSERT ON {table} BEGIN
+                INSERT OR REPLACE INTO {new} (rowid, {col_list}) VALUES (NEW.rowid, {new_vals});
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER {triggers[1]} AFTER UPDATE ON {table} BEGIN
+                DELETE FROM {new} WHERE rowid = OLD.rowid;
+                INSERT OR REPLACE INTO {new} (rowid, {col_list}) VALUES (NEW.rowid, {new_vals});
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER {triggers[2]} AFTER DELETE ON {table} BEGIN
+                DELETE FROM {new} WHERE rowid = OLD.rowid;
+            END
+        """)
+        max_rowid = conn.execute(f"SELECT COALESCE(MAX(rowid), 0) FROM {table}").fetchone()[0]
+
+    # linhas acima de max_rowid chegam pelas triggers; OR IGNORE preserva o que elas já gravaram
+    batches = 0
+    last = 0
+    while last < max_rowid:
+        with transaction():
+            conn.execute(
+                f"INSERT OR IGNORE INTO {new} (rowid, {col_list}) SELECT rowid, {col_list} FROM {table} WHERE rowid > ? AND rowid <= ?",
+                (last, last + batch_size)
+            )
+        last += batch_size
+        batches += 1
+        if pause:
+            time.sleep(pause)
+
+    with transaction():
+        for trg in triggers:
+            conn.execute(f"DROP TRIGGER IF EXISTS {trg}")
+        conn.execute(f"DROP TABLE {table}")
+        conn.execute(f"ALTER TABLE {new} RENAME TO {table}")
+        for sql in post_sql:
+            conn.execute(sql)
+    return batches
 
 # -------------------------
 # Usuários & Carteira
 # -------------------------
+# Cache LRU de usuários (caches.UserCache, o mesmo do backend postgres).
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE") or 10000)
+_user_cache = UserCache(USER_CACHE_SIZE)
+
+def user_cache_stats() -> Dict:
+    return _user_cache.stats()
+
 def ensure_user(telegram_id: int, username: Optional[str], first_name: Optional[str], last_name: Optional[str]) -> int:
     """
     Garante que o usuário exista; atualiza campos básicos se necessário.
     Retorna o user.id interno (inteiro).
+    Só escreve no banco se o usuário é novo ou algum campo informado mudou.
     """
-    conn = _conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,))
-    row = cur.fetchone()
+    cached = _user_cache.lookup(telegram_id, username, first_name, last_name)
+    if cached is not None:
+        return cached
 
-    if not row:
-        cur.execute(
-            "INSERT INTO users (telegram_id, username, first_name, last_name) VALUES (?, ?, ?, ?)",
-            (telegram_id, username, first_name, last_name)
-        )
-        user_id = cur.lastrowid
-        # cria carteira
-        cur.execute("INSERT OR IGNORE INTO wallet (user_id, balance) VALUES (?, 0)", (user_id,))
-    else:
-        user_id = row["id"]
-        # atualiza parcialmente (COALESCE sem apagar)
+    with transaction() as conn:
+        cur = conn.cursor()
+        # UPSERT: cria o usuário ou atualiza parcialmente (COALESCE sem apagar)
         cur.execute("""
-            UPDATE users SET
-                username = COALESCE(?, username),
-                first_name = COALESCE(?, first_name),
-                last_name = COALESCE(?, last_name)
-            WHERE id = ?
-        """, (username, first_name, last_name, user_id))
-
+            INSERT INTO users (telegram_id, username, first_name, last_name) VALUES (?, ?, ?, ?)
+            ON CONFLICT(telegram_id) DO UPDATE SET
+                username = COALESCE(excluded.username, username),
+                first_name = COALESCE(excluded.first_name, first_name),
+                last_name = COALESCE(excluded.last_name, last_name)
+        """, (telegram_id, username, first_name, last_name))
+        cur.execute("SELECT id, username, first_name, last_name FROM users WHERE telegram_id = ?", (telegram_id,))
+        row = cur.fetchone()
+        user_id = row["id"]
         # garante carteira existe
         cur.execute("INSERT OR IGNORE INTO wallet (user_id, balance) VALUES (?, 0)", (user_id,))
 
-    conn.commit()
-    conn.close()
+    _user_cache.store(telegram_id, user_id, row["username"], row["first_name"], row["last_name"])
     return user_id
 
 def get_user_by_telegram(telegram_id: int) -> Optional[Dict]:
-    conn = _conn()
-    cur = conn.cursor()
+    cur = _conn().cursor()
     cur.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
     row = cur.fetchone()
-    conn.close()
     return dict(row) if row else None
 
 def get_user_by_id(user_id: int) -> Optional[Dict]:
-    conn = _conn()
-    cur = conn.cursor()
+    cur = _conn().cursor()
     cur.execute("SELECT * FROM users WHERE id = ?", (user_id,))
     row = cur.fetchone()
-    conn.close()
     return dict(row) if row else None
 
+# Carteira: cada mudança de saldo é um lançamento em wallet_ledger (centavos inteiros,
+# nunca alterado/apagado) e o snapshot wallet.balance_cents é atualizado na mesma transação.
+# wallet.balance (REAL) continua espelhando o saldo para código/relatórios antigos.
+LEDGER_OPENING = "opening"    # saldo migrado da versão sem ledger
+LEDGER_RECHARGE = "recharge"  # PIX aprovado (transaction_id)
+LEDGER_PURCHASE = "purchase"  # compra (sale_id)
+LEDGER_ADMIN = "admin"        # /addsaldo e ajustes manuais
+
+def to_cents(amount) -> int:
+    """R$ -> centavos, arredondando meio centavo para cima (Decimal, sem erro de float)."""
+    return int((Decimal(str(amount)) * 100).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+
+def _ledger_post(cur, user_id: int, cents: int, kind: str, transaction_id: Optional[int] = None,
+                 sale_id: Optional[int] = None, note: Optional[str] = None) -> int:
+    """Lança no ledger e atualiza o snapshot. Deve rodar dentro de transaction()."""
+    cur.execute("""
+        INSERT INTO wallet_ledger (user_id, amount_cents, kind, transaction_id, sale_id, note)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (user_id, cents, kind, transaction_id, sale_id, note))
+    entry_id = cur.lastrowid
+    cur.execute("""
+        INSERT INTO wallet (user_id, balance, balance_cents) VALUES (?, ? / 100.0, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            balance_cents = balance_cents + excluded.balance_cents,
+            balance = (balance_cents + excluded.balance_cents) / 100.0
+    """, (user_id, cents, cents))
+    return entry_id
+
 def get_balance(telegram_id: int) -> float:
-    conn = _conn()
-    cur = conn.cursor()
+    cur = _conn().cursor()
     cur.execute("""
-        SELECT w.balance
+        SELECT w.balance_cents
         FROM wallet w
         JOIN users u ON u.id = w.user_id
         WHERE u.telegram_id = ?
     """, (telegram_id,))
     row = cur.fetchone()
-    conn.close()
-    return float(row["balance"]) if row else 0.0
+    return row["balance_cents"] / 100.0 if row else 0.0
 
-def debit_balance(telegram_id: int, amount: float) -> None:
-    conn = _conn()
-    cur = conn.cursor()
-    cur.execute("""
-        UPDATE wallet
-        SET balance = balance - ?
-        WHERE user_id = (SELECT id FROM users WHERE telegram_id = ?)
-    """, (amount, telegram_id))
-    conn.commit()
-    conn.close()
+def _post_for_telegram(telegram_id: int, cents: int, kind: str, transaction_id: Optional[int], note: Optional[str]) -> bool:
+    with transaction() as conn:
+        cur = conn.cursor()
+        row = cur.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
+        if not row:
+            return False
+        if transaction_id is not None and cur.execute(
+                "SELECT 1 FROM wallet_ledger WHERE transaction_id = ?", (transaction_id,)).fetchone():
+            return False  # recarga já creditada
+        _ledger_post(cur, row["id"], cents, kind, transaction_id=transaction_id, note=note)
+        return True
 
-def credit_balance(telegram_id: int, amount: float) -> None:
-    conn = _conn()
-    cur = conn.cursor()
+def debit_balance(telegram_id: int, amount: float, kind: str = LEDGER_ADMIN, note: Optional[str] = None) -> bool:
+    return _post_for_telegram(telegram_id, -to_cents(amount), kind, None, note)
+
+def credit_balance(telegram_id: int, amount: float, kind: str = LEDGER_ADMIN,
+                   transaction_id: Optional[int] = None, note: Optional[str] = None) -> bool:
+    """
+    Credita a carteira. Com transaction_id (recarga PIX) o crédito acontece no máximo uma vez:
+    retorna False se essa transação já tinha sido creditada (ou se o usuário não existe).
+    """
+    return _post_for_telegram(telegram_id, to_cents(amount), kind, transaction_id, note)
+
+def get_ledger(telegram_id: int, limit: int = 20) -> List[Dict]:
+    """Últimos lançamentos da carteira do usuário (mais recentes primeiro)."""
+    cur = _conn().cursor()
     cur.execute("""
-        UPDATE wallet
-        SET balance = balance + ?
-        WHERE user_id = (SELECT id FROM users WHERE telegram_id = ?)
-    """, (amount, telegram_id))
-    conn.commit()
-    conn.close()
+        SELECT l.id, l.amount_cents, l.kind, l.transaction_id, l.sale_id, l.note, l.created_at
+        FROM wallet_ledger l
+        JOIN users u ON u.id = l.user_id
+        WHERE u.telegram_id = ?
+        ORDER BY l.id DESC
+        LIMIT ?
+    """, (telegram_id, limit))
+    return [dict(r) for r in cur.fetchall()]
+
+def verify_wallets(fix: bool = False) -> List[Dict]:
+    """
+    Confere wallet.balance_cents contra a soma do ledger (a fonte da verdade).
+    Retorna as divergências [{"user_id", "snapshot", "ledger"}]; com fix=True corrige o snapshot.
+    """
+    with transaction(immediate=fix) as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT w.user_id, w.balance_cents AS snapshot, COALESCE(l.total, 0) AS ledger
+            FROM wallet w
+            LEFT JOIN (SELECT user_id, SUM(amount_cents) AS total FROM wallet_ledger GROUP BY user_id) l
+                   ON l.user_id = w.user_id
+            WHERE w.balance_cents != COALESCE(l.total, 0)
+        """)
+        drift = [dict(r) for r in cur.fetchall()]
+        if fix and drift:
+            cur.executemany(
+                "UPDATE wallet SET balance_cents = ?, balance = ? / 100.0 WHERE user_id = ?",
+                [(d["ledger"], d["ledger"], d["user_id"]) for d in drift],
+            )
+    return drift
 
 # -------------------------
 # Transações (MP / PIX)
 # -------------------------
 def add_transaction(user_id: int, mp_id: str, amount: float, status: str, description: Optional[str]=None, raw_json: Optional[dict]=None) -> int:
-    conn = _conn()
-    cur = conn.cursor()
     raw_text = json.dumps(raw_json, ensure_ascii=False) if raw_json is not None else None
-    cur.execute("""
-        INSERT INTO transactions (user_id, mp_id, amount, status, description, raw_json)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (user_id, mp_id, amount, status, description, raw_text))
-    tx_id = cur.lastrowid
-    conn.commit()
-    conn.close()
-    return tx_id
+    with transaction() as conn:
+        cur = conn.execute("""
+            INSERT INTO transactions (user_id, mp_id, amount, status, description, raw_json)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (user_id, mp_id, amount, status, description, raw_text))
+        return cur.lastrowid
 
 def approve_transaction_by_mp_id(mp_id: str) -> bool:
     """
     Marca transação aprovada/creditada. Retorna True se mudou algo.
     """
-    conn = _conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id, status FROM transactions WHERE mp_id = ?", (mp_id,))
-    row = cur.fetchone()
-    if not row:
-        conn.close()
-        return False
-    if row["status"] in ("approved", "aprovado", "accredited", "paid"):
-        conn.close()
-        return False
-    cur.execute("UPDATE transactions SET status = 'approved', approved_at = datetime('now') WHERE mp_id = ?", (mp_id,))
-    conn.commit()
-    changed = cur.rowcount > 0
-    conn.close()
-    return changed
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, status FROM transactions WHERE mp_id = ?", (mp_id,))
+        row = cur.fetchone()
+        if not row:
+            return False
+        if row["status"] in APPROVED_STATUSES:
+            return False
+        cur.execute("UPDATE transactions SET status = 'approved', approved_at = datetime('now') WHERE id = ?", (row["id"],))
+        if cur.rowcount == 0:
+            return False
+        _rollup_recharge(cur, row["id"])
+        return True
+
+
+def _process_tag() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def settle_approved_payment(mp_id: str, processed_by: Optional[str] = None) -> Optional[Dict]:
+    """
+    Aprova a recarga mp_id e credita a carteira em uma única transação, no máximo uma vez:
+    o evento "payment.approved:<mp_id>" é gravado em processed_events (chave única),
+    então webhook, reconciliador, /aprovarpix e vários workers WSGI podem receber o mesmo
+    pagamento e só a primeira chamada aplica. Falhou no meio, nada fica gravado.
+    Retorna {"transaction_id", "telegram_id", "amount"} para quem aplicou; senão None.
+    """
+    with transaction() as conn:
+        cur = conn.cursor()
+        tx = cur.execute("""
+            SELECT t.id, t.user_id, t.amount, t.status, u.telegram_id
+            FROM transactions t
+            JOIN users u ON u.id = t.user_id
+            WHERE t.mp_id = ?
+        """, (mp_id,)).fetchone()
+        if not tx:
+            return None
+        cur.execute("INSERT OR IGNORE INTO processed_events (event_key, kind, processed_by) VALUES (?, ?, ?)",
+                    (f"{EVENT_PAYMENT_APPROVED}:{mp_id}", EVENT_PAYMENT_APPROVED, processed_by or _process_tag()))
+        if cur.rowcount == 0:
+            return None
+        # já aprovada sem o evento: crédito feito antes de processed_events/ledger (fica
+        # no 'opening' da migração 8, sem transaction_id); só registra o evento
+        if tx["status"] in APPROVED_STATUSES:
+            return None
+        cur.execute("UPDATE transactions SET status = 'approved', approved_at = datetime('now') WHERE id = ?", (tx["id"],))
+        _rollup_recharge(cur, tx["id"])
+        _ledger_post(cur, tx["user_id"], to_cents(tx["amount"]), LEDGER_RECHARGE, transaction_id=tx["id"])
+        return {"transaction_id": tx["id"], "telegram_id": int(tx["telegram_id"]), "amount": float(tx["amount"])}
+
+def mark_pending_transaction(mp_id: str, status: str) -> bool:
+    """Muda o status de uma transação ainda pendente (ex.: 'cancelled' / 'rejected' vindo do MP)."""
+    with transaction() as conn:
+        cur = conn.execute("UPDATE transactions SET status = ? WHERE mp_id = ? AND status = 'pending'", (status, mp_id))
+        return cur.rowcount > 0
+
+def list_pending_transactions(max_age_s: int, min_age_s: int = 0, after_id: int = 0, limit: int = 100) -> List[Dict]:
+    """
+    Página de transações 'pending' criadas entre max_age_s e min_age_s segundos atrás,
+    com id > after_id (keyset por id; filtra por idx_transactions_status_approved).
+    """
+    cur = _conn().cursor()
+    cur.execute("""
+        SELECT id, mp_id, created_at FROM transactions
+        WHERE status = 'pending' AND id > ?
+          AND created_at >= datetime('now', ?) AND created_at <= datetime('now', ?)
+        ORDER BY id
+        LIMIT ?
+    """, (after_id, f"-{int(max_age_s)} seconds", f"-{int(min_age_s)} seconds", limit))
+    return [dict(r) for r in cur.fetchall()]
+
+def expire_pending_transactions(max_age_s: int) -> int:
+    """Marca como 'expired' as pendentes mais velhas que max_age_s. Retorna quantas mudaram."""
+    with transaction() as conn:
+        cur = conn.execute(
+            "UPDATE transactions SET status = 'expired' WHERE status = 'pending' AND created_at < datetime('now', ?)",
+            (f"-{int(max_age_s)} seconds",)
+        )
+        return cur.rowcount
 
 def get_transaction_by_mp_id(mp_id: str) -> Optional[Dict]:
-    conn = _conn()
-    cur = conn.cursor()
+    cur = _conn().cursor()
     cur.execute("SELECT * FROM transactions WHERE mp_id = ?", (mp_id,))
     row = cur.fetchone()
-    conn.close()
     return dict(row) if row else None
 
 def get_approved_history(telegram_id: int, limit: int = 20) -> List[Dict]:
     """
     Retorna histórico de transações aprovadas (join com users).
     """
-    conn = _conn()
-    cur = conn.cursor()
+    cur = _conn().cursor()
     # considera vários status compatíveis com aprovações
     cur.execute("""
         SELECT t.amount, t.approved_at, t.mp_id, t.created_at
@@ -274,27 +969,158 @@ def get_approved_history(telegram_id: int, limit: int = 20) -> List[Dict]:
         LIMIT ?
     """, (telegram_id, limit))
     rows = cur.fetchall()
-    conn.close()
     return [dict(r) for r in rows]
 
+def get_approved_history_page(telegram_id: int, limit: int = 10, before_id: Optional[int] = None,
+                              after_id: Optional[int] = None) -> Dict:
+    """
+    Página do histórico de recargas aprovadas, da mais recente para a mais antiga.
+    O cursor é o id da transação na borda da página: before_id pagina para as mais antigas,
+    after_id para as mais novas. A ordem real é (approved_at, id), e cada página é um
+    range scan em idx_transactions_user_history (sem OFFSET).
+    Retorna {"rows": [...], "has_older": bool, "has_newer": bool}.
+    """
+    empty = {"rows": [], "has_older": False, "has_newer": False}
+    cur = _conn().cursor()
+    user = cur.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
+    if not user:
+        return empty
+    # o texto de status precisa ser igual ao WHERE do índice parcial
+    base = f"""
+        SELECT id, amount, approved_at, mp_id FROM transactions
+        WHERE user_id = ? AND status IN {APPROVED_STATUSES!r}
+    """
+    cursor_id = after_id if after_id is not None else before_id
+    if cursor_id is not None:
+        # o cursor só vale para transações do próprio usuário
+        key = cur.execute("SELECT approved_at FROM transactions WHERE id = ? AND user_id = ?",
+                          (cursor_id, user["id"])).fetchone()
+        if not key:
+            return empty
+        key = (key["approved_at"], cursor_id)
+
+    if after_id is not None:
+        # indo para as mais novas: busca em ordem crescente e inverte
+        cur.execute(base + " AND (approved_at, id) > (?, ?) ORDER BY approved_at, id LIMIT ?",
+                    (user["id"], key[0], key[1], limit + 1))
+        rows = [dict(r) for r in cur.fetchall()]
+        return {"rows": rows[:limit][::-1], "has_older": True, "has_newer": len(rows) > limit}
+
+    if before_id is not None:
+        cur.execute(base + " AND (approved_at, id) < (?, ?) ORDER BY approved_at DESC, id DESC LIMIT ?",
+                    (user["id"], key[0], key[1], limit + 1))
+    else:
+        cur.execute(base + " ORDER BY approved_at DESC, id DESC LIMIT ?", (user["id"], limit + 1))
+    rows = [dict(r) for r in cur.fetchall()]
+    return {"rows": rows[:limit], "has_older": len(rows) > limit, "has_newer": before_id is not None}
+
 # -------------------------
 # Produtos e acessos
 # -------------------------
-def list_products() -> List[Dict]:
-    conn = _conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id, name, price, stock, active FROM products WHERE active=1")
-    rows = cur.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+# Cache do catálogo (processo inteiro). Invalidado pelas escritas abaixo e
+# recarregado após CATALOG_TTL segundos para pegar edições feitas por outro processo.
+CATALOG_TTL = float(os.environ.get("CATALOG_TTL") or 60)
+
+def _load_catalog() -> List[Dict]:
+    cur = _conn().execute("SELECT id, name, price, stock, active, category_id FROM products ORDER BY id")
+    return [dict(r) for r in cur.fetchall()]
+
+_catalog = CatalogCache(_load_catalog, CATALOG_TTL)
+
+def invalidate_catalog() -> None:
+    _catalog.invalidate()
+
+def catalog_version() -> int:
+    """Versão do catálogo em cache; muda sempre que ele é recarregado."""
+    return _catalog.snapshot()[0]
+
+def list_products(include_sold_out: bool = False, category_id: Optional[int] = None,
+                  after_id: Optional[int] = None, before_id: Optional[int] = None,
+                  limit: Optional[int] = None) -> List[Dict]:
+    """
+    Produtos ativos; por padrão só os que têm estoque (products.stock > 0).
+    Sem limit: lista inteira, vinda do cache do catálogo.
+    Com limit: consulta em janela direto no banco (idx_products_catalog), só à venda,
+    em ordem de id: after_id -> próximos, before_id -> anteriores (retornados em ordem crescente).
+    category_id filtra a categoria; 0 = produtos sem categoria.
+    """
+    if limit is None:
+        _version, _by_id, active = _catalog.snapshot()
+        return [dict(p) for p in active
+                if (include_sold_out or (p["stock"] or 0) > 0)
+                and (category_id is None or (p.get("category_id") or 0) == category_id)]
+
+    where = ["active = 1", "stock > 0"]
+    params = []
+    if category_id == 0:
+        where.append("category_id IS NULL")
+    elif category_id is not None:
+        where.append("category_id = ?")
+        params.append(category_id)
+    order = "id"
+    if before_id is not None:
+        where.append("id < ?")
+        params.append(before_id)
+        order = "id DESC"
+    elif after_id is not None:
+        where.append("id > ?")
+        params.append(after_id)
+    cur = _conn().cursor()
+    cur.execute(f"""
+        SELECT id, name, price, stock, active, category_id FROM products
+        WHERE {" AND ".join(where)}
+        ORDER BY {order}
+        LIMIT ?
+    """, params + [limit])
+    rows = [dict(r) for r in cur.fetchall()]
+    return rows[::-1] if before_id is not None else rows
+
+def list_categories() -> List[Dict]:
+    """Categorias com produtos à venda: [{"id", "name", "available"}]; id 0 = sem categoria."""
+    cur = _conn().cursor()
+    cur.execute("""
+        SELECT COALESCE(p.category_id, 0) AS id, COALESCE(c.name, 'Outros') AS name, COUNT(*) AS available,
+               COALESCE(c.position, 1000000) AS position
+        FROM products p
+        LEFT JOIN categories c ON c.id = p.category_id
+        WHERE p.active = 1 AND p.stock > 0
+        GROUP BY COALESCE(p.category_id, 0)
+        ORDER BY position, name
+    """)
+    return [{"id": r["id"], "name": r["name"], "available": r["available"]} for r in cur.fetchall()]
+
+def list_all_categories() -> List[Dict]:
+    cur = _conn().execute("SELECT id, name, position FROM categories ORDER BY position, name")
+    return [dict(r) for r in cur.fetchall()]
+
+def add_category(name: str, position: int = 0) -> int:
+    with transaction() as conn:
+        cid = conn.execute("INSERT INTO categories (name, position) VALUES (?, ?)", (name, position)).lastrowid
+    invalidate_catalog()
+    return cid
+
+def delete_category(category_id: int) -> bool:
+    """Remove a categoria; os produtos dela ficam sem categoria."""
+    with transaction() as conn:
+        conn.execute("UPDATE products SET category_id = NULL WHERE category_id = ?", (category_id,))
+        changed = conn.execute("DELETE FROM categories WHERE id = ?", (category_id,)).rowcount > 0
+    invalidate_catalog()
+    return changed
+
+def set_product_category(product_id: int, category_id: Optional[int]) -> bool:
+    """category_id None/0 tira o produto da categoria."""
+    with transaction() as conn:
+        if category_id and not conn.execute("SELECT 1 FROM categories WHERE id = ?", (category_id,)).fetchone():
+            return False
+        changed = conn.execute("UPDATE products SET category_id = ? WHERE id = ?",
+                               (category_id or None, product_id)).rowcount > 0
+    invalidate_catalog()
+    return changed
 
 def get_product(product_id: int) -> Optional[Dict]:
-    conn = _conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id, name, price, stock, active FROM products WHERE id = ?", (product_id,))
-    row = cur.fetchone()
-    conn.close()
-    return dict(row) if row else None
+    _version, by_id, _active = _catalog.snapshot()
+    p = by_id.get(product_id)
+    return dict(p) if p else None
 
 def get_available_access(product_id: int) -> Optional[Dict]:
     """
@@ -302,44 +1128,152 @@ def get_available_access(product_id: int) -> Optional[Dict]:
     id, login, password
     (mapeia coluna 'senha' -> 'password' para compatibilidade com bot.py)
     """
-    conn = _conn()
-    cur = conn.cursor()
+    cur = _conn().cursor()
     cur.execute("""
         SELECT id, login, senha FROM product_access
         WHERE product_id = ? AND vendido = 0
+        ORDER BY id
         LIMIT 1
     """, (product_id,))
     row = cur.fetchone()
-    conn.close()
     if not row:
         return None
     return {"id": row["id"], "login": row["login"], "password": row["senha"]}
 
 def mark_access_sold(access_id: int) -> None:
-    conn = _conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE product_access SET vendido = 1 WHERE id = ?", (access_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        row = conn.execute("SELECT product_id FROM product_access WHERE id = ? AND vendido = 0", (access_id,)).fetchone()
+        if row:
+            conn.execute("UPDATE product_access SET vendido = 1 WHERE id = ?", (access_id,))
+    if row:
+        _catalog.stock_delta(row[0], -1)
 
-def add_product(name: str, price: float, stock: int = 0) -> int:
-    conn = _conn()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO products (name, price, stock) VALUES (?, ?, ?)", (name, price, stock))
-    pid = cur.lastrowid
-    conn.commit()
-    conn.close()
+def add_product(name: str, price: float) -> int:
+    # stock começa em 0 e acompanha os acessos cadastrados (triggers de product_access)
+    with transaction() as conn:
+        cur = conn.execute("INSERT INTO products (name, price, stock) VALUES (?, ?, 0)", (name, price))
+        pid = cur.lastrowid
+    invalidate_catalog()
     return pid
 
+def update_product(product_id: int, name: str, price: float) -> bool:
+    with transaction() as conn:
+        cur = conn.execute("UPDATE products SET name = ?, price = ? WHERE id = ?", (name, price, product_id))
+        changed = cur.rowcount > 0
+    invalidate_catalog()
+    return changed
+
+def delete_product(product_id: int) -> bool:
+    with transaction() as conn:
+        cur = conn.execute("DELETE FROM products WHERE id = ?", (product_id,))
+        changed = cur.rowcount > 0
+    invalidate_catalog()
+    return changed
+
 def add_product_access(product_id: int, login: str, senha: str) -> int:
-    conn = _conn()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO product_access (product_id, login, senha, vendido) VALUES (?, ?, ?, 0)", (product_id, login, senha))
-    aid = cur.lastrowid
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        cur = conn.execute("INSERT INTO product_access (product_id, login, senha, vendido) VALUES (?, ?, ?, 0)", (product_id, login, senha))
+        aid = cur.lastrowid
+    _catalog.stock_delta(product_id, 1)
     return aid
 
+IMPORT_CHUNK_SIZE = 500  # abaixo do limite de variáveis do SQLite no IN (...)
+
+def bulk_add_product_access(product_id: int, rows, chunk_size: int = IMPORT_CHUNK_SIZE) -> dict:
+    """
+    Importa acessos (login, senha) de um iterável, sem carregá-lo inteiro na memória.
+    Cada lote é uma transação: consulta os logins já cadastrados para o produto
+    (idx_product_access_login) e insere os novos com executemany.
+    Logins repetidos no próprio arquivo também contam como duplicados.
+    Retorna {"inserted": n, "duplicates": n}.
+    """
+    result = {"inserted": 0, "duplicates": 0}
+    it = iter(rows)
+    while True:
+        chunk = list(islice(it, chunk_size))
+        if not chunk:
+            break
+        with transaction() as conn:
+            logins = list({login for login, _senha in chunk})
+            marks = ",".join("?" * len(logins))
+            existing = {r[0] for r in conn.execute(
+                f"SELECT login FROM product_access WHERE product_id = ? AND login IN ({marks})",
+                [product_id] + logins,
+            )}
+            new_rows = []
+            for login, senha in chunk:
+                if login in existing:
+                    result["duplicates"] += 1
+                    continue
+                existing.add(login)
+                new_rows.append((product_id, login, senha))
+            if new_rows:
+                conn.executemany(
+                    "INSERT INTO product_access (product_id, login, senha, vendido) VALUES (?, ?, ?, 0)",
+                    new_rows,
+                )
+            result["inserted"] += len(new_rows)
+        _catalog.stock_delta(product_id, len(new_rows))
+    return result
+
+def _recount_stock(cur, product_id: Optional[int] = None) -> List[Dict]:
+    where = "WHERE p.id = ?" if product_id is not None else ""
+    cur.execute(f"""
+        SELECT p.id, p.stock,
+               (SELECT COUNT(*) FROM product_access a WHERE a.product_id = p.id AND a.vendido = 0) AS real
+        FROM products p {where}
+    """, (product_id,) if product_id is not None else ())
+    drift = [{"product_id": r["id"], "stock": r["stock"], "real": r["real"]}
+             for r in cur.fetchall() if r["stock"] != r["real"]]
+    cur.executemany("UPDATE products SET stock = ? WHERE id = ?", [(d["real"], d["product_id"]) for d in drift])
+    return drift
+
+def recount_stock(product_id: Optional[int] = None) -> List[Dict]:
+    """
+    Recalcula products.stock a partir de product_access (todos os produtos ou um só).
+    Retorna os produtos corrigidos: [{"product_id", "stock" (antes), "real"}].
+    """
+    with transaction() as conn:
+        drift = _recount_stock(conn.cursor(), product_id)
+    invalidate_catalog()
+    return drift
+
+# -------------------------
+# Cache de admins e banidos (write-through)
+# -------------------------
+# caches.AclCache: carregado na primeira consulta; escritas deste processo atualizam o
+# cache na hora. Escritas de outros processos são detectadas pelo contador
+# cache_versions('acl'), verificado no máximo a cada ACL_REFRESH_INTERVAL segundos.
+ACL_REFRESH_INTERVAL = float(os.environ.get("ACL_REFRESH_INTERVAL") or 5)
+
+def _acl_db_version(conn) -> int:
+    row = conn.execute("SELECT version FROM cache_versions WHERE name = 'acl'").fetchone()
+    return int(row[0]) if row else 0
+
+def _load_acl():
+    with transaction(immediate=False) as conn:
+        version = _acl_db_version(conn)
+        banned = {int(r[0]) for r in conn.execute("SELECT telegram_id FROM banned_users")}
+        admins = {
+            int(r["telegram_id"]): {"nome": r["nome"], "senha": r["senha"], "nivel": r["nivel"]}
+            for r in conn.execute("SELECT telegram_id, nome, senha, nivel FROM admins")
+        }
+    return version, banned, admins
+
+_acl = AclCache(_load_acl, lambda: _acl_db_version(_conn()), ACL_REFRESH_INTERVAL)
+
+def load_acl_cache() -> None:
+    """Pré-carrega admins e banidos (chamado no start do bot)."""
+    _acl.reload()
+
+def _acl_write(sql: str, params: tuple, apply) -> None:
+    """Executa a escrita + incremento da versão e aplica `apply(acl)` no cache local."""
+    with transaction() as conn:
+        conn.execute(sql, params)
+        conn.execute("UPDATE cache_versions SET version = version + 1 WHERE name = 'acl'")
+        version = _acl_db_version(conn)
+    _acl.applied(version, apply)
+
 # -------------------------
 # Admins (persistentes) - helpers para bot
 # -------------------------
@@ -348,123 +1282,278 @@ def is_admin_level(telegram_id: int, senha: Optional[str] = None, min_level: int
     Verifica se telegram_id é admin com senha (se senha for passada) e nivel >= min_level.
     Usado por bot para autenticar /admin <senha>.
     """
-    conn = _conn()
-    cur = conn.cursor()
-    if senha is None:
-        cur.execute("SELECT nivel FROM admins WHERE telegram_id = ?", (telegram_id,))
-        row = cur.fetchone()
-    else:
-        cur.execute("SELECT nivel FROM admins WHERE telegram_id = ? AND senha = ?", (telegram_id, senha))
-        row = cur.fetchone()
-    conn.close()
-    if not row:
-        return False
-    try:
-        return int(row["nivel"]) >= int(min_level)
-    except Exception:
-        return False
+    return _acl.is_admin_level(telegram_id, senha, min_level)
 
 def add_admin_db(telegram_id: int, nome: Optional[str], senha: str, nivel: int = 1) -> None:
-    conn = _conn()
-    cur = conn.cursor()
-    cur.execute("REPLACE INTO admins (telegram_id, nome, senha, nivel) VALUES (?, ?, ?, ?)", (telegram_id, nome, senha, nivel))
-    conn.commit()
-    conn.close()
+    def apply(acl):
+        acl["admins"][int(telegram_id)] = {"nome": nome, "senha": senha, "nivel": nivel}
+    _acl_write("REPLACE INTO admins (telegram_id, nome, senha, nivel) VALUES (?, ?, ?, ?)", (telegram_id, nome, senha, nivel), apply)
 
 def remove_admin_db(telegram_id: int) -> None:
-    conn = _conn()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM admins WHERE telegram_id = ?", (telegram_id,))
-    conn.commit()
-    conn.close()
+    def apply(acl):
+        acl["admins"].pop(int(telegram_id), None)
+    _acl_write("DELETE FROM admins WHERE telegram_id = ?", (telegram_id,), apply)
 
 def list_admins_db() -> List[Dict]:
-    conn = _conn()
-    cur = conn.cursor()
-    cur.execute("SELECT telegram_id, nome, nivel FROM admins")
-    rows = cur.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    return _acl.list_admins()
 
 # -------------------------
 # Banimentos persistentes
 # -------------------------
 def ban_user_db(telegram_id: int) -> None:
-    conn = _conn()
-    cur = conn.cursor()
-    cur.execute("REPLACE INTO banned_users (telegram_id) VALUES (?)", (telegram_id,))
-    conn.commit()
-    conn.close()
+    def apply(acl):
+        acl["banned"].add(int(telegram_id))
+    _acl_write("REPLACE INTO banned_users (telegram_id) VALUES (?)", (telegram_id,), apply)
 
 def unban_user_db(telegram_id: int) -> None:
-    conn = _conn()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM banned_users WHERE telegram_id = ?", (telegram_id,))
-    conn.commit()
-    conn.close()
+    def apply(acl):
+        acl["banned"].discard(int(telegram_id))
+    _acl_write("DELETE FROM banned_users WHERE telegram_id = ?", (telegram_id,), apply)
 
 def is_banned_db(telegram_id: int) -> bool:
-    conn = _conn()
-    cur = conn.cursor()
-    cur.execute("SELECT 1 FROM banned_users WHERE telegram_id = ?", (telegram_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row is not None
+    return _acl.is_banned(telegram_id)
 
 # -------------------------
 # Relatórios (usado por /report)
 # -------------------------
-def get_sales_report(period: str = "total") -> Dict:
-    """
-    period: 'total', 'daily', 'weekly', 'monthly'
-    Retorna dict: {count: int, total: float}
-    Usa tabela transactions (aprovadas) como fonte primária e fallback em sales.
-    """
-    conn = _conn()
-    cur = conn.cursor()
+# Os relatórios leem só os agregados diários (sales_daily / product_sales_daily),
+# atualizados por _rollup_recharge / _rollup_sale na mesma transação da escrita.
+# O custo depende do número de dias do intervalo, não do tamanho do histórico.
 
-    approved_statuses = ("approved", "aprovado", "accredited", "paid")
+def _rollup_recharge(cur, tx_id: int) -> None:
+    cur.execute("""
+        INSERT INTO sales_daily (day, recharge_count, recharge_total)
+        SELECT date(approved_at), 1, amount FROM transactions WHERE id = ?
+        ON CONFLICT(day) DO UPDATE SET
+            recharge_count = recharge_count + 1,
+            recharge_total = recharge_total + excluded.recharge_total
+    """, (tx_id,))
 
-    if period == "total":
-        cur.execute(f"SELECT COUNT(*), COALESCE(SUM(amount),0) FROM transactions WHERE status IN ({','.join(['?']*len(approved_statuses))})", approved_statuses)
-        cnt, total = cur.fetchone()
-        conn.close()
-        return {"count": int(cnt or 0), "total": float(total or 0.0)}
+def _rollup_sale(cur, product_id: int, amount: float, quantity: int = 1) -> None:
+    cur.execute("""
+        INSERT INTO sales_daily (day, sales_count, sales_total) VALUES (date('now'), ?, ?)
+        ON CONFLICT(day) DO UPDATE SET
+            sales_count = sales_count + excluded.sales_count,
+            sales_total = sales_total + excluded.sales_total
+    """, (quantity, amount))
+    cur.execute("""
+        INSERT INTO product_sales_daily (day, product_id, sales_count, sales_total) VALUES (date('now'), ?, ?, ?)
+        ON CONFLICT(day, product_id) DO UPDATE SET
+            sales_count = sales_count + excluded.sales_count,
+            sales_total = sales_total + excluded.sales_total
+    """, (product_id, quantity, amount))
 
-    if period == "daily":
-        cur.execute(f"SELECT COUNT(*), COALESCE(SUM(amount),0) FROM transactions WHERE status IN ({','.join(['?']*len(approved_statuses))}) AND DATE(approved_at)=DATE('now')", approved_statuses)
-        cnt, total = cur.fetchone()
-        conn.close()
-        return {"count": int(cnt or 0), "total": float(total or 0.0)}
+def _backfill_sales_rollups(cur) -> None:
+    cur.execute("DELETE FROM sales_daily")
+    cur.execute("DELETE FROM product_sales_daily")
+    cur.execute(f"""
+        INSERT INTO sales_daily (day, recharge_count, recharge_total)
+        SELECT date(COALESCE(approved_at, created_at)), COUNT(*), COALESCE(SUM(amount), 0)
+        FROM transactions
+        WHERE status IN ({','.join(['?']*len(APPROVED_STATUSES))})
+        GROUP BY 1
+    """, APPROVED_STATUSES)
+    cur.execute("""
+        INSERT INTO sales_daily (day, sales_count, sales_total)
+        SELECT date(date), COALESCE(SUM(quantity), 0), COALESCE(SUM(amount), 0)
+        FROM sales
+        GROUP BY 1
+        ON CONFLICT(day) DO UPDATE SET
+            sales_count = excluded.sales_count,
+            sales_total = excluded.sales_total
+    """)
+    cur.execute("""
+        INSERT INTO product_sales_daily (day, product_id, sales_count, sales_total)
+        SELECT date(date), product_id, COALESCE(SUM(quantity), 0), COALESCE(SUM(amount), 0)
+        FROM sales
+        WHERE product_id IS NOT NULL
+        GROUP BY 1, 2
+    """)
 
-    if period == "weekly":
-        cur.execute(f"SELECT COUNT(*), COALESCE(SUM(amount),0) FROM transactions WHERE status IN ({','.join(['?']*len(approved_statuses))}) AND DATE(approved_at) >= DATE('now','-6 days')", approved_statuses)
-        cnt, total = cur.fetchone()
-        conn.close()
-        return {"count": int(cnt or 0), "total": float(total or 0.0)}
+def rebuild_sales_rollups() -> None:
+    """Recalcula os agregados a partir de transactions/sales (ver db_migrate.py --rebuild-rollups)."""
+    with transaction() as conn:
+        _backfill_sales_rollups(conn.cursor())
 
+def _period_bounds(period: str):
+    today = datetime.now(timezone.utc).date()
+    if period == "total":
+        return None, None
+    if period == "daily":
+        return today, today
+    if period == "weekly":
+        return today - timedelta(days=6), today
     if period == "monthly":
-        cur.execute(f"SELECT COUNT(*), COALESCE(SUM(amount),0) FROM transactions WHERE status IN ({','.join(['?']*len(approved_statuses))}) AND strftime('%Y-%m', approved_at) = strftime('%Y-%m','now')", approved_statuses)
-        cnt, total = cur.fetchone()
-        conn.close()
-        return {"count": int(cnt or 0), "total": float(total or 0.0)}
+        return today.replace(day=1), today
+    raise ValueError(f"período inválido: {period}")
+
+def get_sales_report_range(start: Optional[date] = None, end: Optional[date] = None) -> Dict:
+    """
+    Totais entre os dias start e end (inclusive, UTC); None = sem limite.
+    Retorna dict: {count, total} das recargas aprovadas + {sales_count, sales_total} das vendas.
+    """
+    sql = """
+        SELECT COALESCE(SUM(recharge_count),0), COALESCE(SUM(recharge_total),0),
+               COALESCE(SUM(sales_count),0), COALESCE(SUM(sales_total),0)
+        FROM sales_daily WHERE 1=1
+    """
+    params = []
+    if start:
+        sql += " AND day >= ?"
+        params.append(start.isoformat())
+    if end:
+        sql += " AND day <= ?"
+        params.append(end.isoformat())
+    cnt, total, s_cnt, s_total = _conn().execute(sql, params).fetchone()
+    return {"count": int(cnt), "total": float(total), "sales_count": int(s_cnt), "sales_total": float(s_total)}
+
+def get_product_sales_report(start: Optional[date] = None, end: Optional[date] = None, limit: int = 10) -> List[Dict]:
+    """Vendas por produto no intervalo, ordenadas pelo total (maior primeiro)."""
+    sql = """
+        SELECT r.product_id, p.name, SUM(r.sales_count) AS sales_count, SUM(r.sales_total) AS sales_total
+        FROM product_sales_daily r
+        LEFT JOIN products p ON p.id = r.product_id
+        WHERE 1=1
+    """
+    params = []
+    if start:
+        sql += " AND r.day >= ?"
+        params.append(start.isoformat())
+    if end:
+        sql += " AND r.day <= ?"
+        params.append(end.isoformat())
+    sql += " GROUP BY r.product_id ORDER BY sales_total DESC LIMIT ?"
+    params.append(limit)
+    return [dict(r) for r in _conn().execute(sql, params)]
 
-    # fallback
-    conn.close()
-    return {"count": 0, "total": 0.0}
+def get_sales_report(period: str = "total") -> Dict:
+    """
+    period: 'total', 'daily', 'weekly', 'monthly'
+    Retorna dict: {count: int, total: float, sales_count: int, sales_total: float}
+    """
+    try:
+        start, end = _period_bounds(period)
+    except ValueError:
+        # fallback
+        return {"count": 0, "total": 0.0, "sales_count": 0, "sales_total": 0.0}
+    return get_sales_report_range(start, end)
 
 # -------------------------
 # Função utilitária: gravar venda (sales) quando necessário
 # -------------------------
 def register_sale(user_id: int, product_id: int, price: float, quantity: int = 1) -> int:
     amount = float(price) * int(quantity)
-    conn = _conn()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO sales (user_id, product_id, amount, quantity) VALUES (?, ?, ?, ?)", (user_id, product_id, amount, quantity))
-    sid = cur.lastrowid
-    conn.commit()
-    conn.close()
-    return sid
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO sales (user_id, product_id, amount, quantity) VALUES (?, ?, ?, ?)", (user_id, product_id, amount, quantity))
+        sid = cur.lastrowid
+        _rollup_sale(cur, product_id, amount, quantity)
+        return sid
+
+# -------------------------
+# Compra atômica (usada por callback_buy)
+# -------------------------
+PURCHASE_OK = "ok"
+PURCHASE_NOT_FOUND = "not_found"
+PURCHASE_NO_USER = "no_user"
+PURCHASE_INSUFFICIENT_BALANCE = "insufficient_balance"
+PURCHASE_OUT_OF_STOCK = "out_of_stock"
+
+def purchase(telegram_id: int, product_id: int) -> Dict:
+    """
+    Executa a compra inteira em uma única transação BEGIN IMMEDIATE:
+    reserva um acesso não vendido, debita a carteira e registra a venda.
+    Retorna dict com 'status' (PURCHASE_*) e, em caso de sucesso,
+    'product', 'price', 'balance' e 'access' (id, login, password).
+    Em caso de falha nada é alterado.
+    """
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, name, price, stock, active FROM products WHERE id = ?", (product_id,))
+        product = cur.fetchone()
+        if not product or not product["active"]:
+            return {"status": PURCHASE_NOT_FOUND}
+        price = float(product["price"])
+        if not product["stock"]:
+            return {"status": PURCHASE_OUT_OF_STOCK, "price": price}
+
+        cur.execute("""
+            SELECT u.id, w.balance_cents
+            FROM users u
+            JOIN wallet w ON w.user_id = u.id
+            WHERE u.telegram_id = ?
+        """, (telegram_id,))
+        user = cur.fetchone()
+        if not user:
+            return {"status": PURCHASE_NO_USER, "price": price}
+        price_cents = to_cents(price)
+        balance_cents = user["balance_cents"]
+        if balance_cents < price_cents:
+            return {"status": PURCHASE_INSUFFICIENT_BALANCE, "price": price, "balance": balance_cents / 100.0}
+
+        cur.execute("""
+            SELECT id, login, senha FROM product_access
+            WHERE product_id = ? AND vendido = 0
+            ORDER BY id
+            LIMIT 1
+        """, (product_id,))
+        access = cur.fetchone()
+        if not access:
+            return {"status": PURCHASE_OUT_OF_STOCK, "price": price}
+
+        # BEGIN IMMEDIATE garante que nenhum outro comprador leu/alterou essas linhas desde o SELECT
+        cur.execute("UPDATE product_access SET vendido = 1 WHERE id = ?", (access["id"],))
+        cur.execute("INSERT INTO sales (user_id, product_id, amount, quantity) VALUES (?, ?, ?, 1)", (user["id"], product_id, price))
+        _ledger_post(cur, user["id"], -price_cents, LEDGER_PURCHASE, sale_id=cur.lastrowid)
+        _rollup_sale(cur, product_id, price, 1)
+
+        result = {
+            "status": PURCHASE_OK,
+            "product": dict(product),
+            "price": price,
+            "balance": (balance_cents - price_cents) / 100.0,
+            "access": {"id": access["id"], "login": access["login"], "password": access["senha"]},
+        }
+    _catalog.stock_delta(product_id, -1)
+    return result
+
+# -------------------------
+# Broadcast (jobs com checkpoint)
+# -------------------------
+def iter_users_after(last_user_id: int, limit: int = 500) -> List[Dict]:
+    """Página de usuários com id > last_user_id (keyset pela PK, sem OFFSET)."""
+    cur = _conn().cursor()
+    cur.execute("SELECT id, telegram_id FROM users WHERE id > ? ORDER BY id LIMIT ?", (last_user_id, limit))
+    return [dict(r) for r in cur.fetchall()]
+
+def create_broadcast_job(text: str, created_by: Optional[int]) -> int:
+    with transaction() as conn:
+        cur = conn.execute("INSERT INTO broadcast_jobs (text, created_by) VALUES (?, ?)", (text, created_by))
+        return cur.lastrowid
+
+def get_broadcast_job(job_id: int) -> Optional[Dict]:
+    row = _conn().execute("SELECT * FROM broadcast_jobs WHERE id = ?", (job_id,)).fetchone()
+    return dict(row) if row else None
+
+def list_running_broadcasts() -> List[Dict]:
+    cur = _conn().execute("SELECT * FROM broadcast_jobs WHERE status = 'running' ORDER BY id")
+    return [dict(r) for r in cur.fetchall()]
+
+def checkpoint_broadcast(job_id: int, last_user_id: int, delivered: int, blocked: int, failed: int) -> None:
+    """Avança o cursor e soma os contadores do lote concluído."""
+    with transaction() as conn:
+        conn.execute("""
+            UPDATE broadcast_jobs SET
+                last_user_id = ?,
+                delivered = delivered + ?,
+                blocked = blocked + ?,
+                failed = failed + ?
+            WHERE id = ?
+        """, (last_user_id, delivered, blocked, failed, job_id))
+
+def finish_broadcast(job_id: int, status: str = "done") -> None:
+    with transaction() as conn:
+        conn.execute("UPDATE broadcast_jobs SET status = ?, finished_at = datetime('now') WHERE id = ? AND status = 'running'", (status, job_id))
 
 # -------------------------
 # UTILIDADES
@@ -472,6 +1561,101 @@ def register_sale(user_id: int, product_id: int, price: float, quantity: int = 1
 def row_to_dict(row):
     return dict(row) if row else None
 
+# -------------------------
+# BACKEND DE ARMAZENAMENTO (DB_BACKEND=sqlite | postgres)
+# -------------------------
+# BACKEND_API é a interface usada por bot.py e pelos demais módulos. O padrão é a
+# implementação SQLite acima (um arquivo, um host). Com DB_BACKEND=postgres esses nomes
+# passam a apontar para db_postgres.py (pool de conexões; várias réplicas no mesmo banco).
+# Tracing de SQL e rebuild_table continuam exclusivos do SQLite; constantes, to_cents e
+# os status PURCHASE_* / LEDGER_* são compartilhados.
+DB_BACKEND = (os.environ.get("DB_BACKEND") or "sqlite").lower()
+BACKEND_API = (
+    "transaction", "close_conn", "backend_info", "lock_stats", "reset_lock_stats",
+    "schema_version", "migrate",
+    "user_cache_stats", "ensure_user", "get_user_by_telegram", "get_user_by_id",
+    "get_balance", "debit_balance", "credit_balance", "get_ledger", "verify_wallets",
+    "add_transaction", "approve_transaction_by_mp_id", "settle_approved_payment", "mark_pending_transaction",
+    "list_pending_transactions", "expire_pending_transactions", "get_transaction_by_mp_id",
+    "get_approved_history", "get_approved_history_page",
+    "invalidate_catalog", "catalog_version", "list_products", "list_categories", "list_all_categories",
+    "add_category", "delete_category", "set_product_category", "get_product",
+    "get_available_access", "mark_access_sold", "add_product", "update_product", "delete_product",
+    "add_product_access", "bulk_add_product_access", "recount_stock",
+    "load_acl_cache", "is_admin_level", "add_admin_db", "remove_admin_db", "list_admins_db",
+    "ban_user_db", "unban_user_db", "is_banned_db",
+    "rebuild_sales_rollups", "get_sales_report_range", "get_product_sales_report", "get_sales_report",
+    "register_sale", "purchase",
+    "iter_users_after", "create_broadcast_job", "get_broadcast_job", "list_running_broadcasts",
+    "checkpoint_broadcast", "finish_broadcast",
+)
+# nomes não-função que também mudam com o backend (db_migrate.py --status)
+BACKEND_SCHEMA = ("MIGRATIONS", "SCHEMA_VERSION")
+
+def _install_backend(module) -> None:
+    missing = [n for n in BACKEND_API if not callable(getattr(module, n, None))]
+    missing += [n for n in BACKEND_SCHEMA if not hasattr(module, n)]
+    if missing:
+        raise RuntimeError(f"backend {module.__name__} incompleto; faltam: {', '.join(missing)}")
+    for n in BACKEND_API + BACKEND_SCHEMA:
+        globals()[n] = getattr(module, n)
+
+if DB_BACKEND == "postgres":
+    import db_postgres
+    _install_backend(db_postgres)
+elif DB_BACKEND != "sqlite":
+    raise RuntimeError(f"DB_BACKEND inválido: {DB_BACKEND} (use sqlite ou postgres)")
+
+# -------------------------
+# OBSERVADORES DE CHAMADAS (métricas / tracing)
+# -------------------------
+# Toda função pública deste módulo é envolvida por _observed no import. Sem observadores
+# o custo é um teste de lista vazia; com eles, cada chamada informa (nome, segundos, erro|None).
+_call_observers = []
+# os *_stats só leem contadores em memória (lidos a cada scrape do /metrics)
+_NOT_OBSERVED = {"transaction", "add_call_observer", "remove_call_observer", "row_to_dict",
+                 "enable_sql_trace", "reset_sql_trace", "sql_trace_summary", "dump_sql_trace",
+                 "lock_stats", "reset_lock_stats", "user_cache_stats"}
+
+def add_call_observer(fn) -> None:
+    if fn not in _call_observers:
+        _call_observers.append(fn)
+
+def remove_call_observer(fn) -> None:
+    if fn in _call_observers:
+        _call_observers.remove(fn)
+
+def _observed(fn):
+    name = fn.__name__
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not _call_observers:
+            return fn(*args, **kwargs)
+        error = None
+        t0 = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            elapsed = time.perf_counter() - t0
+            for obs in list(_call_observers):
+                try:
+                    obs(name, elapsed, error)
+                except Exception:
+                    pass
+    return wrapper
+
+for _name, _fn in list(globals().items()):
+    if (inspect.isfunction(_fn) and (_fn.__module__ == __name__ or _name in BACKEND_API)
+            and not _name.startswith("_") and _name not in _NOT_OBSERVED):
+        globals()[_name] = _observed(_fn)
+
+if SQL_TRACE:
+    enable_sql_trace()
+
 # -------------------------
 # Fim do db.py
 # -------------------------
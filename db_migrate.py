@@ -1,151 +1,93 @@
 # db_migrate.py
-# Script de migração segura do SQLite para a loja com admins, relatórios, produtos, acessos e transações
-
-import sqlite3
-
-DB_PATH = "store.db"  # Ajuste se usar outro nome
-
-def run_migrations():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-
-    print("\n=== INICIANDO MIGRAÇÕES DO BANCO ===")
-
-    # -----------------------------
-    # USERS
-    # -----------------------------
-    print("-> Garantindo tabela: users")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        telegram_id INTEGER UNIQUE NOT NULL,
-        username TEXT,
-        first_name TEXT,
-        last_name TEXT
-    )
-    """)
-
-    # -----------------------------
-    # WALLET
-    # -----------------------------
-    print("-> Garantindo tabela: wallet")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS wallet (
-        user_id INTEGER PRIMARY KEY,
-        balance REAL NOT NULL DEFAULT 0,
-        FOREIGN KEY (user_id) REFERENCES users(id)
-    )
-    """)
-
-    # -----------------------------
-    # PRODUCTS
-    # -----------------------------
-    print("-> Garantindo tabela: products")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS products (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        price REAL NOT NULL,
-        stock INTEGER DEFAULT 0,
-        active INTEGER DEFAULT 1
-    )
-    """)
-
-    # -----------------------------
-    # PRODUCT_ACCESS
-    # -----------------------------
-    print("-> Garantindo tabela: product_access")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS product_access (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        product_id INTEGER NOT NULL,
-        login TEXT NOT NULL,
-        senha TEXT NOT NULL,
-        vendido INTEGER NOT NULL DEFAULT 0,
-        FOREIGN KEY (product_id) REFERENCES products(id)
-    )
-    """)
-
-    # -----------------------------
-    # TRANSACTIONS
-    # -----------------------------
-    print("-> Garantindo tabela: transactions")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS transactions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        mp_id TEXT,
-        amount REAL NOT NULL,
-        status TEXT NOT NULL,
-        description TEXT,
-        raw_json TEXT,
-        created_at TEXT DEFAULT (datetime('now')),
-        approved_at TEXT,
-        FOREIGN KEY (user_id) REFERENCES users(id)
-    )
-    """)
-
-    # -----------------------------
-    # ADMINS
-    # -----------------------------
-    print("-> Garantindo tabela: admins")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS admins (
-        telegram_id INTEGER PRIMARY KEY,
-        nome TEXT,
-        senha TEXT,
-        nivel INTEGER NOT NULL DEFAULT 1
-    )
-    """)
-
-    # -----------------------------
-    # BANNED USERS
-    # -----------------------------
-    print("-> Garantindo tabela: banned_users")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS banned_users (
-        telegram_id INTEGER PRIMARY KEY
-    )
-    """)
-
-    # -----------------------------
-    # SALES (para relatórios)
-    # -----------------------------
-    print("-> Garantindo tabela: sales")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS sales (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        product_id INTEGER,
-        amount REAL,
-        quantity INTEGER DEFAULT 1,
-        date TEXT DEFAULT (datetime('now'))
-    )
-    """)
-
-    # -----------------------------
-    # COLUNAS DE MIGRAÇÃO EXTRA
-    # (caso versões antigas não tivessem)
-    # -----------------------------
-
-    def add_column(table, column, type_def):
-        try:
-            cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {type_def}")
-            print(f"-> Coluna adicionada: {table}.{column}")
-        except sqlite3.OperationalError:
-            pass  # coluna já existe
-
-    print("-> Garantindo colunas extras opcionais...")
-    add_column("products", "active", "INTEGER DEFAULT 1")
-    add_column("transactions", "approved_at", "TEXT")
-
-    # Finalizar
-    conn.commit()
-    conn.close()
-
-    print("\n=== MIGRAÇÕES FINALIZADAS COM SUCESSO ===")
+# Script de migração do banco da loja.
+# As migrações ficam versionadas em db.py (MIGRATIONS, controladas por PRAGMA user_version)
+# ou em db_postgres.py com DB_BACKEND=postgres; este script apenas as aplica e mostra o estado do schema.
+#
+# Uso:
+#   python db_migrate.py            -> aplica migrações pendentes, inclusive as online
+#                                      (tabelas grandes; o start do bot não as aplica)
+#   python db_migrate.py --status   -> mostra versão atual / esperada
+#   python db_migrate.py --rebuild-rollups -> recalcula os agregados de /report
+#   python db_migrate.py --recount-stock   -> recalcula products.stock a partir de product_access
+#   python db_migrate.py --verify-wallets  -> confere wallet.balance_cents contra wallet_ledger
+#   python db_migrate.py --rebuild-wallets -> idem, corrigindo o snapshot pelo ledger
+#   python db_migrate.py CAMINHO.db -> usa outro arquivo de banco (SQLite)
+#   DB_BACKEND=postgres DATABASE_URL=... python db_migrate.py --from-sqlite store.db
+#                                   -> cria o schema no postgres e copia a loja SQLite (banco vazio)
+
+import sys
+
+import db
+
+def run_migrations(path: str = None, status_only: bool = False, rebuild_rollups: bool = False,
+                   recount_stock: bool = False, verify_wallets: bool = False, rebuild_wallets: bool = False,
+                   from_sqlite: str = None):
+    if path:
+        db.DB_PATH = path
+
+    current = db.schema_version()
+    print(f"\n=== BANCO: {db.backend_info()} — schema v{current} (atual: v{db.SCHEMA_VERSION}) ===")
+
+    if status_only:
+        for version, descricao, _fn, online in db.MIGRATIONS:
+            estado = "aplicada" if version <= current else "pendente"
+            modo = " [online]" if online else ""
+            print(f"  v{version}: {descricao}{modo} — {estado}")
+        return current
+
+    if current >= db.SCHEMA_VERSION:
+        print("-> Nada a fazer, schema já está atualizado.")
+        final = current
+    else:
+        final = db.migrate(verbose=True, online=True)
+        print(f"\n=== MIGRAÇÕES FINALIZADAS COM SUCESSO (v{final}) ===")
+
+    if from_sqlite:
+        if db.DB_BACKEND != "postgres":
+            print("-> --from-sqlite exige DB_BACKEND=postgres.")
+            return final
+        print(f"-> Copiando {from_sqlite} para o postgres...")
+        import db_postgres
+        for table, n in db_postgres.copy_from_sqlite(from_sqlite).items():
+            print(f"  {table}: {n}")
+        print("-> Cópia concluída.")
+
+    if rebuild_rollups:
+        print("-> Recalculando agregados de vendas (sales_daily / product_sales_daily)...")
+        db.rebuild_sales_rollups()
+        print("-> Agregados recalculados.")
+    if recount_stock:
+        print("-> Recontando estoque (products.stock)...")
+        drift = db.recount_stock()
+        for d in drift:
+            print(f"  produto {d['product_id']}: {d['stock']} -> {d['real']}")
+        print(f"-> {len(drift)} produto(s) corrigido(s).")
+    if verify_wallets or rebuild_wallets:
+        print("-> Conferindo carteiras (wallet.balance_cents x soma de wallet_ledger)...")
+        drift = db.verify_wallets(fix=rebuild_wallets)
+        for d in drift:
+            print(f"  user_id {d['user_id']}: snapshot {d['snapshot']} / ledger {d['ledger']} (centavos)")
+        acao = "corrigida(s)" if rebuild_wallets else "divergente(s)"
+        print(f"-> {len(drift)} carteira(s) {acao}.")
+    return final
 
 
 if __name__ == "__main__":
-    run_migrations()
+    argv = sys.argv[1:]
+    from_sqlite = None
+    if "--from-sqlite" in argv:
+        i = argv.index("--from-sqlite")
+        from_sqlite = argv[i + 1] if i + 1 < len(argv) else None
+        if not from_sqlite:
+            sys.exit("uso: db_migrate.py --from-sqlite CAMINHO.db")
+        del argv[i:i + 2]
+    args = [a for a in argv if not a.startswith("--")]
+    run_migrations(
+        args[0] if args else None,
+        status_only="--status" in sys.argv,
+        rebuild_rollups="--rebuild-rollups" in sys.argv,
+        recount_stock="--recount-stock" in sys.argv,
+        verify_wallets="--verify-wallets" in sys.argv,
+        rebuild_wallets="--rebuild-wallets" in sys.argv,
+        from_sqlite=from_sqlite,
+    )
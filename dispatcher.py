@@ -0,0 +1,123 @@
+# dispatcher.py
+# Despacho de updates do Telegram com ordem garantida por chat
+# - Cada chat_id tem sua própria fila; no máximo um worker processa um chat por vez
+# - Chats diferentes rodam em paralelo em um pool de N workers
+# - Um handler lento (ex.: mp_create_pix) ocupa só um worker, sem travar outros chats
+#   que caíram no mesmo "shard" (as filas são por chat, não por hash)
+# - stats() expõe profundidade das filas para métricas
+
+import queue
+import threading
+from collections import deque
+from typing import Callable, Dict, Hashable
+
+def update_chat_id(update) -> Hashable:
+    """Chave de ordenação de um telebot.types.Update: chat da mensagem ou usuário."""
+    for attr in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        msg = getattr(update, attr, None)
+        if msg is not None:
+            return msg.chat.id
+    cq = getattr(update, "callback_query", None)
+    if cq is not None:
+        if cq.message is not None:
+            return cq.message.chat.id
+        return cq.from_user.id
+    for attr in ("inline_query", "chosen_inline_result", "shipping_query", "pre_checkout_query",
+                 "my_chat_member", "chat_member", "chat_join_request"):
+        obj = getattr(update, attr, None)
+        if obj is not None:
+            chat = getattr(obj, "chat", None)
+            if chat is not None:
+                return chat.id
+            user = getattr(obj, "from_user", None)
+            if user is not None:
+                return user.id
+    return None
+
+class ChatDispatcher:
+    def __init__(self, workers: int = 8, name: str = "dispatch"):
+        self.workers = workers
+        self.name = name
+        self._lock = threading.Lock()
+        # chat_id -> deque[(fn, args)]; a cabeça da fila é a tarefa em execução
+        self._pending: Dict[Hashable, deque] = {}
+        self._ready = queue.Queue()
+        self._threads = []
+        self._queued = 0
+        self._busy = 0
+        self.processed = 0
+        self.errors = 0
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, name=f"{self.name}-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, key: Hashable, fn: Callable, *args) -> None:
+        with self._lock:
+            self._queued += 1
+            dq = self._pending.get(key)
+            if dq is not None:
+                dq.append((fn, args))
+                return
+            self._pending[key] = deque([(fn, args)])
+        self._ready.put(key)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            longest = max((len(dq) for dq in self._pending.values()), default=0)
+            return {
+                "workers": self.workers,
+                "busy_workers": self._busy,
+                "queue_depth": self._queued,
+                "active_chats": len(self._pending),
+                "ready_chats": self._ready.qsize(),
+                "max_chat_depth": longest,
+                "processed": self.processed,
+                "errors": self.errors,
+            }
+
+    def _worker(self):
+        while True:
+            key = self._ready.get()
+            with self._lock:
+                fn, args = self._pending[key][0]
+                self._busy += 1
+            failed = False
+            try:
+                fn(*args)
+            except Exception as e:
+                failed = True
+                print(f"[{self.name}] erro ao processar update do chat {key}: {e}")
+            with self._lock:
+                self._busy -= 1
+                self._queued -= 1
+                self.processed += 1
+                if failed:
+                    self.errors += 1
+                dq = self._pending[key]
+                dq.popleft()
+                if dq:
+                    # ainda há updates deste chat: volta para o fim da fila (justiça entre chats)
+                    self._ready.put(key)
+                else:
+                    del self._pending[key]
+
+def install(bot, dispatcher: ChatDispatcher) -> None:
+    """
+    Faz bot.process_new_updates despachar cada update para a fila do seu chat.
+    Os handlers passam a rodar de forma síncrona dentro dos workers do dispatcher.
+    """
+    original = bot.process_new_updates
+
+    def process_new_updates(updates):
+        for upd in updates:
+            dispatcher.submit(update_chat_id(upd), original, [upd])
+
+    bot.threaded = False
+    bot.process_new_updates = process_new_updates
+    dispatcher.start()
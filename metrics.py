@@ -0,0 +1,195 @@
+# metrics.py
+# Métricas no formato texto do Prometheus, sem dependências externas
+# - Counter / Histogram com labels; Gauge e CounterFunc calculados na hora do scrape (callback)
+# - Custo por observação: um lock curto + soma em dict (pode ficar ligado em produção)
+# - render() gera o texto servido em GET /metrics (bot.py)
+
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Tuple
+
+# segundos; cobre de consultas SQLite (sub-ms) até chamadas lentas ao MP
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels_text(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _fmt(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels: Dict) -> Tuple:
+        return tuple(labels.get(n, "") for n in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_labels_text(self.labelnames, k)} {_fmt(v)}" for k, v in sorted(items)]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label -> [contagem por bucket (+Inf no fim), soma, total]
+        self._values: Dict[Tuple, list] = {}
+
+    def observe(self, seconds: float, **labels) -> None:
+        key = self._key(labels)
+        idx = bisect_left(self.buckets, seconds)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][idx] += 1
+            entry[1] += seconds
+            entry[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            items = [(k, (list(v[0]), v[1], v[2])) for k, v in self._values.items()]
+        out = []
+        for key, (counts, total, n) in sorted(items):
+            acc = 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                acc += c
+                le = 'le="%s"' % _fmt(bound)
+                out.append(f"{self.name}_bucket{_labels_text(self.labelnames, key, le)} {acc}")
+            out.append(f"{self.name}_sum{_labels_text(self.labelnames, key)} {_fmt(total)}")
+            out.append(f"{self.name}_count{_labels_text(self.labelnames, key)} {n}")
+        return out
+
+class Gauge(_Metric):
+    """Valor lido no scrape: fn() retorna um número ou {valor_do_label: número}."""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, fn: Callable, labelname: str = None):
+        super().__init__(name, help_text, (labelname,) if labelname else ())
+        self.fn = fn
+
+    def samples(self):
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        if isinstance(value, dict):
+            return [f"{self.name}{_labels_text(self.labelnames, (k,))} {_fmt(v)}" for k, v in sorted(value.items())]
+        return [f"{self.name} {_fmt(value)}"]
+
+class CounterFunc(Gauge):
+    """Contador mantido fora daqui (ex.: lock_stats do db), lido no scrape; fn() nunca diminui."""
+    kind = "counter"
+
+class _Timer:
+    def __init__(self, hist: Histogram, labels: Dict):
+        self.hist = hist
+        self.labels = labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.t0, **self.labels)
+        return False
+
+def render() -> str:
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for m in metrics:
+        samples = m.samples()
+        if samples or m.kind == "gauge":
+            lines.extend(m.header())
+            lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# -------------------------
+# Instrumentação dos handlers do telebot
+# -------------------------
+def instrument_handlers(bot, updates: Counter, latency: Histogram, errors: Counter) -> int:
+    """
+    Envolve as funções dos handlers já registrados no bot (message, callback_query...)
+    com contagem e latência por nome de função. Chame depois de registrar todos.
+    """
+    wrapped = 0
+    for attr in dir(bot):
+        if not attr.endswith("_handlers"):
+            continue
+        handlers = getattr(bot, attr, None)
+        if not isinstance(handlers, list):
+            continue
+        for h in handlers:
+            if not isinstance(h, dict) or "function" not in h or getattr(h["function"], "_metrics_wrapped", False):
+                continue
+            h["function"] = _wrap_handler(h["function"], updates, latency, errors)
+            wrapped += 1
+    return wrapped
+
+def _wrap_handler(fn, updates, latency, errors):
+    name = fn.__name__
+
+    def handler(*args, **kwargs):
+        updates.inc(handler=name)
+        t0 = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            errors.inc(handler=name)
+            raise
+        finally:
+            latency.observe(time.perf_counter() - t0, handler=name)
+
+    handler.__name__ = name
+    handler.__wrapped__ = fn
+    handler._metrics_wrapped = True
+    return handler
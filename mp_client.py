@@ -0,0 +1,163 @@
+# mp_client.py
+# Cliente HTTP do Mercado Pago usado por bot.py
+# - requests.Session compartilhada (keep-alive + pool de conexões)
+# - Retentativas limitadas com backoff + jitter (só para chamadas idempotentes)
+# - Timeouts por endpoint
+# - Circuit breaker: após falhas seguidas, falha rápido até o cooldown passar
+#
+# base_url pode apontar para um servidor local (stand-in) em testes/benchmarks.
+
+import random
+import threading
+import time
+import uuid
+from typing import Callable, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+MP_API_BASE = "https://api.mercadopago.com"
+
+# status HTTP que valem nova tentativa
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+class CircuitOpenError(Exception):
+    """Mercado Pago marcado como indisponível; chamada recusada sem tocar a rede."""
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._probing:
+                raise CircuitOpenError("Mercado Pago indisponível (circuit breaker aberto)")
+            # half-open: deixa passar uma chamada de teste
+            self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+class MercadoPagoClient:
+    """
+    Uma instância por processo. Métodos levantam requests.HTTPError em respostas
+    4xx/5xx definitivas (como raise_for_status) e CircuitOpenError com o circuito aberto.
+    """
+
+    def __init__(self, access_token: str, base_url: str = MP_API_BASE, pool_size: int = 20,
+                 max_retries: int = 3, backoff_base: float = 0.5, backoff_max: float = 8.0,
+                 connect_timeout: float = 3.05, create_timeout: float = 25, get_timeout: float = 15,
+                 breaker: Optional[CircuitBreaker] = None, observer: Optional[Callable] = None):
+        self.access_token = access_token
+        self.base_url = base_url.rstrip("/")
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeouts = {
+            "create_payment": (connect_timeout, create_timeout),
+            "get_payment": (connect_timeout, get_timeout),
+        }
+        self.breaker = breaker or CircuitBreaker()
+        # observer(endpoint, status, segundos) por tentativa; status = código HTTP, "error" ou "circuit_open"
+        self.observer = observer
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {access_token}",
+            "Connection": "keep-alive",
+        })
+
+    def _sleep_backoff(self, attempt: int, retry_after: Optional[str] = None):
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        delay = random.uniform(0, delay)  # full jitter
+        if retry_after:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        time.sleep(delay)
+
+    def _observe(self, endpoint: str, status, started: float):
+        if self.observer:
+            try:
+                self.observer(endpoint, status, time.perf_counter() - started)
+            except Exception:
+                pass
+
+    def _request(self, endpoint: str, method: str, path: str, idempotent: bool, **kwargs) -> requests.Response:
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError:
+            self._observe(endpoint, "circuit_open", time.perf_counter())
+            raise
+        attempts = (self.max_retries + 1) if idempotent else 1
+        url = f"{self.base_url}{path}"
+        for attempt in range(attempts):
+            last = attempt == attempts - 1
+            started = time.perf_counter()
+            try:
+                resp = self.session.request(method, url, timeout=self.timeouts[endpoint], **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._observe(endpoint, "error", started)
+                if last:
+                    self.breaker.record_failure()
+                    raise
+                self._sleep_backoff(attempt)
+                continue
+            except Exception:
+                self._observe(endpoint, "error", started)
+                self.breaker.record_failure()
+                raise
+
+            self._observe(endpoint, resp.status_code, started)
+            if resp.status_code in RETRY_STATUS:
+                if last:
+                    self.breaker.record_failure()
+                    resp.raise_for_status()
+                self._sleep_backoff(attempt, resp.headers.get("Retry-After"))
+                continue
+
+            # 4xx definitivo é erro do pedido, não do MP: não conta para o breaker
+            self.breaker.record_success()
+            resp.raise_for_status()
+            return resp
+
+    def create_payment(self, payload: dict, idempotency_key: Optional[str] = None) -> dict:
+        """POST /v1/payments. A mesma X-Idempotency-Key é reenviada em cada tentativa."""
+        idempotency_key = idempotency_key or str(uuid.uuid4())
+        headers = {"Content-Type": "application/json", "X-Idempotency-Key": idempotency_key}
+        resp = self._request("create_payment", "POST", "/v1/payments", idempotent=True, json=payload, headers=headers)
+        return resp.json()
+
+    def get_payment(self, payment_id: str) -> dict:
+        resp = self._request("get_payment", "GET", f"/v1/payments/{payment_id}", idempotent=True)
+        return resp.json()
@@ -0,0 +1,233 @@
+# outbox.py
+# Fila de envio para o Telegram com limite de taxa
+# - Handlers enfileiram (send_message / reply_to / send_photo) e retornam na hora
+# - Limites: global (~30 msg/s) e por chat (~1 msg/s, com pequena rajada), via GCRA (token bucket)
+# - Prioridades: tráfego interativo (PRIORITY_HIGH) passa na frente de broadcasts (PRIORITY_LOW)
+# - 429: respeita parameters.retry_after e reagenda; outros erros temporários: backoff
+# - Arquivos (send_photo com BytesIO etc.) voltam ao início antes de cada tentativa
+# - Erros definitivos (bloqueado, chat inexistente) ou tentativas esgotadas vão para o dead-letter log
+#   (sem o texto: só um trecho inicial, e nada para envios marcados sensitive=True, como
+#   credenciais vendidas e o copia-e-cola do PIX)
+# - A execução usa o ChatDispatcher, então mensagens do mesmo chat saem na ordem enfileirada
+
+import heapq
+import itertools
+import json
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from dispatcher import ChatDispatcher
+
+PRIORITY_HIGH = 0
+PRIORITY_LOW = 10
+
+# caracteres do texto guardados no dead-letter log (o resto nunca é gravado)
+DEAD_LETTER_PREVIEW = 40
+
+class RateLimiter:
+    """GCRA: `rate` envios/s por chave com tolerância de `burst` envios seguidos."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.interval = 1.0 / rate
+        self.tolerance = (max(1, burst) - 1) * self.interval
+        self._tat: Dict[object, float] = {}
+
+    def reserve(self, key, now: float) -> float:
+        """Reserva o próximo horário livre para `key` e retorna quanto esperar (s)."""
+        tat = max(self._tat.get(key, now), now)
+        self._tat[key] = tat + self.interval
+        return max(0.0, tat - self.tolerance - now)
+
+    def block(self, key, until: float) -> None:
+        self._tat[key] = max(self._tat.get(key, 0.0), until)
+
+    def prune(self, now: float) -> None:
+        for key in [k for k, tat in self._tat.items() if tat < now]:
+            del self._tat[key]
+
+class Outbox:
+    def __init__(self, bot, global_rate: float = 30.0, chat_rate: float = 1.0, chat_burst: int = 3,
+                 workers: int = 8, max_attempts: int = 5, dead_letter_path: Optional[str] = "dead_letters.jsonl",
+                 observer: Optional[Callable] = None):
+        self.bot = bot
+        # observer(método, status, segundos) por tentativa; status = "ok" ou código de erro da Bot API
+        self.observer = observer
+        self.max_attempts = max_attempts
+        self.dead_letter_path = dead_letter_path
+        self._global = RateLimiter(global_rate, burst=max(1, int(global_rate)))
+        self._chat = RateLimiter(chat_rate, burst=chat_burst)
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._ready = []    # heap (priority, seq, job)
+        self._delayed = []  # heap (due, seq, job)
+        self._executor = ChatDispatcher(workers=workers, name="outbox")
+        self._thread = None
+        self._last_prune = time.monotonic()
+        self.stats = {"enqueued": 0, "sent": 0, "retried": 0, "rate_limited": 0, "dead": 0}
+
+    # ---------- API usada pelos handlers ----------
+    def send_message(self, chat_id, text, priority: int = PRIORITY_HIGH, on_done: Callable = None,
+                     sensitive: bool = False, **kwargs):
+        self.enqueue(chat_id, "send_message", (chat_id, text), kwargs, priority, on_done, sensitive)
+
+    def reply_to(self, message, text, priority: int = PRIORITY_HIGH, on_done: Callable = None,
+                 sensitive: bool = False, **kwargs):
+        self.enqueue(message.chat.id, "reply_to", (message, text), kwargs, priority, on_done, sensitive)
+
+    def send_photo(self, chat_id, photo, priority: int = PRIORITY_HIGH, on_done: Callable = None,
+                   sensitive: bool = False, **kwargs):
+        self.enqueue(chat_id, "send_photo", (chat_id, photo), kwargs, priority, on_done, sensitive)
+
+    def enqueue(self, chat_id, method: str, args: tuple, kwargs: dict, priority: int = PRIORITY_HIGH,
+                on_done: Callable = None, sensitive: bool = False) -> None:
+        """
+        on_done(ok: bool, error: Exception|None) é chamado ao entregar ou desistir.
+        sensitive=True: o texto nunca vai para o dead-letter log (credenciais, código PIX).
+        """
+        job = {"chat_id": chat_id, "method": method, "args": args, "kwargs": kwargs,
+               "priority": priority, "on_done": on_done, "attempt": 0, "reserved": False,
+               "sensitive": sensitive}
+        with self._cond:
+            self.stats["enqueued"] += 1
+            heapq.heappush(self._ready, (priority, next(self._seq), job))
+            self._cond.notify()
+        self.start()
+
+    def depth(self) -> Dict:
+        with self._cond:
+            return {"ready": len(self._ready), "delayed": len(self._delayed),
+                    "executing": self._executor.stats()["queue_depth"]}
+
+    def pending_low_priority_ok(self) -> bool:
+        """True se não há tráfego interativo esperando (broadcasts podem avançar)."""
+        with self._cond:
+            return not any(p < PRIORITY_LOW for p, _s, _j in self._ready)
+
+    # ---------- agendamento ----------
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._scheduler, name="outbox-scheduler", daemon=True)
+            self._thread.start()
+        self._executor.start()
+
+    def _schedule_later(self, job, delay: float):
+        with self._cond:
+            heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._seq), job))
+            self._cond.notify()
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _due, seq, job = heapq.heappop(self._delayed)
+                    heapq.heappush(self._ready, (job["priority"], seq, job))
+                if now - self._last_prune > 60:
+                    self._chat.prune(now)
+                    self._last_prune = now
+                if self._ready:
+                    return heapq.heappop(self._ready)[2]
+                timeout = (self._delayed[0][0] - now) if self._delayed else None
+                self._cond.wait(timeout)
+
+    def _scheduler(self):
+        while True:
+            job = self._next_job()
+            now = time.monotonic()
+            if not job["reserved"]:
+                wait = self._chat.reserve(job["chat_id"], now)
+                if wait > 0:
+                    # horário reservado: mensagens seguintes do chat ficam atrás desta
+                    job["reserved"] = True
+                    self._schedule_later(job, wait)
+                    continue
+            job["reserved"] = False
+            wait = self._global.reserve(None, now)
+            if wait > 0:
+                time.sleep(wait)
+            self._executor.submit(job["chat_id"], self._execute, job)
+
+    # ---------- execução ----------
+    @staticmethod
+    def _rewind(job):
+        # a tentativa anterior (ex.: send_photo com BytesIO) leu o arquivo até o fim;
+        # sem voltar ao início o reenvio após 429/5xx sobe 0 bytes
+        for value in itertools.chain(job["args"], job["kwargs"].values()):
+            if hasattr(value, "read") and hasattr(value, "seek"):
+                value.seek(0)
+
+    def _execute(self, job):
+        job["attempt"] += 1
+        self._rewind(job)
+        started = time.perf_counter()
+        try:
+            getattr(self.bot, job["method"])(*job["args"], **job["kwargs"])
+        except Exception as e:
+            self._observe(job, str(getattr(e, "error_code", None) or "error"), started)
+            self._handle_error(job, e)
+            return
+        self._observe(job, "ok", started)
+        with self._cond:
+            self.stats["sent"] += 1
+        self._done(job, True, None)
+
+    def _observe(self, job, status: str, started: float):
+        if self.observer:
+            try:
+                self.observer(job["method"], status, time.perf_counter() - started)
+            except Exception:
+                pass
+
+    def _handle_error(self, job, error):
+        code = getattr(error, "error_code", None)
+        if code == 429:
+            params = (getattr(error, "result_json", None) or {}).get("parameters") or {}
+            retry_after = float(params.get("retry_after") or 1)
+            with self._cond:
+                self.stats["rate_limited"] += 1
+                self._chat.block(job["chat_id"], time.monotonic() + retry_after)
+            if job["attempt"] < self.max_attempts:
+                self._schedule_later(job, retry_after)
+                return
+        elif code is not None and 400 <= code < 500:
+            # erro definitivo (ex.: 403 bot bloqueado, 400 chat não encontrado)
+            self._dead(job, error)
+            return
+        elif job["attempt"] < self.max_attempts:
+            with self._cond:
+                self.stats["retried"] += 1
+            self._schedule_later(job, min(30.0, 0.5 * (2 ** job["attempt"])))
+            return
+        self._dead(job, error)
+
+    def _dead(self, job, error):
+        with self._cond:
+            self.stats["dead"] += 1
+        if self.dead_letter_path:
+            record = {
+                "ts": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "chat_id": job["chat_id"],
+                "method": job["method"],
+                "attempts": job["attempt"],
+                "error": str(error),
+            }
+            text = next((a for a in job["args"] if isinstance(a, str)), None)
+            if text is not None and not job["sensitive"]:
+                record["preview"] = text[:DEAD_LETTER_PREVIEW] + ("…" if len(text) > DEAD_LETTER_PREVIEW else "")
+            try:
+                with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            except Exception as e:
+                print("Erro ao gravar dead-letter:", e)
+        self._done(job, False, error)
+
+    def _done(self, job, ok: bool, error):
+        cb = job.get("on_done")
+        if cb:
+            try:
+                cb(ok, error)
+            except Exception as e:
+                print("Erro no callback do outbox:", e)
@@ -0,0 +1,106 @@
+# reconciler.py
+# Reconciliação periódica de PIX pendentes (rede de segurança do webhook do MP)
+# - A cada `interval` segundos percorre as transações 'pending' dentro da janela de pagamento
+#   (keyset por id, em lotes), ignorando as criadas há menos de `min_age` (o webhook costuma chegar antes)
+# - Cada pagamento é reconsultado com backoff exponencial próprio (1 min, 2 min, 4 min... até max_delay)
+# - A consulta/crédito passa pela mesma PaymentQueue do webhook (singleflight + idempotência);
+#   no máximo `max_inflight` pagamentos do reconciliador ficam na fila ao mesmo tempo
+# - Pendentes mais velhas que a janela são marcadas como 'expired'
+# - Quem consulta o MP chama record_status(): com status final o pagamento sai do agendamento
+
+import random
+import threading
+import time
+from typing import Dict
+
+import db
+
+# status do MP (ou nosso) depois dos quais não há mais o que reconsultar
+FINAL_STATUSES = frozenset(db.APPROVED_STATUSES) | {"cancelled", "rejected", "refunded", "charged_back", "expired"}
+
+class PendingReconciler:
+    def __init__(self, payment_queue, interval: float = 60.0, window: int = 86400, min_age: int = 60,
+                 batch_size: int = 100, max_inflight: int = 20, base_delay: float = 60.0,
+                 max_delay: float = 1800.0):
+        self.queue = payment_queue
+        self.interval = interval
+        self.window = window
+        self.min_age = min_age
+        self.batch_size = batch_size
+        self.max_inflight = max_inflight
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        # mp_id -> {"attempt": n, "due": monotonic, "first_seen": monotonic}
+        self._schedule: Dict[str, Dict] = {}
+        self.stats = {"runs": 0, "checked": 0, "expired": 0, "errors": 0}
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._loop, name="pix-reconciler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                with self._lock:
+                    self.stats["errors"] += 1
+                print(f"[pix-reconciler] erro na reconciliação: {e}")
+
+    def _backoff(self, attempt: int) -> float:
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return delay * random.uniform(0.8, 1.0)
+
+    def run_once(self) -> Dict:
+        """Uma passada: expira as vencidas e enfileira as pendentes cujo backoff venceu."""
+        expired = db.expire_pending_transactions(self.window)
+        submitted = 0
+        budget = self.max_inflight - self.queue.inflight()
+        now = time.monotonic()
+        after_id = 0
+        while budget > 0:
+            rows = db.list_pending_transactions(self.window, self.min_age, after_id, self.batch_size)
+            if not rows:
+                break
+            after_id = rows[-1]["id"]
+            for row in rows:
+                mp_id = str(row["mp_id"])
+                with self._lock:
+                    entry = self._schedule.setdefault(mp_id, {"attempt": 0, "due": now, "first_seen": now})
+                    if entry["due"] > now:
+                        continue
+                    entry["attempt"] += 1
+                    entry["due"] = now + self._backoff(entry["attempt"])
+                self.queue.submit(mp_id)
+                submitted += 1
+                budget -= 1
+                if budget <= 0:
+                    break
+
+        with self._lock:
+            # entradas mais velhas que a janela já foram expiradas ou resolvidas
+            for mp_id in [k for k, e in self._schedule.items() if now - e["first_seen"] > self.window]:
+                del self._schedule[mp_id]
+            self.stats["runs"] += 1
+            self.stats["checked"] += submitted
+            self.stats["expired"] += expired
+        return {"submitted": submitted, "expired": expired}
+
+    def record_status(self, mp_id: str, status) -> None:
+        """Resultado de uma consulta ao MP; status final encerra o acompanhamento do pagamento."""
+        if status in FINAL_STATUSES:
+            with self._lock:
+                self._schedule.pop(str(mp_id), None)
+
+    def tracked(self) -> int:
+        with self._lock:
+            return len(self._schedule)
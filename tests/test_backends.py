@@ -0,0 +1,205 @@
+# test_backends.py
+# Contrato da camada de dados: os mesmos testes rodam no SQLite (db.py) e no postgres
+# (db_postgres.py, só com DATABASE_URL). Compra, liquidação de PIX, ledger e paginação.
+
+import threading
+
+import db
+
+
+def _user(store, telegram_id: int, balance: float = 0.0) -> int:
+    user_id = store.ensure_user(telegram_id, f"u{telegram_id}", None, None)
+    if balance:
+        assert store.credit_balance(telegram_id, balance)
+    return user_id
+
+
+def _product(store, name: str = "Conta", price: float = 10.0, accesses: int = 2) -> int:
+    product_id = store.add_product(name, price)
+    result = store.bulk_add_product_access(product_id, ((f"{name}{i}@mail", f"s{i}") for i in range(accesses)))
+    assert result["inserted"] == accesses
+    return product_id
+
+
+def _run_threads(store, target, n: int) -> list:
+    results = [None] * n
+    start = threading.Barrier(n)
+
+    def worker(i):
+        start.wait()
+        try:
+            results[i] = target(i)
+        finally:
+            store.close_conn()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+# -------------------------
+# Compra
+# -------------------------
+def test_purchase_sells_access_and_debits_wallet(store):
+    _user(store, 1001, balance=25.0)
+    product_id = _product(store, price=10.0, accesses=2)
+
+    first = store.purchase(1001, product_id)
+    assert first["status"] == db.PURCHASE_OK
+    assert first["access"]["login"] == "Conta0@mail" and first["access"]["password"] == "s0"
+    assert first["price"] == 10.0 and first["balance"] == 15.0
+
+    second = store.purchase(1001, product_id)
+    assert second["status"] == db.PURCHASE_OK and second["access"]["login"] == "Conta1@mail"
+    assert store.get_balance(1001) == 5.0
+    assert store.get_product(product_id)["stock"] == 0
+    assert store.get_available_access(product_id) is None
+
+    assert store.purchase(1001, product_id)["status"] == db.PURCHASE_OUT_OF_STOCK
+    assert store.get_balance(1001) == 5.0
+    assert store.verify_wallets() == []
+
+
+def test_purchase_failures_change_nothing(store):
+    _user(store, 1001, balance=5.0)
+    product_id = _product(store, price=10.0, accesses=1)
+
+    result = store.purchase(1001, product_id)
+    assert result["status"] == db.PURCHASE_INSUFFICIENT_BALANCE and result["balance"] == 5.0
+    assert store.purchase(9999, product_id)["status"] == db.PURCHASE_NO_USER
+    assert store.purchase(1001, product_id + 100)["status"] == db.PURCHASE_NOT_FOUND
+
+    assert store.get_balance(1001) == 5.0
+    assert store.get_product(product_id)["stock"] == 1
+    assert store.get_available_access(product_id)["login"] == "Conta0@mail"
+
+
+def test_concurrent_purchases_sell_each_access_once(store):
+    buyers = 8
+    for i in range(buyers):
+        _user(store, 2000 + i, balance=10.0)
+    product_id = _product(store, price=10.0, accesses=5)
+
+    results = _run_threads(store, lambda i: store.purchase(2000 + i, product_id), buyers)
+
+    sold = [r["access"]["id"] for r in results if r["status"] == db.PURCHASE_OK]
+    assert len(sold) == 5 and len(set(sold)) == 5
+    assert sum(r["status"] == db.PURCHASE_OUT_OF_STOCK for r in results) == buyers - 5
+    assert store.get_product(product_id)["stock"] == 0
+    assert sum(store.get_balance(2000 + i) for i in range(buyers)) == 30.0
+    assert store.verify_wallets() == []
+
+
+# -------------------------
+# Liquidação de PIX
+# -------------------------
+def test_settle_approves_and_credits_once(store):
+    user_id = _user(store, 1001)
+    store.add_transaction(user_id, "mp-1", 20.0, "pending")
+
+    settled = store.settle_approved_payment("mp-1")
+    assert settled["telegram_id"] == 1001 and settled["amount"] == 20.0
+    assert store.settle_approved_payment("mp-1") is None
+    assert store.settle_approved_payment("nao-existe") is None
+
+    assert store.get_balance(1001) == 20.0
+    assert store.get_transaction_by_mp_id("mp-1")["status"] == "approved"
+    [entry] = store.get_ledger(1001)
+    assert entry["kind"] == db.LEDGER_RECHARGE and entry["amount_cents"] == 2000
+    assert entry["transaction_id"] == settled["transaction_id"]
+
+
+def test_concurrent_settle_credits_once(store):
+    user_id = _user(store, 1001)
+    store.add_transaction(user_id, "mp-2", 15.5, "pending")
+
+    results = _run_threads(store, lambda i: store.settle_approved_payment("mp-2", processed_by=f"t{i}"), 6)
+
+    assert sum(r is not None for r in results) == 1
+    assert store.get_balance(1001) == 15.5
+    assert store.verify_wallets() == []
+
+
+def test_settle_skips_payment_already_approved(store):
+    user_id = _user(store, 1001, balance=30.0)
+    store.add_transaction(user_id, "mp-3", 30.0, "approved")
+
+    assert store.settle_approved_payment("mp-3") is None
+    assert store.get_balance(1001) == 30.0
+
+
+# -------------------------
+# Ledger
+# -------------------------
+def test_ledger_entries_and_wallet_snapshot(store):
+    _user(store, 1001)
+    assert store.credit_balance(1001, 12.34, note="bônus")
+    assert store.debit_balance(1001, 2.34)
+    assert not store.credit_balance(9999, 1.0)
+
+    ledger = store.get_ledger(1001)
+    assert [(e["kind"], e["amount_cents"]) for e in ledger] == [(db.LEDGER_ADMIN, -234), (db.LEDGER_ADMIN, 1234)]
+    assert ledger[1]["note"] == "bônus"
+    assert store.get_balance(1001) == 10.0
+    assert store.verify_wallets() == []
+
+
+def test_recharge_credit_is_idempotent_per_transaction(store):
+    user_id = _user(store, 1001)
+    tx_id = store.add_transaction(user_id, "mp-4", 5.0, "approved")
+
+    assert store.credit_balance(1001, 5.0, kind=db.LEDGER_RECHARGE, transaction_id=tx_id)
+    assert not store.credit_balance(1001, 5.0, kind=db.LEDGER_RECHARGE, transaction_id=tx_id)
+    assert store.get_balance(1001) == 5.0
+
+
+# -------------------------
+# Paginação
+# -------------------------
+def test_history_pages_walk_both_directions(store):
+    user_id = _user(store, 1001)
+    other_id = _user(store, 1002)
+    for i in range(25):
+        store.add_transaction(user_id, f"h{i}", float(i + 1), "pending")
+        store.settle_approved_payment(f"h{i}")
+    store.add_transaction(other_id, "outro", 1.0, "pending")
+    store.settle_approved_payment("outro")
+    other_tx = store.get_transaction_by_mp_id("outro")["id"]
+
+    page1 = store.get_approved_history_page(1001, limit=10)
+    assert [r["mp_id"] for r in page1["rows"]] == [f"h{i}" for i in range(24, 14, -1)]
+    assert page1["has_older"] and not page1["has_newer"]
+
+    page2 = store.get_approved_history_page(1001, limit=10, before_id=page1["rows"][-1]["id"])
+    page3 = store.get_approved_history_page(1001, limit=10, before_id=page2["rows"][-1]["id"])
+    assert [r["mp_id"] for r in page3["rows"]] == [f"h{i}" for i in range(4, -1, -1)]
+    assert not page3["has_older"] and page3["has_newer"]
+
+    back = store.get_approved_history_page(1001, limit=10, after_id=page3["rows"][0]["id"])
+    assert back["rows"] == page2["rows"] and back["has_newer"]
+
+    # cursor de outro usuário não vaza nada
+    assert store.get_approved_history_page(1001, limit=10, before_id=other_tx)["rows"] == []
+
+
+def test_catalog_pages_by_category(store):
+    games = store.add_category("Jogos", position=1)
+    ids = [_product(store, name=f"P{i}", price=1.0 + i, accesses=1) for i in range(7)]
+    for product_id in ids[:5]:
+        assert store.set_product_category(product_id, games)
+    _product(store, name="Esgotado", accesses=0)
+
+    cats = store.list_categories()
+    assert [(c["id"], c["name"], c["available"]) for c in cats] == [(games, "Jogos", 5), (0, "Outros", 2)]
+
+    page1 = store.list_products(category_id=games, limit=2)
+    page2 = store.list_products(category_id=games, limit=2, after_id=page1[-1]["id"])
+    page3 = store.list_products(category_id=games, limit=2, after_id=page2[-1]["id"])
+    assert [p["id"] for p in page1 + page2 + page3] == ids[:5]
+    assert store.list_products(category_id=games, limit=2, before_id=page3[0]["id"]) == page2
+
+    assert [p["id"] for p in store.list_products(category_id=0, limit=10)] == ids[5:]
+    assert sorted(p["id"] for p in store.list_products()) == ids
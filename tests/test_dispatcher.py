@@ -0,0 +1,89 @@
+# test_dispatcher.py
+# ChatDispatcher instalado num bot falso: ordem por chat e chats em paralelo.
+
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from dispatcher import ChatDispatcher, install
+
+
+def _update(chat_id: int, seq: int):
+    return SimpleNamespace(update_id=seq, message=SimpleNamespace(chat=SimpleNamespace(id=chat_id), text=str(seq)))
+
+
+class FakeBot:
+    """process_new_updates do telebot: grava (chat, seq) de cada update, na ordem em que roda."""
+
+    def __init__(self, handler):
+        self.threaded = True
+        self.handler = handler
+
+    def process_new_updates(self, updates):
+        for upd in updates:
+            self.handler(upd)
+
+
+def _wait_idle(dispatcher: ChatDispatcher, timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while dispatcher.stats()["queue_depth"]:
+        assert time.monotonic() < deadline, "dispatcher não esvaziou"
+        time.sleep(0.005)
+
+
+def test_interleaved_chats_keep_order_and_run_in_parallel():
+    seen = {1: [], 2: []}
+    running = {1: 0, 2: 0}
+    overlap = threading.Event()
+    lock = threading.Lock()
+
+    def handler(upd):
+        chat = upd.message.chat.id
+        with lock:
+            running[chat] += 1
+            assert running[chat] == 1, "dois updates do mesmo chat ao mesmo tempo"
+            if running[1] and running[2]:
+                overlap.set()
+        if upd.update_id == 0:
+            overlap.wait(5)  # só termina quando o chat 2 já estiver rodando junto
+        time.sleep(random.uniform(0, 0.002))
+        with lock:
+            seen[chat].append(upd.update_id)
+            running[chat] -= 1
+
+    bot = FakeBot(handler)
+    dispatcher = ChatDispatcher(workers=4, name="teste")
+    install(bot, dispatcher)
+    assert bot.threaded is False
+
+    # um lote do getUpdates com os dois chats intercalados
+    bot.process_new_updates([_update(1 + i % 2, i) for i in range(40)])
+    _wait_idle(dispatcher)
+
+    assert seen[1] == list(range(0, 40, 2))
+    assert seen[2] == list(range(1, 40, 2))
+    assert overlap.is_set()
+    assert dispatcher.stats()["processed"] == 40 and dispatcher.stats()["errors"] == 0
+
+
+def test_slow_chat_does_not_block_other_chat():
+    release = threading.Event()
+    done = []
+
+    def handler(upd):
+        if upd.message.chat.id == 1:
+            release.wait(5)
+        done.append(upd.update_id)
+        if upd.message.chat.id == 2:
+            release.set()
+
+    bot = FakeBot(handler)
+    dispatcher = ChatDispatcher(workers=2, name="teste")
+    install(bot, dispatcher)
+
+    bot.process_new_updates([_update(1, 0), _update(1, 1), _update(2, 2)])
+    assert release.wait(5)
+    _wait_idle(dispatcher)
+    # o chat 2 terminou enquanto o chat 1 esperava; o chat 1 manteve a ordem
+    assert done[0] == 2 and done[1:] == [0, 1]
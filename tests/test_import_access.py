@@ -0,0 +1,39 @@
+# test_import_access.py
+# Leitura dos arquivos do /importar (_iter_access_lines).
+
+import os
+
+import pytest
+
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:teste")
+bot = pytest.importorskip("bot")
+
+
+def _parse(text: str):
+    counts = {"malformed": 0}
+    rows = list(bot._iter_access_lines(text.encode("utf-8"), counts))
+    return rows, counts["malformed"]
+
+
+def test_password_may_contain_other_delimiters():
+    rows, malformed = _parse("user1@mail.com:pass1\nuser2@mail.com:pa,ss\nuser3@mail.com:a|b;c\n")
+    assert rows == [("user1@mail.com", "pass1"), ("user2@mail.com", "pa,ss"), ("user3@mail.com", "a|b;c")]
+    assert malformed == 0
+
+
+def test_splits_only_on_first_delimiter():
+    rows, malformed = _parse("login | senha\nana | p|a|ss\nbia|x\n")
+    assert rows == [("ana", "p|a|ss"), ("bia", "x")]
+    assert malformed == 0
+
+
+def test_quoted_csv_with_bom_and_comments():
+    rows, malformed = _parse('﻿login,senha\n# comentário\n\n"a@b.com", "se,nha"\nc@d.com,e\n')
+    assert rows == [("a@b.com", "se,nha"), ("c@d.com", "e")]
+    assert malformed == 0
+
+
+def test_lines_without_file_delimiter_are_malformed():
+    rows, malformed = _parse("a;1\nb;2\nsemseparador\nc:3\n;vazio\n")
+    assert rows == [("a", "1"), ("b", "2")]
+    assert malformed == 3
@@ -0,0 +1,36 @@
+# test_metrics.py
+# Texto do /metrics: tipos das métricas e leituras do scrape fora do db_call_seconds.
+
+import os
+
+import pytest
+
+import metrics
+
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:teste")
+bot = pytest.importorskip("bot")
+
+
+def _families(text: str) -> dict:
+    """nome -> tipo, das linhas # TYPE."""
+    return dict(line.split()[2:4] for line in text.splitlines() if line.startswith("# TYPE"))
+
+
+def test_lock_waits_and_cache_lookups_are_counters():
+    types = _families(metrics.render())
+    assert types["db_lock_waits_total"] == "counter"
+    assert types["user_cache_lookups_total"] == "counter"
+    assert types["user_cache_size"] == "gauge"
+    assert "db_lock_waits" not in types and "user_cache" not in types
+
+
+def test_scrape_does_not_feed_db_call_seconds(sqlite_db):
+    sqlite_db.migrate()
+    sqlite_db.ensure_user(1001, "cliente", None, None)
+
+    text = metrics.render()
+    assert 'user_cache_lookups_total{result="misses"} 1' in text
+    for name in ("lock_stats", "user_cache_stats"):
+        assert bot.M_DB_SECONDS._values.get((name,)) is None
+    # funções que vão ao banco continuam medidas
+    assert bot.M_DB_SECONDS._values[("ensure_user",)][2] >= 1
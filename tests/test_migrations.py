@@ -0,0 +1,241 @@
+# test_migrations.py
+# Upgrade a partir do schema original (user_version 0, sem ledger nem processed_events).
+
+import sqlite3
+import threading
+
+# tabelas da primeira versão de db.py, antes das migrações versionadas
+BASELINE_SCHEMA = """
+CREATE TABLE users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    telegram_id INTEGER UNIQUE NOT NULL,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT
+);
+CREATE TABLE wallet (
+    user_id INTEGER PRIMARY KEY,
+    balance REAL NOT NULL DEFAULT 0,
+    FOREIGN KEY (user_id) REFERENCES users(id)
+);
+CREATE TABLE products (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    price REAL NOT NULL,
+    stock INTEGER DEFAULT 0,
+    active INTEGER DEFAULT 1
+);
+CREATE TABLE product_access (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    product_id INTEGER NOT NULL,
+    login TEXT NOT NULL,
+    senha TEXT NOT NULL,
+    vendido INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY (product_id) REFERENCES products(id)
+);
+CREATE TABLE transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    mp_id TEXT,
+    amount REAL NOT NULL,
+    status TEXT NOT NULL,
+    description TEXT,
+    raw_json TEXT,
+    created_at TEXT DEFAULT (datetime('now')),
+    approved_at TEXT,
+    FOREIGN KEY (user_id) REFERENCES users(id)
+);
+CREATE TABLE admins (
+    telegram_id INTEGER PRIMARY KEY,
+    nome TEXT,
+    senha TEXT,
+    nivel INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE banned_users (
+    telegram_id INTEGER PRIMARY KEY
+);
+CREATE TABLE sales (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    product_id INTEGER,
+    amount REAL,
+    quantity INTEGER DEFAULT 1,
+    date TEXT DEFAULT (datetime('now'))
+);
+"""
+
+
+def _baseline_store(path: str) -> None:
+    """Loja antiga: PIX 555 aprovado e creditado (R$ 50) e PIX 556 ainda pendente."""
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.execute("INSERT INTO users (id, telegram_id, username) VALUES (1, 1001, 'cliente')")
+    conn.execute("INSERT INTO wallet (user_id, balance) VALUES (1, 50.0)")
+    conn.execute("""INSERT INTO transactions (user_id, mp_id, amount, status, approved_at)
+                    VALUES (1, '555', 50.0, 'approved', datetime('now'))""")
+    conn.execute("INSERT INTO transactions (user_id, mp_id, amount, status) VALUES (1, '556', 20.0, 'pending')")
+    conn.commit()
+    conn.close()
+
+
+def test_upgrade_from_baseline_does_not_credit_legacy_payment_again(sqlite_db):
+    _baseline_store(sqlite_db.DB_PATH)
+    assert sqlite_db.schema_version() == 0
+
+    assert sqlite_db.migrate() == sqlite_db.SCHEMA_VERSION
+    assert sqlite_db.get_balance(1001) == 50.0
+
+    # /aprovarpix ou notificação reenviada pelo MP para o pagamento antigo
+    assert sqlite_db.settle_approved_payment("555") is None
+    assert sqlite_db.settle_approved_payment("555") is None
+    assert sqlite_db.get_balance(1001) == 50.0
+    assert sqlite_db.verify_wallets() == []
+
+    # o pendente continua sendo creditado uma vez
+    settled = sqlite_db.settle_approved_payment("556")
+    assert settled["amount"] == 20.0 and settled["telegram_id"] == 1001
+    assert sqlite_db.settle_approved_payment("556") is None
+    assert sqlite_db.get_balance(1001) == 70.0
+    assert sqlite_db.verify_wallets() == []
+
+
+def test_approved_payment_without_event_is_not_credited(sqlite_db):
+    # banco já na v11 sem o evento (ex.: migrado antes do backfill)
+    sqlite_db.migrate()
+    user_id = sqlite_db.ensure_user(2002, "outro", None, None)
+    sqlite_db.add_transaction(user_id, "777", 30.0, "approved")
+
+    assert sqlite_db.settle_approved_payment("777") is None
+    assert sqlite_db.get_balance(2002) == 0.0
+    # o evento fica registrado: as próximas chamadas param no processed_events
+    row = sqlite_db._conn().execute(
+        "SELECT kind FROM processed_events WHERE event_key = ?", ("payment.approved:777",)).fetchone()
+    assert row["kind"] == "payment.approved"
+
+
+def test_startup_on_current_schema_is_silent(sqlite_db, capsys):
+    assert sqlite_db.migrate() == sqlite_db.SCHEMA_VERSION
+    assert sqlite_db.migrate() == sqlite_db.SCHEMA_VERSION
+    assert capsys.readouterr().out == ""
+
+
+# -------------------------
+# rebuild_table / migrações online
+# -------------------------
+SCRATCH_V2 = """
+CREATE TABLE {table} (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    qty INTEGER NOT NULL DEFAULT 0,
+    note TEXT DEFAULT 'v2'
+)
+"""
+
+
+def _scratch(store, rows: int) -> None:
+    with store.transaction() as conn:
+        conn.execute("CREATE TABLE scratch (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, qty INTEGER NOT NULL DEFAULT 0)")
+        conn.executemany("INSERT INTO scratch (name, qty) VALUES (?, ?)", [(f"n{i}", i) for i in range(rows)])
+
+
+def _objects(store, table: str) -> set:
+    return {r["name"] for r in store._conn().execute("SELECT name FROM sqlite_master WHERE tbl_name = ?", (table,))}
+
+
+def test_rebuild_table_copies_rows_and_runs_post_sql(sqlite_db):
+    _scratch(sqlite_db, 120)
+    before = [tuple(r) for r in sqlite_db._conn().execute("SELECT id, name, qty FROM scratch ORDER BY id")]
+
+    batches = sqlite_db.rebuild_table("scratch", SCRATCH_V2, post_sql=("CREATE INDEX idx_scratch_name ON scratch (name)",),
+                                      batch_size=50)
+
+    assert batches == 3
+    conn = sqlite_db._conn()
+    assert [tuple(r) for r in conn.execute("SELECT id, name, qty FROM scratch ORDER BY id")] == before
+    assert {r["note"] for r in conn.execute("SELECT note FROM scratch")} == {"v2"}
+    assert _objects(sqlite_db, "scratch") == {"scratch", "idx_scratch_name"}
+    assert not _objects(sqlite_db, "scratch__new")
+
+
+def test_rebuild_table_mirrors_concurrent_writes(sqlite_db):
+    _scratch(sqlite_db, 600)
+
+    def writer():
+        try:
+            for i in range(120):
+                with sqlite_db.transaction() as conn:
+                    conn.execute("INSERT INTO scratch (name, qty) VALUES (?, -1)", (f"novo{i}",))
+                    conn.execute("UPDATE scratch SET qty = qty + 1000 WHERE id = ?", (i * 5 + 1,))
+                    conn.execute("DELETE FROM scratch WHERE id = ?", (i * 5 + 2,))
+        finally:
+            sqlite_db.close_conn()
+
+    # lotes pequenos com pausa: a cópia leva várias transações e o escritor entra entre elas
+    t = threading.Thread(target=writer)
+    t.start()
+    sqlite_db.rebuild_table("scratch", SCRATCH_V2, batch_size=25, pause=0.002)
+    t.join()
+
+    rows = {r["name"]: r["qty"] for r in sqlite_db._conn().execute("SELECT name, qty FROM scratch")}
+    assert len(rows) == 600
+    assert all(rows[f"novo{i}"] == -1 for i in range(120))
+    assert all(f"n{i * 5 + 1}" not in rows for i in range(120))
+    assert all(rows[f"n{i * 5}"] == i * 5 + 1000 for i in range(120))
+    assert rows["n3"] == 3
+
+
+def test_rebuild_table_can_rerun_after_failed_swap(sqlite_db):
+    _scratch(sqlite_db, 40)
+    try:
+        sqlite_db.rebuild_table("scratch", SCRATCH_V2, post_sql=("CREATE INDEX quebrado ON nao_existe (x)",), batch_size=10)
+    except sqlite3.OperationalError:
+        pass
+    else:
+        raise AssertionError("post_sql inválido deveria falhar")
+    # a troca é uma transação só: a tabela antiga continua inteira
+    assert "note" not in sqlite_db._column_names(sqlite_db._conn().cursor(), "scratch")
+
+    sqlite_db.rebuild_table("scratch", SCRATCH_V2, batch_size=10)
+    assert sqlite_db._conn().execute("SELECT COUNT(*) FROM scratch").fetchone()[0] == 40
+    assert not _objects(sqlite_db, "scratch__new")
+
+
+def _with_online_step(sqlite_db, monkeypatch):
+    """Acrescenta à lista uma etapa online que reconstrói categories (existe desde a v10)."""
+    version = sqlite_db.SCHEMA_VERSION + 1
+
+    def step():
+        sqlite_db.rebuild_table("categories", """
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            position INTEGER NOT NULL DEFAULT 0,
+            hidden INTEGER NOT NULL DEFAULT 0
+        )
+        """)
+
+    monkeypatch.setattr(sqlite_db, "MIGRATIONS", sqlite_db.MIGRATIONS + [(version, "teste online", step, True)])
+    monkeypatch.setattr(sqlite_db, "SCHEMA_VERSION", version)
+    return version
+
+
+def test_online_step_waits_for_db_migrate_on_database_in_use(sqlite_db, monkeypatch, capsys):
+    sqlite_db.migrate()
+    sqlite_db.add_category("Jogos")
+    version = _with_online_step(sqlite_db, monkeypatch)
+
+    assert sqlite_db.migrate() == version - 1
+    assert "pendente" in capsys.readouterr().out
+
+    assert sqlite_db.migrate(online=True) == version
+    assert "hidden" in sqlite_db._column_names(sqlite_db._conn().cursor(), "categories")
+    assert [c["name"] for c in sqlite_db.list_all_categories()] == ["Jogos"]
+
+
+def test_online_step_runs_in_place_on_fresh_database(sqlite_db, monkeypatch, capsys):
+    version = _with_online_step(sqlite_db, monkeypatch)
+
+    assert sqlite_db.migrate() == version
+    assert sqlite_db.migrate() == version
+    assert "pendente" not in capsys.readouterr().out
+    assert "hidden" in sqlite_db._column_names(sqlite_db._conn().cursor(), "categories")
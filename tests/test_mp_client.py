@@ -0,0 +1,98 @@
+# test_mp_client.py
+# MercadoPagoClient com uma sessão falsa (sem rede): retentativas e circuit breaker.
+
+import time
+
+import pytest
+import requests
+
+from mp_client import CircuitBreaker, CircuitOpenError, MercadoPagoClient
+
+
+def _response(status: int, body: bytes = b"{}") -> requests.Response:
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = body
+    resp.url = "http://mp.local/v1/payments"
+    return resp
+
+
+class FakeSession:
+    """Devolve (ou levanta) os itens de `script` em ordem; guarda os cabeçalhos de cada chamada."""
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.calls = []
+
+    def request(self, method, url, timeout=None, headers=None, **kwargs):
+        self.calls.append((method, url, dict(headers or {})))
+        item = self.script.pop(0)
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+
+def _client(script, breaker=None, max_retries=3) -> MercadoPagoClient:
+    client = MercadoPagoClient("TOKEN", base_url="http://mp.local", max_retries=max_retries,
+                               backoff_base=0, breaker=breaker or CircuitBreaker())
+    client.session = FakeSession(script)
+    return client
+
+
+def test_create_payment_retries_5xx_and_timeout_with_same_idempotency_key():
+    client = _client([_response(502), requests.Timeout("lento"), _response(201, b'{"id": 99}')])
+
+    assert client.create_payment({"transaction_amount": 10}, idempotency_key="chave-1") == {"id": 99}
+    keys = [headers["X-Idempotency-Key"] for _, _, headers in client.session.calls]
+    assert keys == ["chave-1"] * 3
+    assert client.breaker.state == "closed"
+
+
+def test_generated_idempotency_key_is_reused_across_retries():
+    client = _client([requests.ConnectionError("reset"), _response(201, b'{"id": 1}')])
+
+    client.create_payment({"transaction_amount": 10})
+    first, second = (headers["X-Idempotency-Key"] for _, _, headers in client.session.calls)
+    assert first and first == second
+
+
+def test_definitive_4xx_is_not_retried_and_does_not_trip_breaker():
+    breaker = CircuitBreaker(failure_threshold=1)
+    client = _client([_response(400)], breaker=breaker)
+
+    with pytest.raises(requests.HTTPError):
+        client.get_payment("1")
+    assert len(client.session.calls) == 1
+    assert breaker.state == "closed"
+
+
+def test_breaker_opens_half_opens_and_closes():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    client = _client([_response(503), _response(503), _response(200, b'{"id": 7}')], breaker=breaker, max_retries=0)
+
+    for _ in range(2):
+        with pytest.raises(requests.HTTPError):
+            client.get_payment("7")
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        client.get_payment("7")
+    assert len(client.session.calls) == 2  # aberto: nem chega na rede
+
+    time.sleep(0.06)
+    assert breaker.state == "half-open"
+    assert client.get_payment("7") == {"id": 7}
+    assert breaker.state == "closed"
+
+
+def test_failed_probe_reopens_and_only_one_probe_passes():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+
+    breaker.before_call()  # a chamada de teste
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()  # outra chamada enquanto o teste está em voo
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
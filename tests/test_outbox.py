@@ -0,0 +1,71 @@
+# test_outbox.py
+# Reenvio do outbox com um bot falso (sem rede).
+
+import io
+import json
+import threading
+
+from outbox import Outbox
+
+
+class RateLimited(Exception):
+    error_code = 429
+    result_json = {"parameters": {"retry_after": 0.01}}
+
+
+class FlakyBot:
+    """Responde 429 na primeira chamada; guarda o que cada tentativa leu do arquivo."""
+
+    def __init__(self):
+        self.uploads = []
+
+    def send_photo(self, chat_id, photo, caption=None, document=None):
+        self.uploads.append((photo.read(), document.read() if document else None))
+        if len(self.uploads) == 1:
+            raise RateLimited("Too Many Requests: retry after 0.01")
+
+
+def test_retry_after_429_resends_the_whole_file():
+    bot = FlakyBot()
+    outbox = Outbox(bot, dead_letter_path=None)
+    done = threading.Event()
+    result = {}
+
+    def on_done(ok, error):
+        result["ok"] = ok
+        done.set()
+
+    outbox.send_photo(42, io.BytesIO(b"\x89PNG qr code"), caption="PIX", on_done=on_done,
+                      document=io.BytesIO(b"extra"))
+    assert done.wait(5)
+
+    assert result["ok"] is True
+    assert bot.uploads == [(b"\x89PNG qr code", b"extra")] * 2
+    assert outbox.stats["rate_limited"] == 1 and outbox.stats["sent"] == 1
+
+
+class Blocked(Exception):
+    error_code = 403
+    result_json = {}
+
+
+class BlockedBot:
+    def send_message(self, chat_id, text, **kwargs):
+        raise Blocked("Forbidden: bot was blocked by the user")
+
+
+def test_dead_letter_log_never_keeps_full_or_sensitive_text(tmp_path):
+    path = tmp_path / "dead.jsonl"
+    outbox = Outbox(BlockedBot(), dead_letter_path=str(path))
+    done = threading.Semaphore(0)
+
+    outbox.send_message(1, "🔑 Acesso: cliente@mail\n🔐 Senha: segredo123", sensitive=True,
+                        on_done=lambda ok, error: done.release())
+    outbox.send_message(2, "Aviso geral " + "x" * 100 + " fim-do-texto", on_done=lambda ok, error: done.release())
+    assert done.acquire(timeout=5) and done.acquire(timeout=5)
+
+    records = {r["chat_id"]: r for r in map(json.loads, path.read_text(encoding="utf-8").splitlines())}
+    assert "segredo123" not in path.read_text(encoding="utf-8")
+    assert set(records[1]) == {"ts", "chat_id", "method", "attempts", "error"}
+    assert records[2]["preview"].startswith("Aviso geral ") and "fim-do-texto" not in records[2]["preview"]
+    assert records[2]["method"] == "send_message" and records[2]["attempts"] == 1
@@ -0,0 +1,60 @@
+# test_reconciler.py
+# PendingReconciler com uma fila falsa que consulta um "MP" em memória.
+
+from reconciler import FINAL_STATUSES, PendingReconciler
+
+
+class FakeQueue:
+    """submit() consulta o pagamento na hora, como o process_payment_notification do bot."""
+
+    def __init__(self, store, mp_status):
+        self.store = store
+        self.mp_status = mp_status
+        self.submitted = []
+        self.reconciler = None
+
+    def submit(self, mp_id):
+        self.submitted.append(mp_id)
+        status = self.mp_status[mp_id]
+        if status in FINAL_STATUSES:
+            # o bot liquida ou marca a transação; aqui basta tirá-la de 'pending'
+            self.store.mark_pending_transaction(mp_id, status)
+        self.reconciler.record_status(mp_id, status)
+        return True
+
+    def inflight(self):
+        return 0
+
+
+def _reconciler(store, mp_status) -> PendingReconciler:
+    store.migrate()
+    user_id = store.ensure_user(1001, "cliente", None, None)
+    for mp_id in mp_status:
+        store.add_transaction(user_id, mp_id, 10.0, "pending")
+    q = FakeQueue(store, mp_status)
+    # base_delay 0: todo pagamento ainda acompanhado volta a ser consultado na passada seguinte
+    q.reconciler = PendingReconciler(q, min_age=0, base_delay=0)
+    return q.reconciler
+
+
+def test_final_status_stops_tracking_payment(sqlite_db):
+    reconciler = _reconciler(sqlite_db, {"mp-pago": "approved", "mp-espera": "pending", "mp-negado": "rejected"})
+
+    assert reconciler.run_once()["submitted"] == 3
+    assert reconciler.tracked() == 1
+    assert sorted(reconciler._schedule) == ["mp-espera"]
+
+    reconciler.queue.submitted.clear()
+    reconciler.run_once()
+    assert reconciler.queue.submitted == ["mp-espera"]
+    assert reconciler._schedule["mp-espera"]["attempt"] == 2
+
+
+def test_non_final_status_keeps_backoff(sqlite_db):
+    reconciler = _reconciler(sqlite_db, {"mp-1": "in_process"})
+    reconciler.base_delay = 60
+
+    reconciler.run_once()
+    reconciler.run_once()
+    assert reconciler.queue.submitted == ["mp-1"]
+    assert reconciler.tracked() == 1
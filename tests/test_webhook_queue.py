@@ -0,0 +1,96 @@
+# test_webhook_queue.py
+# PaymentQueue: coalescência por payment_id, reprocessamento e desistência.
+
+import threading
+import time
+
+from webhook_queue import PaymentQueue
+
+
+def _wait_idle(q: PaymentQueue, timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while q.inflight() or q.depth():
+        assert time.monotonic() < deadline, "fila não esvaziou"
+        time.sleep(0.005)
+
+
+def test_duplicate_notifications_in_flight_are_coalesced():
+    release = threading.Event()
+    calls = []
+
+    def process(payment_id):
+        calls.append(payment_id)
+        release.wait(5)
+
+    q = PaymentQueue(process, workers=2)
+    assert q.submit("p1") is True
+    assert q.submit(123) is True
+    assert q.submit("p1") is False
+    assert q.submit("p1") is False
+    release.set()
+    _wait_idle(q)
+
+    # as duas duplicatas viram uma só rodada extra
+    assert sorted(calls) == ["123", "p1", "p1"]
+    assert q.stats["enqueued"] == 2 and q.stats["coalesced"] == 2 and q.stats["processed"] == 3
+
+
+def test_notification_during_processing_runs_again():
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def process(payment_id):
+        calls.append(payment_id)
+        if len(calls) == 1:
+            started.set()
+            release.wait(5)
+
+    q = PaymentQueue(process, workers=1)
+    q.submit("p1")
+    assert started.wait(5)
+    assert q.submit("p1") is False
+    release.set()
+    _wait_idle(q)
+
+    assert calls == ["p1", "p1"]
+    assert q.submit("p1") is True  # liberado depois da segunda rodada
+    _wait_idle(q)
+
+
+def test_gives_up_after_max_attempts():
+    calls = []
+
+    def process(payment_id):
+        calls.append(payment_id)
+        raise RuntimeError("MP fora do ar")
+
+    q = PaymentQueue(process, workers=1, max_attempts=3, base_delay=0.001, max_delay=0.001)
+    q.submit("p1")
+    _wait_idle(q)
+
+    assert calls == ["p1"] * 3
+    assert q.stats["retried"] == 2 and q.stats["failed"] == 1 and q.stats["processed"] == 0
+    assert q.submit("p1") is True
+    _wait_idle(q)
+
+
+def test_notification_during_failing_attempts_is_retried_after_give_up():
+    failing = threading.Event()
+    calls = []
+
+    def process(payment_id):
+        calls.append(payment_id)
+        if len(calls) <= 2:
+            failing.set()
+            raise RuntimeError("MP fora do ar")
+
+    q = PaymentQueue(process, workers=1, max_attempts=2, base_delay=0.05, max_delay=0.05)
+    q.submit("p1")
+    assert failing.wait(5)
+    assert q.submit("p1") is False  # chega durante o backoff
+    _wait_idle(q)
+
+    # as duas tentativas falham; a notificação nova ganha uma rodada própria
+    assert calls == ["p1"] * 3
+    assert q.stats["failed"] == 1 and q.stats["processed"] == 1
@@ -0,0 +1,105 @@
+# webhook_queue.py
+# Fila de processamento de notificações de pagamento (webhook Mercado Pago)
+# - O endpoint só valida e enfileira; workers processam em background
+# - Singleflight por payment_id: notificações duplicadas em voo são coalescidas
+# - Retentativas com backoff exponencial (+ jitter) quando o processamento falha
+
+import queue
+import random
+import threading
+from typing import Callable, Dict
+
+class PaymentQueue:
+    """
+    process_fn(payment_id) faz o trabalho real (consulta MP, aprova, credita, notifica)
+    e deve ser idempotente. Exceções disparam nova tentativa com backoff até max_attempts.
+    """
+
+    def __init__(self, process_fn: Callable[[str], object], workers: int = 4, max_attempts: int = 5,
+                 base_delay: float = 2.0, max_delay: float = 60.0, name: str = "mp-webhook"):
+        self.process_fn = process_fn
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.name = name
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        # payment_id -> True se chegou nova notificação enquanto processava (reprocessar)
+        self._inflight: Dict[str, bool] = {}
+        self._threads = []
+        self.stats = {"enqueued": 0, "coalesced": 0, "processed": 0, "retried": 0, "failed": 0}
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, name=f"{self.name}-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, payment_id: str) -> bool:
+        """Enfileira payment_id. Retorna False se foi coalescido com um já em voo."""
+        payment_id = str(payment_id)
+        with self._lock:
+            if payment_id in self._inflight:
+                self._inflight[payment_id] = True
+                self.stats["coalesced"] += 1
+                return False
+            self._inflight[payment_id] = False
+            self.stats["enqueued"] += 1
+        self.start()
+        self._queue.put((payment_id, 1))
+        return True
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def inflight(self) -> int:
+        with self._lock:
+            return len(self._inflight)
+
+    def _backoff(self, attempt: int) -> float:
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+    def _worker(self):
+        while True:
+            payment_id, attempt = self._queue.get()
+            try:
+                self.process_fn(payment_id)
+            except Exception as e:
+                if attempt < self.max_attempts:
+                    delay = self._backoff(attempt)
+                    print(f"[{self.name}] falha ao processar {payment_id} (tentativa {attempt}): {e}; nova tentativa em {delay:.1f}s")
+                    with self._lock:
+                        self.stats["retried"] += 1
+                    timer = threading.Timer(delay, self._queue.put, args=((payment_id, attempt + 1),))
+                    timer.daemon = True
+                    timer.start()
+                    continue
+                print(f"[{self.name}] desistindo de {payment_id} após {attempt} tentativas: {e}")
+                with self._lock:
+                    self.stats["failed"] += 1
+                self._finish(payment_id)
+                continue
+            finally:
+                self._queue.task_done()
+
+            with self._lock:
+                self.stats["processed"] += 1
+            self._finish(payment_id)
+
+    def _finish(self, payment_id: str):
+        """Fim do processamento (sucesso ou desistência): libera o id ou roda de novo."""
+        with self._lock:
+            rerun = self._inflight.get(payment_id)
+            if rerun:
+                # chegou notificação nova durante o processamento: roda mais uma vez,
+                # com as tentativas zeradas
+                self._inflight[payment_id] = False
+            else:
+                self._inflight.pop(payment_id, None)
+        if rerun:
+            self._queue.put((payment_id, 1))
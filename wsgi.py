@@ -0,0 +1,23 @@
+# wsgi.py
+# Entrada de produção do HTTP (/mp/webhook, /tg/webhook, /metrics) em servidor WSGI
+# multi-worker, separado do processo de polling do bot.
+#
+# Uso (gunicorn):
+#   EMBEDDED_FLASK=0 python bot.py          -> polling (ou set_webhook), reconciliador e broadcasts
+#   gunicorn -w 4 -k gthread --threads 8 -b 0.0.0.0:8000 wsgi:app
+#
+# - Cada worker é um processo com as próprias filas (PaymentQueue, outbox, dispatcher)
+# - Não use --preload: conexões do banco e threads precisam nascer dentro de cada worker
+# - Os workers não fazem polling, não rodam o reconciliador nem retomam broadcasts
+# - A mesma notificação do MP pode chegar em workers diferentes (ou no reconciliador):
+#   settle_approved_payment grava o evento em processed_events (chave única) e aprova +
+#   credita numa transação só, então o crédito acontece uma única vez
+# - /metrics mostra só o worker que respondeu ao scrape
+# - Processos em hosts diferentes precisam de DB_BACKEND=postgres (SQLite = um arquivo local)
+
+import bot
+
+bot.init_process()
+
+app = bot.app
+application = app  # nome padrão procurado por alguns servidores WSGI